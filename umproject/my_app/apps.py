@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class MyAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'my_app'
+
+    def ready(self):
+        from . import signals # connects the cache invalidation hooks
+        from django.db.backends.signals import connection_created
+        from .database import apply_sqlite_pragmas
+        connection_created.connect(apply_sqlite_pragmas, dispatch_uid='apply_sqlite_pragmas') # WAL, cache size and mmap for SQLite
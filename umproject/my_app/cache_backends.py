@@ -0,0 +1,22 @@
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache # Django's local-memory cache backend
+
+# Local-memory cache with a limit on the bytes it holds, as well as on the number of entries.
+# Gallery fragments can be megabytes each, so MAX_ENTRIES alone doesn't bound the memory a worker
+# process uses for its cache. Set OPTIONS['MAX_BYTES'] (in settings.CACHES); whenever the entries
+# (pickled) add up to more than that, the least recently used ones are dropped until they fit.
+class ByteLimitedLocMemCache(LocMemCache):
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        self._max_bytes = int(params.get('OPTIONS', {}).get('MAX_BYTES', 256 * 1024 * 1024))
+
+    # Called with the lock held, and value already pickled. Entries are kept most recently used first.
+    def _set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        super()._set(key, value, timeout)
+        stored_bytes = sum(len(pickled) for pickled in self._cache.values())
+        while stored_bytes > self._max_bytes and len(self._cache) > 1:
+            evicted_key, evicted = self._cache.popitem(last=True)
+            self._expire_info.pop(evicted_key, None)
+            stored_bytes -= len(evicted)
+        if stored_bytes > self._max_bytes: # one entry bigger than the whole cache
+            self._delete(key)
@@ -0,0 +1,111 @@
+from contextlib import contextmanager # For batching invalidations
+from contextvars import ContextVar # The searches changed so far in the current batch
+from django.conf import settings # For cache timeouts set in settings.py
+from django.core.cache import cache # Django's cache framework, configured by CACHES in settings.py
+from django.db.models import F # For bumping a search's content version in the database
+from .models import Search
+
+# Cache layer for pages whose output only changes when images or searches are added or deleted.
+#
+# Per-search entries (the rendered gallery cards and the image count) are keyed by the search id
+# and its content version, Search.content_version. Saving or deleting an Image bumps its search's
+# version (see signals.py), so stale entries are never read again and just age out of the cache.
+# Code that changes many images at once (a scrape, a batch of saves, a refresh) runs inside
+# invalidation_batch(), so each search's version goes up once at the end instead of once per image.
+# The version is in the database rather than the cache, so a change made in any process (another
+# worker, or a management command like purge_images) is seen by every process straight away.
+# The site-wide entries (the past searches list and the search/image counts) are deleted outright
+# when a Search or Image is added or removed; in other processes they go stale for up to
+# settings.LISTING_CACHE_TIMEOUT seconds, unless a shared cache backend is used.
+#
+# Hit and miss counts per cache are kept in the cache too, so they're shared by every process
+# using a shared backend (e.g. the file based one).
+
+CACHE_NAMES = ('gallery', 'gallery_count', 'past_searches', 'counts', 'resolved_url')
+
+COUNTS_KEY = 'counts'
+PAST_SEARCHES_KEY = 'past-searches'
+
+_batched_search_ids = ContextVar('batched_search_ids', default=None) # set of search ids, inside invalidation_batch()
+
+# Invalidation hook for when an image is added to or deleted from a search. Bumps the search's
+# version so its cached gallery fragments and counts are no longer used (at the end of the
+# invalidation_batch() it's called in, if any).
+def invalidate_search(search_id):
+    if search_id is None:
+        return
+    batched = _batched_search_ids.get()
+    if batched is not None:
+        batched.add(search_id)
+        return
+    invalidate_searches([search_id])
+
+# Bumps the version of every search in search_ids with one UPDATE
+def invalidate_searches(search_ids):
+    if search_ids:
+        Search.objects.filter(pk__in=search_ids).update(content_version=F('content_version') + 1)
+        invalidate_site_counts()
+
+# Context manager (or decorator) collecting invalidate_search() calls, and invalidating each search
+# they were for once on the way out, even if the block failed part way (what it saved is still
+# there). Nested batches leave it to the outermost one.
+@contextmanager
+def invalidation_batch():
+    if _batched_search_ids.get() is not None:
+        yield
+        return
+    search_ids = set()
+    token = _batched_search_ids.set(search_ids)
+    try:
+        yield
+    finally:
+        _batched_search_ids.reset(token)
+        invalidate_searches(search_ids)
+
+# Invalidation hook for when searches or images are added or removed anywhere
+def invalidate_site_counts():
+    cache.delete_many([COUNTS_KEY, PAST_SEARCHES_KEY])
+
+# Counts a hit or miss for one of the CACHE_NAMES caches
+def count_cache_lookup(name, hit):
+    key = f"cache-stats:{name}:{'hits' if hit else 'misses'}"
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError: # evicted between add() and incr()
+        cache.set(key, 1, timeout=None)
+
+# Returns {cache name: {'hits': n, 'misses': n}} for every cache in CACHE_NAMES
+def cache_stats():
+    keys = [f"cache-stats:{name}:{kind}" for name in CACHE_NAMES for kind in ('hits', 'misses')]
+    values = cache.get_many(keys)
+    return {name: {kind: values.get(f"cache-stats:{name}:{kind}", 0) for kind in ('hits', 'misses')} for name in CACHE_NAMES}
+
+# Looks up key in the cache, counting a hit or miss against cache_name. On a miss, calls compute()
+# and caches what it returns for timeout seconds (unless it's None).
+def get_or_compute(cache_name, key, compute, timeout):
+    value = cache.get(key)
+    count_cache_lookup(cache_name, value is not None)
+    if value is None:
+        value = compute()
+        if value is not None:
+            cache.set(key, value, timeout=timeout)
+    return value
+
+# Cache key for the gallery cards of a search, for a given version and set of gallery filter/sort parameters
+def gallery_key(search_id, version, variant):
+    return f"gallery:{search_id}:{version}:{variant}"
+
+# Cache key for the number of images in a search, for a given version and set of gallery filter parameters
+def gallery_count_key(search_id, version, variant):
+    return f"gallery-count:{search_id}:{version}:{variant}"
+
+# Seconds to keep per-search entries. They can't go stale (the version changes instead), so this
+# only bounds how long unused ones occupy the cache.
+def gallery_timeout():
+    return getattr(settings, 'GALLERY_CACHE_TIMEOUT', 60 * 60)
+
+# Seconds to keep the site-wide list and count entries. They're invalidated when searches or images
+# change, so this is only a safety net for changes made without going through the models.
+def listing_timeout():
+    return getattr(settings, 'LISTING_CACHE_TIMEOUT', 5 * 60)
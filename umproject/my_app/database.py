@@ -0,0 +1,92 @@
+import functools # For the view decorator
+from contextvars import ContextVar # Which alias reads go to follows the request through threads and async tasks
+from django.conf import settings # For DATABASES, DATABASE_READ_ALIAS and SQLITE_PRAGMAS
+
+# Database profile support (see DATABASES in settings.py).
+#
+# * SQLite connections get the pragmas in settings.SQLITE_PRAGMAS (WAL journal, page cache size, mmap...)
+#   as they're opened, through the connection_created signal (connected in apps.py).
+# * ReadReplicaRouter sends reads made while a view decorated with @reads_from_replica runs (the listing
+#   and gallery views) to the settings.DATABASE_READ_ALIAS database, if there is one. Everything else,
+#   including every write, goes to 'default', so the scrape -> success page round trip always sees its
+#   own writes. A replica can lag behind, so those views may briefly show slightly old data.
+
+_read_alias = ContextVar('database_read_alias', default=None)
+
+# connection_created handler applying settings.SQLITE_PRAGMAS to new SQLite connections
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+        if connection.alias == read_alias() and connection.is_in_memory_db():
+            # Only in tests: the read alias mirrors the in-memory test database through SQLite's shared
+            # cache, where reading what a test's open transaction wrote would fail with "table is locked"
+            cursor.execute("PRAGMA read_uncommitted = true")
+
+# The read alias to use, or None if there isn't one configured
+def read_alias():
+    alias = getattr(settings, 'DATABASE_READ_ALIAS', None)
+    return alias if alias in settings.DATABASES else None
+
+# View decorator: the view's reads (including ones made while a streamed response is being sent)
+# go to the read alias
+def reads_from_replica(view):
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        token = _read_alias.set(read_alias())
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            _read_alias.reset(token)
+        if getattr(response, 'streaming', False):
+            if response.is_async: # under ASGI, see views.streaming_content()
+                response.streaming_content = _async_reading_from_replica(response.streaming_content)
+            else:
+                response.streaming_content = _reading_from_replica(response.streaming_content)
+        return response
+    return wrapper
+
+# Iterates a streamed response's content with reads going to the read alias (the queries run as
+# each chunk is generated, so the alias is set around next(), not around the yield)
+def _reading_from_replica(content):
+    content = iter(content)
+    while True:
+        token = _read_alias.set(read_alias())
+        try:
+            chunk = next(content)
+        except StopIteration:
+            return
+        finally:
+            _read_alias.reset(token)
+        yield chunk
+
+# Async version of _reading_from_replica(). The chunks are made with sync_to_async, which runs them
+# with a copy of the context set here.
+async def _async_reading_from_replica(content):
+    content = content.__aiter__()
+    while True:
+        token = _read_alias.set(read_alias())
+        try:
+            chunk = await content.__anext__()
+        except StopAsyncIteration:
+            return
+        finally:
+            _read_alias.reset(token)
+        yield chunk
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return _read_alias.get() # None lets Django use 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True # the replica has the same data as 'default'
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == getattr(settings, 'DATABASE_READ_ALIAS', None):
+            return False # replicas get their schema from 'default'
+        return None
@@ -0,0 +1,205 @@
+import re # For cleaning up file names taken from image URLs
+import csv # For the manifest listing every exported image
+import struct # For packing ZIP headers
+import hashlib # For the ETag identifying an export's contents
+import zlib # For the CRC-32 checksum ZIP stores for each file
+from io import StringIO # Build the manifest in memory (it's small, one line per image)
+from urllib.parse import urlparse # For taking file names from image URLs
+from django.db.models.functions import Coalesce, Length # Fall back to the blob length for rows without byte_size
+from django.utils import timezone # For file dates in the archive
+from .models import Image
+
+# Streams a ZIP archive of a search's images.
+#
+# Images are already compressed, so every file is written with the "stored" (no compression) method.
+# That means the size and position of every byte in the archive can be worked out up front from the
+# image sizes in the database, which gives us an exact Content-Length and lets a download be resumed
+# with a Range request. Blobs are read a chunk of rows at a time, so memory stays constant no matter
+# how many images the search has. The last file in the archive is manifest.csv, listing the url,
+# content type, size and hash of every image: 'hash' is the md5 of the file in the archive, and
+# 'download_hash' the md5 of the image as it was downloaded (Image.content_hash), which differs when it
+# was transcoded at ingest. The file hashes are worked out as the images are streamed, so the manifest
+# comes after them; md5s are a fixed 32 characters, so its size is still known up front.
+
+MANIFEST_NAME = 'manifest.csv'
+UNKNOWN_HASH = '0' * 32 # stands in for a file's md5 until it's been read (the same length, so the manifest's size is known)
+MAX_NAME_LENGTH = 100 # longest file name (before the id prefix) we derive from an image URL
+BLOB_CHUNK_SIZE = 20 # number of image blobs read per query
+
+LOCAL_HEADER_SIZE = 30 # fixed part of a ZIP local file header (the file name follows it)
+CENTRAL_HEADER_SIZE = 46 # fixed part of a ZIP central directory entry (the file name follows it)
+END_OF_CENTRAL_DIRECTORY_SIZE = 22
+ZIP_UTF8_FLAG = 0x0800 # file names are UTF-8
+ZIP_MAX_SIZE = 0xFFFFFFFF # bigger archives would need ZIP64 extensions
+ZIP_MAX_ENTRIES = 0xFFFF
+
+# Raised when a search's images won't fit in a plain (non-ZIP64) ZIP archive
+class ExportTooLarge(Exception):
+    pass
+
+# Raised when a blob's length doesn't match the size recorded for it, since streaming it
+# would produce a corrupt archive (run 'manage.py backfill_image_metadata --all' to fix the sizes)
+class ExportSizeMismatch(Exception):
+    pass
+
+# Makes a safe, unique archive file name for an image from its URL, e.g. 1234-logo.png
+def archive_name_for_image(image_id, url, image_format):
+    if url.startswith('data') or url.startswith('('): # data: URIs and '(screen shot)' have no file name
+        name = 'image'
+    else:
+        name = urlparse(url).path.rsplit('/', 1)[-1]
+        name = re.sub(r'[^A-Za-z0-9._-]+', '_', name).strip('._')[:MAX_NAME_LENGTH] or 'image'
+
+    if image_format and '.' not in name:
+        name = f"{name}.{'jpg' if image_format == 'jpeg' else image_format}"
+    return f"{image_id}-{name}"
+
+# Converts a datetime to the (time, date) pair ZIP headers use, in the local timezone
+def dos_date_time(timestamp):
+    local_dt = timestamp.astimezone(timezone.get_current_timezone())
+    year = min(max(local_dt.year, 1980), 2107)
+    dos_time = (local_dt.hour << 11) | (local_dt.minute << 5) | (local_dt.second // 2)
+    dos_date = ((year - 1980) << 9) | (local_dt.month << 5) | local_dt.day
+    return dos_time, dos_date
+
+# Describes every file going into the export of a search: one entry per image, then the manifest.
+# Each entry is a dict with name (bytes), size, dos_time, dos_date, offset (of its local header) and, for
+# images, image_id and content_hash. The crc (and md5 for images) are filled in as the files are read.
+class SearchExport:
+    def __init__(self, search):
+        self.search = search
+
+        rows = list(Image.objects.filter(search=search).order_by('id')
+            .annotate(export_size=Coalesce('byte_size', Length('image')))
+            .values_list('id', 'url', 'content_hash', 'content_type', 'export_size', 'image_format', 'timestamp'))
+
+        if len(rows) + 1 > ZIP_MAX_ENTRIES:
+            raise ExportTooLarge(f"Search {search.id} has too many images ({len(rows)}) to export as one ZIP archive")
+
+        self.entries = []
+        for image_id, url, content_hash, content_type, size, image_format, timestamp in rows:
+            dos_time, dos_date = dos_date_time(timestamp)
+            self.entries.append({'name': archive_name_for_image(image_id, url, image_format).encode('utf-8'), 'size': size or 0,
+                                 'dos_time': dos_time, 'dos_date': dos_date, 'image_id': image_id, 'url': url,
+                                 'content_type': content_type, 'content_hash': content_hash})
+
+        # Until the images are read the manifest has UNKNOWN_HASH for each file's md5, which makes it the
+        # right size. It still lists every image's url, download hash and size, so it identifies the
+        # archive's contents for the ETag.
+        placeholder_manifest = self.manifest_data()
+        self.etag = '"' + hashlib.md5(placeholder_manifest).hexdigest() + '"'
+        dos_time, dos_date = dos_date_time(search.timestamp)
+        self.entries.append({'name': MANIFEST_NAME.encode('utf-8'), 'size': len(placeholder_manifest), 'dos_time': dos_time, 'dos_date': dos_date})
+
+        # Lay out the archive: each file's local header and data, then the central directory
+        offset = 0
+        for entry in self.entries:
+            entry['offset'] = offset
+            offset += LOCAL_HEADER_SIZE + len(entry['name']) + entry['size']
+        self.manifest_offset = self.entries[-1]['offset']
+        self.central_directory_offset = offset
+        self.central_directory_size = sum(CENTRAL_HEADER_SIZE + len(entry['name']) for entry in self.entries)
+        self.total_size = offset + self.central_directory_size + END_OF_CENTRAL_DIRECTORY_SIZE
+
+        if self.total_size > ZIP_MAX_SIZE:
+            raise ExportTooLarge(f"Search {search.id} is too big ({self.total_size} bytes) to export as one ZIP archive")
+
+    # The manifest, with the md5 of each image file that's been read so far
+    def manifest_data(self):
+        manifest = StringIO()
+        writer = csv.writer(manifest)
+        writer.writerow(['file', 'url', 'hash', 'download_hash', 'content_type', 'size'])
+        for entry in self.entries:
+            if 'image_id' in entry:
+                writer.writerow([entry['name'].decode('utf-8'), entry['url'], entry.get('md5', UNKNOWN_HASH), entry['content_hash'], entry['content_type'], entry['size']])
+        return manifest.getvalue().encode('utf-8')
+
+    def filename(self):
+        return f"search-{self.search.id}.zip"
+
+    # Yields the bytes of the archive from byte position start up to and including end
+    # (the whole archive by default). Image blobs entirely before start are still read if the
+    # manifest or central directory is wanted, since they need their hashes and checksums, but
+    # they aren't sent.
+    def stream(self, start=0, end=None):
+        if end is None:
+            end = self.total_size - 1
+        position = 0
+
+        for length, entry_data in self.iter_entry_data(need_all_hashes=end >= self.manifest_offset, start=start):
+            entry_start = position
+            position += length
+            if entry_start > end:
+                return # past the requested range, so there's no need to read any more blobs
+            if entry_data is None or position <= start:
+                continue # before the requested range
+            yield entry_data[max(start - entry_start, 0):end - entry_start + 1]
+
+        central_directory = self.central_directory()
+        if position + len(central_directory) > start:
+            yield central_directory[max(start - position, 0):end - position + 1]
+
+    # Yields (length, bytes) for each file's local header + data, in archive order, filling in each entry's
+    # crc (and md5 for images). Blobs for files that end before start are only read when need_all_hashes
+    # is set; otherwise (length, None) is yielded for them.
+    def iter_entry_data(self, need_all_hashes, start):
+        image_entries = self.entries[:-1]
+
+        for index in range(0, len(image_entries), BLOB_CHUNK_SIZE):
+            chunk = image_entries[index:index + BLOB_CHUNK_SIZE]
+            chunk_end = chunk[-1]['offset'] + LOCAL_HEADER_SIZE + len(chunk[-1]['name']) + chunk[-1]['size']
+            if chunk_end <= start and not need_all_hashes:
+                for entry in chunk:
+                    yield LOCAL_HEADER_SIZE + len(entry['name']) + entry['size'], None
+                continue
+
+            blobs = dict(Image.objects.filter(pk__in=[entry['image_id'] for entry in chunk]).values_list('id', 'image'))
+            for entry in chunk:
+                data = bytes(blobs.get(entry['image_id']) or b'')
+                if len(data) != entry['size']:
+                    raise ExportSizeMismatch(f"Image {entry['image_id']} is {len(data)} bytes but its recorded size is {entry['size']}")
+                entry['crc'] = zlib.crc32(data)
+                entry['md5'] = hashlib.md5(data).hexdigest()
+                entry_data = self.local_header(entry) + data
+                yield len(entry_data), entry_data
+            blobs = None
+
+        manifest_entry = self.entries[-1]
+        manifest_data = self.manifest_data()
+        manifest_entry['crc'] = zlib.crc32(manifest_data)
+        manifest_data = self.local_header(manifest_entry) + manifest_data
+        yield len(manifest_data), manifest_data
+
+    def local_header(self, entry):
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, ZIP_UTF8_FLAG, 0, entry['dos_time'], entry['dos_date'],
+                           entry['crc'], entry['size'], entry['size'], len(entry['name']), 0) + entry['name']
+
+    def central_directory(self):
+        records = []
+        for entry in self.entries:
+            records.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, ZIP_UTF8_FLAG, 0, entry['dos_time'], entry['dos_date'],
+                                       entry.get('crc', 0), entry['size'], entry['size'], len(entry['name']), 0, 0, 0, 0, 0o100644 << 16,
+                                       entry['offset']) + entry['name'])
+        records.append(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self.entries), len(self.entries),
+                                   self.central_directory_size, self.central_directory_offset, 0))
+        return b''.join(records)
+
+# Parses a single 'bytes=start-end' Range header value against an archive of total_size bytes.
+# Returns (start, end) inclusive, None if there's no usable range (send the whole archive),
+# or raises ValueError if the range can't be satisfied.
+def parse_range_header(range_header, total_size):
+    match = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*', range_header or '')
+    if not match or (match.group(1) == '' and match.group(2) == ''):
+        return None # missing, malformed or multi-range: ignore it, as HTTP allows
+
+    if match.group(1) == '': # 'bytes=-500' is the last 500 bytes
+        suffix_length = int(match.group(2))
+        if suffix_length == 0:
+            raise ValueError("Empty range")
+        return max(total_size - suffix_length, 0), total_size - 1
+
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else total_size - 1
+    if start >= total_size or end < start:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, total_size - 1)
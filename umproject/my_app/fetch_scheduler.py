@@ -0,0 +1,218 @@
+import asyncio # For waiting without blocking the event loop in async_fetch()
+import random # For jittering the retry backoff
+import threading # Host state is shared by request threads and async tasks
+import time # For rate limits, backoff and latency
+import requests # Handles http requests
+from email.utils import parsedate_to_datetime # For Retry-After given as an HTTP date
+from urllib.parse import urlparse # For the host of a URL
+from django.conf import settings # For the scheduling limits set in settings.py
+from .metrics import incr, observe # Retry, throttling and circuit breaker counters
+
+try:
+    import httpx # Only needed for async_fetch() (see scrape_web_page_async)
+except ImportError:
+    httpx = None
+
+# Scheduling layer for every page and image request the scraper makes: fetch() for the requests
+# based pipeline, async_fetch() for the httpx one. Per host (URL netloc), shared by every request
+# thread and async scrape in the process:
+#
+# * at most a few requests are in flight at once. The limit adapts AIMD style: it grows by about
+#   one per round of successful requests, shrinks a little when responses are slower than
+#   settings.FETCH_HOST_LATENCY_TARGET, and halves on an error or throttling response.
+# * requests start no faster than settings.FETCH_HOST_MAX_REQUESTS_PER_SECOND on average, in bursts of
+#   up to FETCH_HOST_BURST (a token bucket).
+# * connection errors, timeouts and 429/502/503/504 responses are retried up to
+#   settings.FETCH_MAX_RETRIES times, after a random delay up to FETCH_BACKOFF_BASE * 2**attempt
+#   ("full jitter"), or after Retry-After if the host sent one (which also holds back every other
+#   request to that host until then, for at most FETCH_RETRY_AFTER_MAX seconds).
+# * after settings.FETCH_CIRCUIT_BREAKER_FAILURES failures in a row the host's circuit opens, and
+#   its requests fail straight away with HostCircuitOpen for FETCH_CIRCUIT_BREAKER_COOLDOWN seconds.
+#   Then one request at a time is let through, until one succeeds.
+
+THROTTLE_STATUSES = (429,) # the host is fine, we're just going too fast
+FAILURE_STATUSES = (502, 503, 504) # the host (or something in front of it) is struggling
+SLOT_POLL_SECONDS = 0.02 # how often async_fetch() checks for a free slot while a host is at its limit
+
+class HostCircuitOpen(Exception):
+    def __init__(self, host, seconds):
+        super().__init__(f"Too many failures from {host}, not trying it again for {seconds:.0f}s")
+        self.host = host
+        self.seconds = seconds
+
+class HostState:
+    def __init__(self):
+        self.limit = float(getattr(settings, 'FETCH_HOST_INITIAL_CONCURRENCY', 4)) # adaptive concurrency limit
+        self.in_flight = 0
+        self.tokens = float(getattr(settings, 'FETCH_HOST_BURST', 10)) # rate limit token bucket
+        self.tokens_updated = time.monotonic()
+        self.blocked_until = 0.0 # time.monotonic() before which no request may start (from Retry-After)
+        self.consecutive_failures = 0
+        self.open_until = 0.0 # circuit breaker: no requests until then, then one at a time until one succeeds
+
+_lock = threading.Lock()
+_slot_freed = threading.Condition(_lock) # notified whenever a request finishes
+_hosts = {} # netloc -> HostState
+
+def host_key(url):
+    return urlparse(url).netloc.lower()
+
+# Tries to start a request to host (call with _lock held). Returns 0 if it may go ahead, otherwise
+# how long to wait before trying again. Raises HostCircuitOpen if the host's circuit is open.
+def _try_start(host):
+    state = _hosts.get(host)
+    if state is None:
+        state = _hosts[host] = HostState()
+    now = time.monotonic()
+
+    if state.open_until > now:
+        incr('fetch_circuit_rejected')
+        raise HostCircuitOpen(host, state.open_until - now)
+
+    limit = 1 if state.open_until else max(int(state.limit), 1) # half open after the cooldown: one trial request at a time
+    if state.in_flight >= limit:
+        return SLOT_POLL_SECONDS
+    if state.blocked_until > now:
+        return state.blocked_until - now
+
+    requests_per_second = getattr(settings, 'FETCH_HOST_MAX_REQUESTS_PER_SECOND', 0)
+    if requests_per_second:
+        state.tokens = min(state.tokens + (now - state.tokens_updated) * requests_per_second, getattr(settings, 'FETCH_HOST_BURST', 10))
+        state.tokens_updated = now
+        if state.tokens < 1:
+            return (1 - state.tokens) / requests_per_second
+        state.tokens -= 1
+    state.in_flight += 1
+    return 0
+
+# Records how a request to host went ('ok', 'throttled', 'failed', or None if it never got a
+# response for reasons that aren't the host's fault), and adapts the host's limits
+def _finish(host, outcome, seconds, retry_after=None):
+    with _lock:
+        state = _hosts[host]
+        state.in_flight -= 1
+        now = time.monotonic()
+
+        if outcome == 'ok':
+            state.consecutive_failures = 0
+            state.open_until = 0.0
+            if seconds <= getattr(settings, 'FETCH_HOST_LATENCY_TARGET', 2):
+                state.limit = min(state.limit + 1 / state.limit, getattr(settings, 'FETCH_HOST_MAX_CONCURRENCY', 8)) # additive increase
+            else:
+                state.limit = max(state.limit * 0.9, getattr(settings, 'FETCH_HOST_MIN_CONCURRENCY', 1)) # getting slow, ease off
+        elif outcome in ('throttled', 'failed'):
+            state.limit = max(state.limit / 2, getattr(settings, 'FETCH_HOST_MIN_CONCURRENCY', 1)) # multiplicative decrease
+            if retry_after:
+                retry_after = min(retry_after, getattr(settings, 'FETCH_RETRY_AFTER_MAX', 60)) # a longer wait isn't retried anyway, so don't hold every other request that long
+                state.blocked_until = max(state.blocked_until, now + retry_after)
+            if outcome == 'failed':
+                state.consecutive_failures += 1
+                if state.consecutive_failures >= getattr(settings, 'FETCH_CIRCUIT_BREAKER_FAILURES', 5):
+                    state.open_until = now + getattr(settings, 'FETCH_CIRCUIT_BREAKER_COOLDOWN', 30)
+                    incr('fetch_circuit_opened')
+        _slot_freed.notify_all()
+
+# Classifies a response for _finish(), returning (outcome, seconds from its Retry-After header or None)
+def _response_outcome(status_code, headers):
+    if status_code in THROTTLE_STATUSES:
+        return 'throttled', retry_after_seconds(headers.get('retry-after'))
+    if status_code in FAILURE_STATUSES:
+        retry_after = retry_after_seconds(headers.get('retry-after'))
+        return ('failed' if retry_after is None else 'throttled'), retry_after # with Retry-After, it's telling us to come back later
+    return 'ok', None
+
+# Parses a Retry-After header (seconds, or an HTTP date) into seconds from now, or None
+def retry_after_seconds(value):
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+# How long to wait before retry number attempt+1, or None to give up (the host asked for a longer
+# wait than settings.FETCH_RETRY_AFTER_MAX)
+def retry_delay(attempt, retry_after=None):
+    if retry_after is not None and retry_after > getattr(settings, 'FETCH_RETRY_AFTER_MAX', 60):
+        return None
+    backoff = random.uniform(0, min(getattr(settings, 'FETCH_BACKOFF_BASE', 0.5) * 2 ** attempt, getattr(settings, 'FETCH_BACKOFF_MAX', 30)))
+    return max(backoff, retry_after or 0)
+
+# Waits (blocking the thread) until a request to host may start
+def _wait_to_start(host):
+    queue_start = time.perf_counter()
+    with _slot_freed:
+        while True:
+            wait = _try_start(host)
+            if not wait:
+                break
+            _slot_freed.wait(wait)
+    observe('fetch_queue_seconds', time.perf_counter() - queue_start)
+
+# Waits (without blocking the event loop) until a request to host may start
+async def _async_wait_to_start(host):
+    queue_start = time.perf_counter()
+    while True:
+        with _lock:
+            wait = _try_start(host)
+        if not wait:
+            break
+        await asyncio.sleep(wait)
+    observe('fetch_queue_seconds', time.perf_counter() - queue_start)
+
+# requests.get(url, **kwargs) through the scheduler. Returns the final response (which may still be
+# an error status, for the caller's raise_for_status()), or raises the last connection error or
+# HostCircuitOpen.
+def fetch(url, **kwargs):
+    kwargs.setdefault('timeout', getattr(settings, 'FETCH_TIMEOUT', 30))
+    host = host_key(url)
+    max_retries = getattr(settings, 'FETCH_MAX_RETRIES', 3)
+
+    for attempt in range(max_retries + 1):
+        _wait_to_start(host)
+        start = time.perf_counter()
+        outcome, retry_after, error, response = None, None, None, None
+        try:
+            response = requests.get(url, **kwargs)
+            outcome, retry_after = _response_outcome(response.status_code, response.headers)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            outcome, error = 'failed', e
+        finally:
+            _finish(host, outcome, time.perf_counter() - start, retry_after)
+
+        delay = retry_delay(attempt, retry_after) if outcome != 'ok' and attempt < max_retries else None
+        if delay is None:
+            if error is not None:
+                raise error
+            return response
+        incr('fetch_retries', reason=response.status_code if response is not None else 'error')
+        time.sleep(delay)
+
+# Async version of fetch(), doing client.get(url, **kwargs) with an httpx.AsyncClient
+async def async_fetch(client, url, **kwargs):
+    host = host_key(url)
+    max_retries = getattr(settings, 'FETCH_MAX_RETRIES', 3)
+
+    for attempt in range(max_retries + 1):
+        await _async_wait_to_start(host)
+        start = time.perf_counter()
+        outcome, retry_after, error, response = None, None, None, None
+        try:
+            response = await client.get(url, **kwargs)
+            outcome, retry_after = _response_outcome(response.status_code, response.headers)
+        except httpx.TransportError as e:
+            outcome, error = 'failed', e
+        finally:
+            _finish(host, outcome, time.perf_counter() - start, retry_after)
+
+        delay = retry_delay(attempt, retry_after) if outcome != 'ok' and attempt < max_retries else None
+        if delay is None:
+            if error is not None:
+                raise error
+            return response
+        incr('fetch_retries', reason=response.status_code if response is not None else 'error')
+        await asyncio.sleep(delay)
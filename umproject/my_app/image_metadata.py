@@ -0,0 +1,115 @@
+import hashlib # used for the content hash stored in the Image table
+from io import BytesIO # Wrap image bytes so PIL can read them from memory
+from PIL import Image as PILImage # For reading dimensions and frame counts
+from urllib.parse import urlparse # For splitting image URLs into host and path
+
+# Magic byte signatures at the start of a file, checked in order. We sniff the
+# format from the bytes themselves because the content-type header sent by the
+# remote server is often wrong (or just "application/octet-stream").
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+    (b'\x00\x00\x01\x00', 'ico'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+)
+
+# Returns a short lowercase format name ('png', 'jpeg', 'webp', 'svg', ...) detected
+# from the first bytes of image_data, or '' if it isn't a format we recognize.
+def sniff_image_format(image_data):
+    if not image_data:
+        return ''
+
+    head = bytes(image_data[:64])
+
+    for signature, image_format in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+
+    # RIFF container: bytes 8-12 say what's inside (WEBP for WebP images)
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+
+    # ISO base media container: the 'ftyp' box brand tells AVIF from HEIC
+    if head[4:8] == b'ftyp':
+        brand = head[8:12]
+        if brand in (b'avif', b'avis'):
+            return 'avif'
+        if brand in (b'heic', b'heix', b'mif1', b'msf1'):
+            return 'heic'
+
+    # SVG is text, so skip any BOM, whitespace or <?xml ...?> prolog and look for an <svg tag
+    text_head = bytes(image_data[:1024]).lstrip(b'\xef\xbb\xbf \t\r\n').lower()
+    if text_head.startswith(b'<svg') or (text_head.startswith(b'<?xml') and b'<svg' in text_head):
+        return 'svg'
+
+    return ''
+
+# Computes the values for the precomputed metadata columns on Image, so galleries
+# can filter and sort without loading or decoding the blob. Returns a dict with
+# width, height, byte_size, image_format, frame_count and content_hash.
+# width/height/frame_count are None when PIL can't decode the data (e.g. SVG).
+def compute_image_metadata(image_data):
+    image_data = bytes(image_data) # BinaryField may hand us a memoryview
+
+    metadata = {
+        'width': None,
+        'height': None,
+        'byte_size': len(image_data),
+        'image_format': sniff_image_format(image_data),
+        'frame_count': None,
+        'content_hash': hashlib.md5(image_data).hexdigest(), # same checksum used in unique_search_image
+    }
+
+    if metadata['image_format'] == 'svg':
+        return metadata # PIL can't rasterize SVG, and we don't need it to
+
+    try:
+        with PILImage.open(BytesIO(image_data)) as pil_image:
+            metadata['width'], metadata['height'] = pil_image.size
+            metadata['frame_count'] = getattr(pil_image, 'n_frames', 1) # only multi-frame formats have n_frames
+            if not metadata['image_format'] and pil_image.format:
+                metadata['image_format'] = pil_image.format.lower()
+    except Exception:
+        pass # Not decodable by PIL, leave dimensions empty
+
+    return metadata
+
+MAX_DISPLAY_FILENAME_LENGTH = 60 # max filename we display
+
+# Works out the display filename (extracted from the URL, minus the http & domain name),
+# the lowercase source host and the URL path for an image URL. These are stored on the
+# Image at ingest so pages don't have to recompute them on every render.
+# Returns a dict with filename, host and path.
+def describe_image_url(url):
+    if url.startswith("data"):
+        # if starts with 'data:' instead of 'http:' or 'https:', just use url as a pseudo-filename
+        return {'filename': url[:40], 'host': '', 'path': ''}
+
+    parsed_url = urlparse(url)
+    host = (parsed_url.hostname or '')[:255]
+    path = parsed_url.path[:255]
+
+    return {'filename': display_filename_from_url(url), 'host': host, 'path': path}
+
+# Makes a max-60-character filename from an image URL, to display as a caption.
+# If it's say 100 characters ending in .jpeg, it will truncate the part before 
+# and add (...) but keep the .jpeg. If it doesn't have a period in it, it just
+# truncates it 5 characters before the size limit and adds (...).
+def display_filename_from_url(url):
+    # sometimes the url contains ? and other extraneous data after the filename, so strip everything after ?
+    filename = url.split('?')[0]
+    # split remaining url by / and pick the last (-1) element, which is just the filename
+    filename = filename.split('/')[-1]
+
+    if filename == '':
+        return '(no filename)' # if there was no text between the last / in the url and the ?
+    elif filename.rfind('.') == -1 and len(filename) > MAX_DISPLAY_FILENAME_LENGTH: # if no period in filename & > max chars, truncate + '(...)'
+        return filename[:MAX_DISPLAY_FILENAME_LENGTH-5] + '(...)'
+    elif filename.rfind('.') > 0 and len(filename) > MAX_DISPLAY_FILENAME_LENGTH: # if period & prefix of filename is > max chars, truncate prefix + '(...)'
+        extension = filename[filename.find('.')+1:]
+        return filename.split('.')[0][:MAX_DISPLAY_FILENAME_LENGTH-9] + '(...).' + extension[:4]
+    return filename
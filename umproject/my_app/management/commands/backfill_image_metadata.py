@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from my_app.caching import invalidate_search
+from my_app.models import Image
+from my_app.image_metadata import compute_image_metadata, describe_image_url
+
+METADATA_FIELDS = ['width', 'height', 'byte_size', 'image_format', 'frame_count', 'content_hash', 'filename', 'host', 'path']
+
+# Fills in the precomputed metadata and URL columns for Image rows stored before they existed.
+# Rows are read in primary key order, a batch at a time, so only one batch of blobs
+# is ever held in memory no matter how big the table is.
+#
+#   python manage.py backfill_image_metadata
+#   python manage.py backfill_image_metadata --batch-size 50 --all
+class Command(BaseCommand):
+    help = "Compute width, height, byte size, format, frame count, content hash, filename, host and path for stored images"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help="Number of images to load per query")
+        parser.add_argument('--all', action='store_true', help="Recompute metadata for every image, not just missing ones")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        images = Image.objects.all()
+        if not options['all']:
+            images = images.filter(Q(content_hash='') | Q(filename='')) # rows stored before the metadata columns were added
+
+        last_id = 0
+        updated = 0
+        while True:
+            batch = list(images.filter(pk__gt=last_id).order_by('pk').only('id', 'search_id', 'url', 'image', 'original', 'original_byte_size', 'content_hash')[:batch_size])
+            if not batch:
+                break
+
+            for image in batch:
+                if image.image is not None:
+                    metadata = compute_image_metadata(image.image)
+                    if image.original is not None:
+                        metadata['content_hash'] = compute_image_metadata(image.original)['content_hash'] # hash of what was downloaded
+                    elif image.original_byte_size is not None:
+                        del metadata['content_hash'] # transcoded without keeping the original, so keep the hash we have
+                    for field, value in metadata.items():
+                        setattr(image, field, value)
+                for field, value in describe_image_url(image.url).items():
+                    setattr(image, field, value)
+                image.image = image.original = None # drop the blob references now that we're done with them
+
+            Image.objects.bulk_update(batch, METADATA_FIELDS)
+            for search_id in {image.search_id for image in batch}:
+                invalidate_search(search_id) # bulk_update doesn't send the signals, and the gallery cards show filenames
+            updated += len(batch)
+            last_id = batch[-1].pk
+            self.stdout.write(f"Updated {updated} images (last id {last_id})")
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled metadata for {updated} images"))
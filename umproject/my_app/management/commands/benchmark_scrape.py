@@ -0,0 +1,239 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from my_app import metrics
+from my_app.metrics import percentile
+from my_app.management.fixture_site import FixtureSite
+from my_app.models import Image, Search
+from my_app.views import pick_an_image_from_srcset, retrieve_and_validate_img_handler
+
+# Offline benchmark of the scrape pipeline against a local fixture web server (see ../fixture_site.py).
+#
+# Runs in a throwaway SQLite database (with settings.SQLITE_PRAGMAS), whatever database is configured,
+# so runs are comparable between machines and never touch a real database: the command runs itself
+# again in a subprocess with the 'sqlite' profile (see DATABASES in settings.py) pointed at a file in
+# a temporary directory, and the options passed along in the BENCHMARK_OPTIONS_ENV environment
+# variable. Measures:
+# * scrape: pages submitted to the scrape_web_page view (or scrape_web_page_async with --async) end to end (redirects, HTML parse, srcset
+#   selection, image fetches and database saves), as pages/s, images/s, bytes fetched vs stored and
+#   p50/p95 page latency, plus p50/p95 of each pipeline stage from the metrics histograms
+# * srcset: pick_an_image_from_srcset() on one image's srcset, per call
+# * image_fetch: retrieve_and_validate_img_handler() on one image URL, per call
+#
+# The per-host rate limit (settings.FETCH_HOST_MAX_REQUESTS_PER_SECOND) is off unless --host-rate is
+# given: every fixture request goes to the one local host, which answers in about a millisecond, so
+# the limit would cap the run and hide the pipeline's own speed.
+#
+# Results are printed and can be saved as JSON with --output, then compared with a later run
+# using --compare, to spot regressions.
+#
+#   python manage.py benchmark_scrape --pages 20 --output before.json
+#   python manage.py benchmark_scrape --pages 20 --compare before.json
+
+STAGES = ('page_fetch', 'html_parse', 'srcset_selection', 'image_fetch', 'transcode', 'db_save')
+
+BENCHMARK_OPTIONS_ENV = 'UMPROJECT_BENCHMARK_OPTIONS' # set in the subprocess that runs the benchmark
+BENCHMARK_DATABASE_NAME = 'benchmark.sqlite3'
+
+class Command(BaseCommand):
+    help = "Benchmark scraping against a local fixture web server and report throughput and latency"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=10, help="Number of pages to scrape")
+        parser.add_argument('--images-per-page', type=int, default=20)
+        parser.add_argument('--srcset-variants', type=int, default=3, help="Sizes listed in each image's srcset")
+        parser.add_argument('--image-width', type=int, default=120, help="Width of the smallest srcset variant")
+        parser.add_argument('--lazy-fraction', type=float, default=0.25, help="Fraction of images using data-src/data-srcset")
+        parser.add_argument('--redirect-hops', type=int, default=1, help="Redirects before reaching each page")
+        parser.add_argument('--slow-fraction', type=float, default=0.1, help="Fraction of images served slowly")
+        parser.add_argument('--slow-ms', type=int, default=200, help="Delay for slow images, in milliseconds")
+        parser.add_argument('--oversized-fraction', type=float, default=0.05, help="Fraction of images too big to store")
+        parser.add_argument('--flaky-fraction', type=float, default=0.0, help="Fraction of images failing with a 503 the first time")
+        parser.add_argument('--data-uris', type=int, default=2, help="Inline data: URI images per page")
+        parser.add_argument('--calls', type=int, default=50, help="Calls for the srcset and image fetch benchmarks")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--webdriver', action='store_true', help="Also run the headless browser pass (needs Chrome)")
+        parser.add_argument('--host-rate', type=float, default=0,
+                            help="Per-host request rate limit (default 0, none: the fixture site is one local host, so any cap would be what's measured)")
+        parser.add_argument('--async', dest='async_scrape', action='store_true', help="Scrape with the async view (scrape_web_page_async)")
+        parser.add_argument('--output', help="Save the results as JSON to this file")
+        parser.add_argument('--compare', help="JSON results of an earlier run to compare against")
+
+    def handle(self, *args, **options):
+        if BENCHMARK_OPTIONS_ENV not in os.environ:
+            return self.run_in_benchmark_database(options)
+        options.update(json.loads(os.environ[BENCHMARK_OPTIONS_ENV]))
+        if settings.DB_PROFILE != 'sqlite' or os.path.basename(settings.SQLITE_PATH) != BENCHMARK_DATABASE_NAME:
+            raise CommandError(f"{BENCHMARK_OPTIONS_ENV} is set, but the database isn't a benchmark one; run benchmark_scrape without it")
+        call_command('migrate', verbosity=0, interactive=False)
+
+        site = FixtureSite(
+            images_per_page=options['images_per_page'], srcset_variants=options['srcset_variants'],
+            image_width=options['image_width'], lazy_fraction=options['lazy_fraction'],
+            redirect_hops=options['redirect_hops'], slow_fraction=options['slow_fraction'],
+            slow_ms=options['slow_ms'], oversized_fraction=options['oversized_fraction'], flaky_fraction=options['flaky_fraction'],
+            data_uris=options['data_uris'], seed=options['seed'])
+        base_url = site.start()
+        self.stdout.write(f"Fixture site at {base_url}")
+
+        setup_test_environment() # for the test Client (ALLOWED_HOSTS and so on)
+        try:
+            with override_settings(SCRAPE_WITH_WEBDRIVER=options['webdriver'], FETCH_HOST_MAX_REQUESTS_PER_SECOND=options['host_rate']):
+                results = {
+                    'scrape': self.benchmark_scrape(site, options['pages'], options['async_scrape']),
+                    'srcset': self.benchmark_srcset(site, options['calls']),
+                    'image_fetch': self.benchmark_image_fetch(site, options['calls']),
+                }
+        finally:
+            teardown_test_environment()
+            site.stop()
+
+        report = {
+            'timestamp': timezone.now().isoformat(),
+            'config': {name: options[name] for name in ('pages', 'images_per_page', 'srcset_variants', 'image_width', 'lazy_fraction',
+                       'redirect_hops', 'slow_fraction', 'slow_ms', 'oversized_fraction', 'flaky_fraction', 'data_uris', 'calls', 'seed', 'webdriver', 'async_scrape', 'host_rate')},
+            'results': results,
+        }
+        self.print_results(results)
+
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                self.print_comparison(json.load(baseline_file)['results'], results)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(report, output_file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Saved results to {options['output']}"))
+
+    # Runs this command again in a subprocess, with the 'sqlite' profile pointed at a new database file
+    # in a temporary directory (deleted afterwards), and copies its output
+    def run_in_benchmark_database(self, options):
+        directory = tempfile.mkdtemp(prefix='benchmark_scrape-')
+        environment = {
+            **os.environ,
+            'UMPROJECT_DB_PROFILE': 'sqlite',
+            'UMPROJECT_SQLITE_PATH': os.path.join(directory, BENCHMARK_DATABASE_NAME),
+            BENCHMARK_OPTIONS_ENV: json.dumps({name: value for name, value in options.items() if name not in ('stdout', 'stderr')}),
+        }
+        try:
+            benchmark = subprocess.run([sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'benchmark_scrape'],
+                                       env=environment, capture_output=True, text=True)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        self.stdout.write(benchmark.stdout, ending='')
+        self.stderr.write(benchmark.stderr, ending='')
+        if benchmark.returncode:
+            raise CommandError(f"The benchmark failed (exit status {benchmark.returncode})")
+
+    def benchmark_scrape(self, site, pages, async_scrape=False):
+        client = Client()
+        scrape_path = '/scrape_web_page_async/' if async_scrape else '/scrape_web_page/'
+        stage_snapshots = {stage: metrics.histogram_snapshot('scrape_stage_seconds', stage=stage) for stage in STAGES}
+        fetched_before = metrics.counter_value('page_fetch_bytes') + metrics.counter_value('image_fetch_bytes')
+        failed_pages = 0
+        latencies = []
+
+        start = time.perf_counter()
+        for page_number in range(pages):
+            page_start = time.perf_counter()
+            response = client.post(scrape_path, {'url': site.page_url(page_number), 'force_fresh': 'on'}) # always the whole pipeline, never a reused result
+            latencies.append(time.perf_counter() - page_start)
+            if response.status_code != 302: # success redirects to the gallery, anything else rendered fail.html
+                failed_pages += 1
+        elapsed = time.perf_counter() - start
+
+        images_stored = Image.objects.count()
+        bytes_stored = Image.objects.aggregate(total=Sum('byte_size'))['total'] or 0
+        bytes_fetched = metrics.counter_value('page_fetch_bytes') + metrics.counter_value('image_fetch_bytes') - fetched_before
+
+        stages = {}
+        for stage, before in stage_snapshots.items():
+            after = metrics.histogram_snapshot('scrape_stage_seconds', stage=stage)
+            if after['count'] > before['count']:
+                stages[stage] = {
+                    'count': after['count'] - before['count'],
+                    'mean_seconds': (after['sum'] - before['sum']) / (after['count'] - before['count']),
+                    'p50_seconds': metrics.histogram_quantile(0.5, after, before),
+                    'p95_seconds': metrics.histogram_quantile(0.95, after, before),
+                }
+
+        return {
+            'pages': pages,
+            'failed_pages': failed_pages,
+            'searches': Search.objects.count(),
+            'elapsed_seconds': elapsed,
+            'pages_per_second': pages / elapsed if elapsed else None,
+            'images_stored': images_stored,
+            'images_per_second': images_stored / elapsed if elapsed else None,
+            'bytes_fetched': bytes_fetched,
+            'bytes_stored': bytes_stored,
+            'p50_page_seconds': percentile(latencies, 50),
+            'p95_page_seconds': percentile(latencies, 95),
+            'stages': stages,
+        }
+
+    def benchmark_srcset(self, site, calls):
+        latencies = []
+        picked = 0
+        for call in range(calls):
+            srcset = site.image_srcset('normal', 1000 + call, 0)
+            call_start = time.perf_counter()
+            if pick_an_image_from_srcset(srcset, site.base_url + '/page/0.html')[0]:
+                picked += 1
+            latencies.append(time.perf_counter() - call_start)
+        return self.per_call_results(calls, latencies, picked=picked)
+
+    def benchmark_image_fetch(self, site, calls):
+        latencies = []
+        fetched_bytes = 0
+        for call in range(calls):
+            url = site.base_url + site.image_url('normal', 2000 + call, 0, site.image_width * site.srcset_variants)
+            call_start = time.perf_counter()
+            image_data, content_type = retrieve_and_validate_img_handler(url)
+            latencies.append(time.perf_counter() - call_start)
+            fetched_bytes += len(image_data or b'')
+        return self.per_call_results(calls, latencies, bytes_fetched=fetched_bytes)
+
+    def per_call_results(self, calls, latencies, **extra):
+        elapsed = sum(latencies)
+        return {
+            'calls': calls,
+            'calls_per_second': calls / elapsed if elapsed else None,
+            'p50_seconds': percentile(latencies, 50),
+            'p95_seconds': percentile(latencies, 95),
+            **extra,
+        }
+
+    def print_results(self, results):
+        for section, values in results.items():
+            self.stdout.write(self.style.MIGRATE_HEADING(section))
+            for name, value in values.items():
+                if name == 'stages':
+                    for stage, stage_values in value.items():
+                        self.stdout.write(f"  stage {stage}: " + ', '.join(f"{key}={self.format_value(stage_value)}" for key, stage_value in stage_values.items()))
+                else:
+                    self.stdout.write(f"  {name}: {self.format_value(value)}")
+
+    def print_comparison(self, baseline, results):
+        self.stdout.write(self.style.MIGRATE_HEADING("compared with baseline"))
+        for section, values in results.items():
+            for name, value in values.items():
+                before = baseline.get(section, {}).get(name)
+                if isinstance(value, (int, float)) and isinstance(before, (int, float)) and before:
+                    change = (value - before) / before * 100
+                    self.stdout.write(f"  {section}.{name}: {self.format_value(before)} -> {self.format_value(value)} ({change:+.1f}%)")
+
+    def format_value(self, value):
+        if isinstance(value, float):
+            return f"{value:.4f}"
+        return str(value)
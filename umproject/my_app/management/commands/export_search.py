@@ -0,0 +1,44 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from my_app.models import Search
+from my_app.export import SearchExport, ExportTooLarge
+
+# Writes a ZIP archive of a search's images (plus manifest.csv) to a file, streaming it so memory
+# stays constant. With --resume, an existing partial file is continued from where it stopped.
+#
+#   python manage.py export_search 12 search-12.zip
+#   python manage.py export_search 12 search-12.zip --resume
+class Command(BaseCommand):
+    help = "Export a search's images as a ZIP archive with a manifest"
+
+    def add_arguments(self, parser):
+        parser.add_argument('search_id', type=int)
+        parser.add_argument('output', help="Path of the ZIP file to write")
+        parser.add_argument('--resume', action='store_true', help="Continue a partially written export instead of starting over")
+
+    def handle(self, *args, **options):
+        try:
+            search = Search.objects.select_related('reused_from').get(id=options['search_id'])
+        except Search.DoesNotExist:
+            raise CommandError(f"Search ID {options['search_id']} not found")
+
+        try:
+            export = SearchExport(search.reused_from or search) # a search that reused a recent scrape exports that scrape's images
+        except ExportTooLarge as e:
+            raise CommandError(str(e))
+
+        output = options['output']
+        start = 0
+        if options['resume'] and os.path.exists(output):
+            start = os.path.getsize(output)
+            if start > export.total_size:
+                raise CommandError(f"{output} is bigger than the export ({export.total_size} bytes); the search changed, so start over without --resume")
+            if start == export.total_size:
+                self.stdout.write(self.style.SUCCESS(f"{output} is already complete"))
+                return
+
+        with open(output, 'ab' if start else 'wb') as zip_file:
+            for data in export.stream(start):
+                zip_file.write(data)
+
+        self.stdout.write(self.style.SUCCESS(f"Wrote {export.total_size - start} bytes ({len(export.entries) - 1} images) to {output}"))
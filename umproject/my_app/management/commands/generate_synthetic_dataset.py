@@ -0,0 +1,108 @@
+import hashlib
+import math
+import random
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from my_app.caching import invalidate_search, invalidate_site_counts
+from my_app.models import Image, Search
+
+# Bulk-generates a synthetic dataset of searches and images, to see how the listing and gallery
+# views behave at 10k/100k/1M images (see 'manage.py loadtest_views').
+#
+# Image sizes follow a log-normal distribution like real web images (most are tens of KB, a few
+# are close to the 2MB limit), and searches get a heavy-tailed number of images each. Blobs are
+# random bytes behind a real format signature, and every metadata column is filled in, so the
+# views see rows just like scraped ones. Everything generated is under synthetic.invalid URLs,
+# so --clear can remove it again without touching real data.
+#
+#   python manage.py generate_synthetic_dataset --searches 500 --images 100000
+#   python manage.py generate_synthetic_dataset --clear
+
+SYNTHETIC_SEARCH_PREFIX = 'https://synthetic.invalid/'
+MAX_IMAGE_BYTES = 2000000 # the same limit the scraper stores up to
+
+# (image_format, content_type, signature bytes at the start of the blob, weight)
+FORMATS = (
+    ('jpeg', 'image/jpeg', b'\xff\xd8\xff\xe0', 0.55),
+    ('png', 'image/png', b'\x89PNG\r\n\x1a\n', 0.3),
+    ('gif', 'image/gif', b'GIF89a', 0.05),
+    ('webp', 'image/webp', b'RIFF\x00\x00\x00\x00WEBPVP8 ', 0.1),
+)
+
+class Command(BaseCommand):
+    help = "Generate (or --clear) a synthetic dataset of searches and images for load testing"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--searches', type=int, default=100)
+        parser.add_argument('--images', type=int, default=10000, help="Total number of images across all searches")
+        parser.add_argument('--median-bytes', type=int, default=40000, help="Median image size")
+        parser.add_argument('--batch-size', type=int, default=500, help="Images per bulk insert")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--clear', action='store_true', help="Delete previously generated synthetic data instead")
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            return self.clear(options['batch_size'])
+
+        generator = random.Random(options['seed'])
+        random_bytes = generator.randbytes(MAX_IMAGE_BYTES) # image bodies are slices of this
+
+        # Heavy-tailed split of the images between searches (a few big sites, lots of small ones)
+        weights = [generator.paretovariate(1.2) for _ in range(options['searches'])]
+        total_weight = sum(weights)
+        counts = [int(options['images'] * weight / total_weight) for weight in weights]
+        counts[0] += options['images'] - sum(counts)
+
+        format_weights = [weight for _, _, _, weight in FORMATS]
+        created = 0
+        for search_number, image_count in enumerate(counts):
+            search = Search.objects.create(url=f"{SYNTHETIC_SEARCH_PREFIX}site-{search_number}/")
+            batch = []
+            for image_number in range(image_count):
+                image_format, content_type, signature, _ = generator.choices(FORMATS, weights=format_weights)[0]
+                size = min(max(int(generator.lognormvariate(math.log(options['median_bytes']), 1.2)), 200), MAX_IMAGE_BYTES)
+                unique_bytes = f"{search.id}:{image_number}:".encode('ascii') # so no two blobs are identical
+                offset = generator.randrange(0, MAX_IMAGE_BYTES - size + 1)
+                image_data = (signature + unique_bytes + random_bytes[offset:offset + size])[:max(size, len(signature) + len(unique_bytes))]
+                content_hash = hashlib.md5(image_data).hexdigest()
+                width = int(math.sqrt(size * generator.uniform(2, 12))) # plausible dimensions for the size
+                host = f"img{search_number % 50}.synthetic.invalid"
+                filename = f"image-{image_number}.{'jpg' if image_format == 'jpeg' else image_format}"
+
+                batch.append(Image(
+                    search=search, url=f"https://{host}/media/{search_number}/{filename}", image=image_data,
+                    content_type=content_type, unique_search_image=f"{search.id}+{content_hash}",
+                    width=width, height=max(width * generator.choice((9, 10, 12, 16)) // 16, 1), byte_size=len(image_data),
+                    image_format=image_format, frame_count=1, content_hash=content_hash,
+                    filename=filename, host=host, path=f"/media/{search_number}/{filename}"))
+
+                if len(batch) == options['batch_size']:
+                    created += self.insert(batch)
+                    batch = []
+            if batch:
+                created += self.insert(batch)
+            invalidate_search(search.id) # bulk_create doesn't send the signals that keep the page cache fresh
+            self.stdout.write(f"Search {search.id}: {image_count} images ({created} total)")
+
+        invalidate_site_counts()
+        self.stdout.write(self.style.SUCCESS(f"Generated {len(counts)} searches and {created} images"))
+
+    def insert(self, batch):
+        with transaction.atomic():
+            Image.objects.bulk_create(batch)
+        return len(batch)
+
+    # Deletes the synthetic images a batch at a time (so no single huge delete locks the table), then their searches
+    def clear(self, batch_size):
+        searches = Search.objects.filter(url__startswith=SYNTHETIC_SEARCH_PREFIX)
+        deleted = 0
+        for search_id in searches.values_list('id', flat=True):
+            while True:
+                image_ids = list(Image.objects.filter(search_id=search_id).values_list('id', flat=True)[:batch_size])
+                if not image_ids:
+                    break
+                Image.objects.filter(pk__in=image_ids).only('id', 'search_id').delete() # only() so the blobs aren't loaded to send delete signals
+                deleted += len(image_ids)
+        searches.delete()
+        invalidate_site_counts()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} synthetic images"))
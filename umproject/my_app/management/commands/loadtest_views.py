@@ -0,0 +1,146 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from my_app.metrics import percentile
+from my_app.models import Search
+
+try:
+    import resource # peak RSS, on Unix only
+except ImportError:
+    resource = None
+
+# Load test of the listing and gallery views against whatever data is in the database (generate some
+# with 'manage.py generate_synthetic_dataset'). Each view is requested --requests times from
+# --concurrency threads through Django's test client, and the report shows latency percentiles,
+# SQL query counts and time per request (on every database alias, so reads routed to a replica are
+# counted too, and split by alias), and the process's peak RSS after each view, so N+1 query
+# patterns and full-table loads stand out.
+#
+#   python manage.py loadtest_views --requests 50 --concurrency 4
+#   python manage.py loadtest_views --views past_search --search-id 12 --cold-cache --output results.json
+
+# View name -> URL to request ({search_id} is filled in with --search-id or the biggest search)
+VIEW_URLS = {
+    'home_page': '/',
+    'past_searches': '/past_searches/',
+    'past_search': '/past_search.html?id={search_id}',
+    'show_all_images': '/show_all_images/',
+}
+
+# Peak resident set size of this process so far, in MB (ru_maxrss is KB on Linux, bytes on macOS)
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if peak > 1 << 32 else peak / 1024
+
+class Command(BaseCommand):
+    help = "Load test the listing and gallery views, reporting latency, SQL queries and peak memory"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--views', nargs='+', choices=list(VIEW_URLS), default=list(VIEW_URLS))
+        parser.add_argument('--requests', type=int, default=20, help="Requests per view")
+        parser.add_argument('--concurrency', type=int, default=1, help="Threads making requests at once")
+        parser.add_argument('--search-id', type=int, help="Search to use for past_search (default: the one with the most images)")
+        parser.add_argument('--cold-cache', action='store_true', help="Turn the page cache off, to measure the database work every time")
+        parser.add_argument('--stream', action='store_true', help="Request galleries in streaming mode (read to the end)")
+        parser.add_argument('--output', help="Save the results as JSON to this file")
+
+    def handle(self, *args, **options):
+        search_id = options['search_id']
+        if search_id is None and 'past_search' in options['views']:
+            biggest = Search.objects.annotate(images=Count('image')).order_by('-images').first()
+            if biggest is None:
+                raise CommandError("No searches in the database; run 'manage.py generate_synthetic_dataset' first")
+            search_id = biggest.id
+
+        cache_settings = {'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}} if options['cold_cache'] else {}
+
+        setup_test_environment() # lets the test client's 'testserver' host through ALLOWED_HOSTS
+        results = {}
+        try:
+            with override_settings(**cache_settings):
+                for view in options['views']:
+                    url = VIEW_URLS[view].format(search_id=search_id)
+                    if options['stream'] and view == 'past_search':
+                        url += '&stream=1'
+                    elif view == 'past_search':
+                        url += '&stream=0'
+                    results[view] = self.load_test(url, options['requests'], options['concurrency'])
+                    self.print_view_results(view, url, results[view])
+        finally:
+            teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump({'search_id': search_id, 'options': {name: options[name] for name in ('requests', 'concurrency', 'cold_cache', 'stream')},
+                           'results': results}, output_file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Saved results to {options['output']}"))
+
+    # Requests url the given number of times from concurrency threads, and summarizes the timings
+    def load_test(self, url, requests, concurrency):
+        samples = []
+        samples_lock = threading.Lock()
+        errors = []
+
+        def request_once(_):
+            client = Client()
+            try:
+                with ExitStack() as stack:
+                    queries = {alias: stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in connections} # this thread's connections
+                    start = time.perf_counter()
+                    response = client.get(url)
+                    body_bytes = sum(len(chunk) for chunk in response.streaming_content) if response.streaming else len(response.content)
+                    elapsed = time.perf_counter() - start
+                captured = {alias: context.captured_queries for alias, context in queries.items()}
+                sql_seconds = sum(float(query['time']) for alias_queries in captured.values() for query in alias_queries)
+                with samples_lock:
+                    samples.append({'seconds': elapsed, 'queries': sum(len(alias_queries) for alias_queries in captured.values()),
+                                    'queries_by_alias': {alias: len(alias_queries) for alias, alias_queries in captured.items()},
+                                    'sql_seconds': sql_seconds, 'bytes': body_bytes, 'status': response.status_code})
+            except Exception as e:
+                with samples_lock:
+                    errors.append(str(e))
+            finally:
+                connections.close_all() # each thread has its own connections
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(request_once, range(requests)))
+        wall_seconds = time.perf_counter() - start
+
+        latencies = [sample['seconds'] for sample in samples]
+        query_counts = [sample['queries'] for sample in samples]
+        return {
+            'requests': requests,
+            'errors': len(errors),
+            'non_200': sum(1 for sample in samples if sample['status'] != 200),
+            'requests_per_second': len(samples) / wall_seconds if wall_seconds else None,
+            'p50_seconds': percentile(latencies, 50),
+            'p95_seconds': percentile(latencies, 95),
+            'p99_seconds': percentile(latencies, 99),
+            'max_seconds': max(latencies) if latencies else None,
+            'mean_queries': sum(query_counts) / len(query_counts) if query_counts else None,
+            'max_queries': max(query_counts) if query_counts else None,
+            'mean_queries_by_alias': {alias: sum(sample['queries_by_alias'][alias] for sample in samples) / len(samples) for alias in connections} if samples else None,
+            'mean_sql_seconds': sum(sample['sql_seconds'] for sample in samples) / len(samples) if samples else None,
+            'mean_response_bytes': sum(sample['bytes'] for sample in samples) / len(samples) if samples else None,
+            'peak_rss_mb': peak_rss_mb(),
+            'first_error': errors[0] if errors else None,
+        }
+
+    def print_view_results(self, view, url, results):
+        self.stdout.write(self.style.MIGRATE_HEADING(f"{view} ({url})"))
+        for name, value in results.items():
+            if value is None:
+                continue
+            if isinstance(value, dict):
+                value = ', '.join(f"{key} {item:.4f}" for key, item in value.items())
+            self.stdout.write(f"  {name}: {value:.4f}" if isinstance(value, float) else f"  {name}: {value}")
@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+from my_app.models import Image
+from my_app.retention import (delete_images_in_chunks, delete_searches_in_chunks, images_over_host_caps, reclaim_storage,
+                              searches_over_quota, searches_past_max_age, stored_bytes)
+
+# Applies the retention policies in settings.py (see my_app/retention.py): deletes searches past
+# RETENTION_MAX_SEARCH_AGE_DAYS, then the least recently viewed searches while the total is over
+# RETENTION_MAX_TOTAL_BYTES, then the least recently viewed images of any host over
+# RETENTION_MAX_BYTES_PER_HOST. Rows go a chunk at a time with a pause in between, so it can run
+# in the background while the site is in use. The bytes freed are reported, and with --reclaim the
+# freed space is handed back to the filesystem (see retention.reclaim_storage(); unless SQLite can do it
+# incrementally, that rebuilds the image table, so run it at a quiet time). Each policy can be
+# overridden from the command line.
+#
+#   python manage.py purge_images --dry-run
+#   python manage.py purge_images --max-total-bytes 5000000000 --pause 1
+#   python manage.py purge_images --reclaim
+
+class Command(BaseCommand):
+    help = "Delete images per the retention policies (max age, total quota, per-host caps) in small chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age-days', type=float, help="Override settings.RETENTION_MAX_SEARCH_AGE_DAYS")
+        parser.add_argument('--max-total-bytes', type=int, help="Override settings.RETENTION_MAX_TOTAL_BYTES")
+        parser.add_argument('--max-bytes-per-host', type=int, help="Override settings.RETENTION_MAX_BYTES_PER_HOST")
+        parser.add_argument('--chunk-size', type=int, default=getattr(settings, 'RETENTION_PURGE_CHUNK_SIZE', 200), help="Images deleted per query")
+        parser.add_argument('--pause', type=float, default=getattr(settings, 'RETENTION_PURGE_PAUSE', 0.5), help="Seconds to pause between chunks")
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be deleted")
+        parser.add_argument('--reclaim', action='store_true', help="Hand the freed space back afterwards (incremental vacuum on SQLite if enabled, otherwise VACUUM/OPTIMIZE)")
+
+    def handle(self, *args, **options):
+        max_age_days = self.option_or_setting(options, 'max_age_days', 'RETENTION_MAX_SEARCH_AGE_DAYS')
+        max_total_bytes = self.option_or_setting(options, 'max_total_bytes', 'RETENTION_MAX_TOTAL_BYTES')
+        max_bytes_per_host = self.option_or_setting(options, 'max_bytes_per_host', 'RETENTION_MAX_BYTES_PER_HOST')
+
+        expired = searches_past_max_age(max_age_days)
+        over_quota = searches_over_quota(max_total_bytes, already_deleting=expired)
+        over_host_caps = images_over_host_caps(max_bytes_per_host, already_deleting=expired + over_quota)
+
+        self.stdout.write(f"Searches past the maximum age: {len(expired)}")
+        self.stdout.write(f"Searches evicted to get under the total quota: {len(over_quota)}")
+        self.stdout.write(f"Images evicted to get hosts under their caps: {len(over_host_caps)}")
+
+        if options['dry_run']:
+            would_free = stored_bytes(Image.objects.filter(search_id__in=expired + over_quota)) + stored_bytes(Image.objects.filter(pk__in=over_host_caps))
+            self.stdout.write(self.style.SUCCESS(f"Dry run: would free {filesizeformat(would_free)}"))
+            return
+
+        chunk_size, pause = options['chunk_size'], options['pause']
+        deleted, freed = delete_searches_in_chunks(expired + over_quota, chunk_size, pause, self.progress)
+        host_deleted, host_freed = delete_images_in_chunks(Image.objects.filter(pk__in=over_host_caps), chunk_size, pause, self.progress)
+        deleted += host_deleted
+        freed += host_freed
+
+        if deleted and options['reclaim']:
+            statement = reclaim_storage(chunk_pages=getattr(settings, 'RETENTION_RECLAIM_CHUNK_PAGES', 2560), pause=pause)
+            if statement:
+                self.stdout.write(f"Reclaimed storage with {statement}")
+
+        self.stdout.write(self.style.SUCCESS(f"Deleted {len(expired) + len(over_quota)} searches and {deleted} images, freeing {filesizeformat(freed)} ({freed} bytes)"))
+
+    def option_or_setting(self, options, option, setting):
+        return options[option] if options[option] is not None else getattr(settings, setting, None)
+
+    def progress(self, deleted, freed):
+        self.stdout.write(f"  {deleted} images deleted, {filesizeformat(freed)} freed so far")
@@ -0,0 +1,41 @@
+import sqlite3
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+# Copies the SQLite write database to the read database, for trying the 'sqlite-read-replica' profile
+# (see DATABASES in settings.py) locally. It's a consistent snapshot taken with SQLite's online backup,
+# so it can run while the site is in use. With --interval it keeps copying, which behaves like a
+# replica lagging up to that many seconds behind.
+#
+#   UMPROJECT_DB_PROFILE=sqlite-read-replica python manage.py sync_read_database --interval 5
+
+class Command(BaseCommand):
+    help = "Copy the SQLite write database to the read database (for the sqlite-read-replica profile)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, help="Keep copying, every this many seconds")
+
+    def handle(self, *args, **options):
+        read_alias = settings.DATABASE_READ_ALIAS
+        if read_alias not in settings.DATABASES:
+            raise CommandError(f"No '{read_alias}' database configured (set UMPROJECT_DB_PROFILE=sqlite-read-replica)")
+        if connections['default'].vendor != 'sqlite' or connections[read_alias].vendor != 'sqlite':
+            raise CommandError("Only SQLite databases can be copied; real replicas are kept in sync by the database server")
+
+        while True:
+            start = time.perf_counter()
+            self.copy(connections['default'], settings.DATABASES[read_alias]['NAME'])
+            self.stdout.write(f"Copied to {settings.DATABASES[read_alias]['NAME']} in {time.perf_counter() - start:.2f}s")
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def copy(self, source_connection, target_path):
+        source_connection.ensure_connection()
+        target = sqlite3.connect(target_path)
+        try:
+            source_connection.connection.backup(target)
+        finally:
+            target.close()
@@ -0,0 +1,207 @@
+import base64 # For inline data: URI images
+import hashlib # For image ETags
+import random # Deterministic choices of which images are lazy, slow or oversized
+import re # For routing request paths
+import threading # The server runs in a background thread
+import struct # For packing the PNG text chunk that makes each image unique
+import time # For slow responses
+import zlib # For the PNG chunk checksum
+from io import BytesIO # Build fixture images in memory
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler # Local web server, no network needed
+from PIL import Image as PILImage # For generating fixture images
+
+# A local web server generating synthetic pages full of images, so the scrape pipeline can be
+# benchmarked without hitting real sites (see 'manage.py benchmark_scrape').
+#
+# Pages live at /page/<n>.html, and are reached through <redirect_hops> redirects (with status
+# redirect_status) starting at /redirect/<hops>/page/<n>.html (with relative Location headers if
+# relative_redirects is set, and any query string passed along). /loop/<length>/<n> redirects round a loop of length URLs forever. Each page has images_per_page <img> tags, each with a srcset of
+# srcset_variants sizes. Some are lazy-loaded (data-src / data-srcset), some are served slowly
+# (/slow/...), some are too big to store (/big/...), some fail with a 503 the first time they're
+# requested (/flaky/...), and each page also has data_uris inline data: URI images. Images have an
+# ETag, and answer a matching If-None-Match with 304 Not Modified. /status/<code> always answers with
+# that status (and /status/<code>/retry-after/<seconds> with a Retry-After header too), for testing
+# how failing hosts are handled. Everything is generated from the seed, so runs are repeatable.
+
+OVERSIZED_BYTES = 2100000 # just over the 2000000 byte limit in retrieve_and_validate_img_handler()
+
+class FixtureSite:
+    def __init__(self, images_per_page=20, srcset_variants=3, image_width=120, lazy_fraction=0.25, redirect_hops=1,
+                 slow_fraction=0.1, slow_ms=200, oversized_fraction=0.05, flaky_fraction=0.0, data_uris=2, seed=0,
+                 relative_redirects=False, redirect_status=302):
+        self.images_per_page = images_per_page
+        self.srcset_variants = max(srcset_variants, 1)
+        self.image_width = image_width
+        self.lazy_fraction = lazy_fraction
+        self.redirect_hops = redirect_hops
+        self.slow_fraction = slow_fraction
+        self.slow_ms = slow_ms
+        self.oversized_fraction = oversized_fraction
+        self.flaky_fraction = flaky_fraction
+        self.data_uris = data_uris
+        self.seed = seed
+        self.relative_redirects = relative_redirects
+        self.redirect_status = redirect_status
+
+        self._images = {} # width -> PNG bytes
+        self._images_lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._flaky_served = set() # flaky image paths that already failed once
+        self.requests_served = 0
+        self.bytes_served = 0
+
+    # Starts serving on a free local port, in a background thread. Returns the base URL.
+    def start(self):
+        site = self
+
+        class Handler(FixtureRequestHandler):
+            fixture_site = site
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    # URL to submit for page n (through the configured number of redirects)
+    def page_url(self, page_number):
+        if self.redirect_hops > 0:
+            return f"{self.base_url}/redirect/{self.redirect_hops}/page/{page_number}.html"
+        return f"{self.base_url}/page/{page_number}.html"
+
+    # URL of one size variant of an image, with /slow, /big or /flaky in front for those kinds of image
+    def image_url(self, kind, page_number, image_number, width):
+        prefix = {'slow': '/slow', 'big': '/big', 'flaky': '/flaky'}.get(kind, '')
+        return f"{prefix}/img/{page_number}-{image_number}-{width}.png"
+
+    # A srcset with every size variant of an image, e.g. "/img/1-2-120.png 1x, /img/1-2-240.png 2x"
+    def image_srcset(self, kind, page_number, image_number):
+        return ', '.join(f"{self.image_url(kind, page_number, image_number, self.image_width * variant)} {variant}x"
+                         for variant in range(1, self.srcset_variants + 1))
+
+    def page_html(self, page_number):
+        chooser = random.Random(f"{self.seed}-{page_number}")
+        tags = []
+        for image_number in range(self.images_per_page):
+            roll = chooser.random()
+            if roll < self.oversized_fraction:
+                kind = 'big'
+            elif roll < self.oversized_fraction + self.slow_fraction:
+                kind = 'slow'
+            elif roll < self.oversized_fraction + self.slow_fraction + self.flaky_fraction:
+                kind = 'flaky'
+            else:
+                kind = 'normal'
+            src = self.image_url(kind, page_number, image_number, self.image_width)
+            srcset = self.image_srcset(kind, page_number, image_number)
+            if chooser.random() < self.lazy_fraction:
+                tags.append(f'<img loading="lazy" data-src="{src}" data-srcset="{srcset}" alt="image {image_number}">')
+            else:
+                tags.append(f'<img src="{src}" srcset="{srcset}" alt="image {image_number}">')
+
+        for data_uri_number in range(self.data_uris):
+            image_data = self.image_bytes(16 + data_uri_number, f"{page_number}-inline-{data_uri_number}")
+            tags.append(f'<img src="data:image/png;base64,{base64.b64encode(image_data).decode("ascii")}" alt="inline {data_uri_number}">')
+
+        return (f"<!DOCTYPE html><html><head><title>Fixture page {page_number}</title></head><body>"
+                f"<h1>Fixture page {page_number}</h1>{''.join(tags)}</body></html>").encode('utf-8')
+
+    # PNG bytes for an image of the given width (3:4 aspect). The pixels are generated once per width
+    # (noise keeps the PNGs from compressing down to nothing, so sizes are realistic), and a text chunk
+    # with tag is added so every image has different bytes, like it would on a real site.
+    def image_bytes(self, width, tag):
+        with self._images_lock:
+            image_data = self._images.get(width)
+            if image_data is None:
+                height = max(width * 3 // 4, 1)
+                buffer = BytesIO()
+                PILImage.effect_noise((width, height), 48).convert('RGB').save(buffer, format='PNG')
+                image_data = self._images[width] = buffer.getvalue()
+
+        chunk_data = b'Comment\x00' + tag.encode('ascii')
+        chunk = struct.pack('>I', len(chunk_data)) + b'tEXt' + chunk_data + struct.pack('>I', zlib.crc32(b'tEXt' + chunk_data))
+        return image_data[:-12] + chunk + image_data[-12:] # the last 12 bytes are the IEND chunk
+
+    def oversized_bytes(self):
+        return b'\x89PNG\r\n\x1a\n' + random.Random(self.seed).randbytes(OVERSIZED_BYTES)
+
+class FixtureRequestHandler(BaseHTTPRequestHandler):
+    fixture_site = None # set on a subclass by FixtureSite.start()
+
+    def do_GET(self):
+        site = self.fixture_site
+        path, _, query = self.path.partition('?')
+        query = f"?{query}" if query else ''
+
+        match = re.fullmatch(r'/redirect/(\d+)/page/(\d+)\.html', path)
+        if match:
+            hops = int(match.group(1))
+            if hops > 1:
+                location = f"/redirect/{hops - 1}/page/{match.group(2)}.html"
+            else:
+                location = f"/page/{match.group(2)}.html"
+            # relative to this URL's directory (/redirect/<hops>/page/), or absolute
+            location = f"../../..{location}" if site.relative_redirects else site.base_url + location
+            return self.send(site.redirect_status, b'', 'text/html', {'Location': location + query})
+
+        match = re.fullmatch(r'/loop/(\d+)/(\d+)', path)
+        if match:
+            length = int(match.group(1))
+            return self.send(302, b'', 'text/html', {'Location': f"{site.base_url}/loop/{length}/{(int(match.group(2)) + 1) % length}"})
+
+        match = re.fullmatch(r'/page/(\d+)\.html', path)
+        if match:
+            return self.send(200, site.page_html(int(match.group(1))), 'text/html; charset=utf-8')
+
+        match = re.fullmatch(r'(/slow|/big|/flaky)?/img/(\d+-\d+)-(\d+)\.png', path)
+        if match:
+            if match.group(1) == '/flaky':
+                with site._stats_lock:
+                    first_request = path not in site._flaky_served
+                    site._flaky_served.add(path)
+                if first_request:
+                    return self.send(503, b'Try again', 'text/plain', {'Retry-After': '0'})
+            if match.group(1) == '/slow':
+                time.sleep(site.slow_ms / 1000)
+            if match.group(1) == '/big':
+                return self.send(200, site.oversized_bytes(), 'image/png')
+            image_data = site.image_bytes(int(match.group(3)), match.group(2))
+            etag = f'"{hashlib.md5(image_data).hexdigest()}"'
+            if self.headers.get('If-None-Match') == etag:
+                return self.send(304, b'', 'image/png', {'ETag': etag})
+            return self.send(200, image_data, 'image/png', {'ETag': etag})
+
+        match = re.fullmatch(r'/status/(\d+)(?:/retry-after/(\d+))?', path)
+        if match:
+            headers = {'Retry-After': match.group(2)} if match.group(2) else None
+            return self.send(int(match.group(1)), f"Status {match.group(1)}".encode('ascii'), 'text/plain', headers)
+
+        return self.send(404, b'Not found', 'text/plain')
+
+    def send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        with self.fixture_site._stats_lock: # counted before the client can see the response, so a caller's counts are up to date
+            self.fixture_site.requests_served += 1
+            self.fixture_site.bytes_served += len(body)
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # keep benchmark output clean
@@ -0,0 +1,172 @@
+import threading # Metrics are updated from request threads and worker threads
+import time # For timing pipeline stages
+from contextlib import contextmanager # For the timer() and search_timing() with-blocks
+from contextvars import ContextVar # The per-search summary follows the request through threads and async tasks
+
+# In-process counters and timers for the scrape pipeline, exposed in the Prometheus text format
+# by the /metrics view. Each server process keeps its own, as Prometheus expects when it scrapes
+# every worker.
+#
+# While a scrape runs inside search_timing(), every stage timed with timer() or record_stage() is
+# also added to that search's timing summary, which gets saved with the Search.
+
+METRIC_PREFIX = 'umproject_'
+
+# Upper bounds (seconds) of the histogram buckets for stage timings
+TIMER_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_counters = {} # (name, labels) -> value
+_histograms = {} # (name, labels) -> {'buckets': [count per bucket], 'sum': seconds, 'count': n}
+
+_current_summary = ContextVar('current_search_timing_summary', default=None)
+
+def _labels_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+# Adds value to the counter name (with the given labels), and to the current search's summary
+def incr(name, value=1, **labels):
+    key = (name, _labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+    summary = _current_summary.get()
+    if summary is not None:
+        counter_name = name + ''.join(f"[{label}={labels[label]}]" for label in sorted(labels))
+        with _lock:
+            summary['counters'][counter_name] = summary['counters'].get(counter_name, 0) + value
+
+# Records one observation of seconds in the histogram name (with the given labels)
+def observe(name, seconds, **labels):
+    key = (name, _labels_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': [0] * len(TIMER_BUCKETS), 'sum': 0.0, 'count': 0}
+        for index, bound in enumerate(TIMER_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][index] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+# Records that a pipeline stage took seconds, in the stage timing histogram and the current search's summary
+def record_stage(stage, seconds):
+    observe('scrape_stage_seconds', seconds, stage=stage)
+
+    summary = _current_summary.get()
+    if summary is not None:
+        with _lock:
+            stage_totals = summary['stages'].setdefault(stage, {'count': 0, 'seconds': 0.0})
+            stage_totals['count'] += 1
+            stage_totals['seconds'] += seconds
+
+# Times the body of a with-block as one run of a pipeline stage, e.g.
+#     with timer('page_fetch'):
+#         response = requests.get(url)
+@contextmanager
+def timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+# Collects the stage timings and counters of everything run inside the with-block into a summary
+# for one search, e.g.
+#     with search_timing() as summary:
+#         ... scrape ...
+#     search.timing_summary = timing_summary_for_storage(summary)
+@contextmanager
+def search_timing():
+    summary = {'stages': {}, 'counters': {}}
+    token = _current_summary.set(summary)
+    start = time.perf_counter()
+    try:
+        yield summary
+    finally:
+        summary['total_seconds'] = time.perf_counter() - start
+        _current_summary.reset(token)
+
+# Rounds a search timing summary to something compact to store as JSON
+def timing_summary_for_storage(summary):
+    return {
+        'total_seconds': round(summary.get('total_seconds', 0.0), 3),
+        'stages': {stage: {'count': totals['count'], 'seconds': round(totals['seconds'], 3)} for stage, totals in sorted(summary['stages'].items())},
+        'counters': dict(sorted(summary['counters'].items())),
+    }
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape_label(value)}"' for key, value in labels) + '}'
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+# Returns every counter and histogram in the Prometheus text exposition format.
+# extra_counters is a list of (name, labels dict, value) for counters kept elsewhere (e.g. cache stats).
+def render_prometheus(extra_counters=()):
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: {'buckets': list(value['buckets']), 'sum': value['sum'], 'count': value['count']} for key, value in _histograms.items()}
+    for name, labels, value in extra_counters:
+        counters[(name, _labels_key(labels))] = value
+
+    lines = []
+    for name in sorted({name for name, labels in counters}):
+        lines.append(f"# TYPE {METRIC_PREFIX}{name}_total counter")
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append(f"{METRIC_PREFIX}{name}_total{_format_labels(labels)} {value}")
+
+    for name in sorted({name for name, labels in histograms}):
+        lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+        for (histogram_name, labels), histogram in sorted(histograms.items()):
+            if histogram_name != name:
+                continue
+            for bound, count in zip(TIMER_BUCKETS, histogram['buckets']):
+                lines.append(f"{METRIC_PREFIX}{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {count}")
+            lines.append(f"{METRIC_PREFIX}{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"{METRIC_PREFIX}{name}_sum{_format_labels(labels)} {histogram['sum']:.6f}")
+            lines.append(f"{METRIC_PREFIX}{name}_count{_format_labels(labels)} {histogram['count']}")
+
+    return '\n'.join(lines) + '\n'
+
+# Current value of a counter, mostly for benchmarks and tests comparing before and after
+def counter_value(name, **labels):
+    with _lock:
+        if labels:
+            return _counters.get((name, _labels_key(labels)), 0)
+        return sum(value for (counter_name, _), value in _counters.items() if counter_name == name)
+
+# Copy of a histogram's bucket counts, sum and count (all zero if nothing was recorded yet).
+# Benchmarks take one before and after a run, and diff them with histogram_quantile().
+def histogram_snapshot(name, **labels):
+    with _lock:
+        histogram = _histograms.get((name, _labels_key(labels)))
+        if histogram is None:
+            return {'buckets': [0] * len(TIMER_BUCKETS), 'sum': 0.0, 'count': 0}
+        return {'buckets': list(histogram['buckets']), 'sum': histogram['sum'], 'count': histogram['count']}
+
+# Estimates quantile q (0-1) of the observations recorded between two histogram snapshots, as the
+# upper bound of the bucket it falls in (like Prometheus' histogram_quantile without interpolation).
+# Returns None if nothing was recorded in between.
+def histogram_quantile(q, after, before=None):
+    before = before or {'buckets': [0] * len(TIMER_BUCKETS), 'count': 0}
+    count = after['count'] - before['count']
+    if count <= 0:
+        return None
+    rank = q * count
+    for bound, cumulative_after, cumulative_before in zip(TIMER_BUCKETS, after['buckets'], before['buckets']):
+        if cumulative_after - cumulative_before >= rank:
+            return bound
+    return float('inf')
+
+# Nearest-rank percentile (0-100) of a list of raw measurements (e.g. request latencies a benchmark
+# timed itself), or None if it's empty
+def percentile(values, percent):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(percent / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
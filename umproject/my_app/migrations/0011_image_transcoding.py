@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-19 01:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0010_image_url_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='bytes_saved',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='original',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='original_byte_size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='original_content_type',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='search',
+            name='bytes_saved',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 01:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0011_image_transcoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='search',
+            name='timing_summary',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
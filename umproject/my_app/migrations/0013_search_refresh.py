@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-19 01:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0012_search_timing_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='etag',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='last_modified',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='vanished_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='search',
+            name='last_refreshed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='search',
+            name='refresh_summary',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 01:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0013_search_refresh'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='search',
+            name='last_viewed',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
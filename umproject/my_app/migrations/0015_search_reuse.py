@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-19 01:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0014_search_last_viewed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='search',
+            name='final_url',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='search',
+            name='reused_from',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='reuses', to='my_app.search'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 01:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0015_search_reuse'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='search',
+            name='content_version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 01:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0016_search_content_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='found_by',
+            field=models.CharField(default='html', max_length=8),
+        ),
+    ]
@@ -1,15 +1,34 @@
 from django.db import models
 
+# How a scrape found an image (Image.found_by)
+FOUND_IN_HTML = 'html' # an img tag in the page's HTML
+FOUND_BY_BROWSER = 'browser' # only by the webdriver pass (lazy loaded or added by scripts, and screen shots of svg elements)
+
 class Search(models.Model):
     url = models.CharField(max_length=255)
     timestamp = models.DateTimeField(auto_now_add=True)
+    bytes_saved = models.BigIntegerField(default=0)
+      # bytes_saved is the total storage saved by transcoding this search's images (none if the originals are kept too, see transcode.py)
+    timing_summary = models.JSONField(null=True, blank=True)
+      # timing_summary is the time spent in each stage of the scrape, and its counters (see metrics.py)
+    last_refreshed = models.DateTimeField(null=True, blank=True)
+    refresh_summary = models.JSONField(null=True, blank=True)
+      # refresh_summary is what the last refresh (re-scrape into this search) found: new, unchanged, removed and not checked images, and bytes transferred
+    last_viewed = models.DateTimeField(null=True, blank=True, db_index=True)
+      # last_viewed is when the search's gallery was last looked at (to within settings.SEARCH_VIEW_RECORD_INTERVAL), for LRU eviction (see retention.py)
+    final_url = models.CharField(max_length=255, blank=True, default='', db_index=True)
+      # final_url is the normalized URL the page was fetched from after redirects, for finding a recent scrape of the same page (see reuse.py)
+    reused_from = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='reuses')
+      # reused_from is the recent search whose images this one shows instead of scraping the page again (see reuse.py)
+    content_version = models.PositiveIntegerField(default=1)
+      # content_version goes up whenever the search's images change, so cached galleries made before that aren't used again (see caching.py)
     def __str__(self):
         return self.query
 
 class Image(models.Model):
     search = models.ForeignKey(Search, on_delete=models.CASCADE, null=True, blank=True)
     url = models.CharField(max_length=255)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
     image = models.BinaryField(editable=False, null=True)
       # BinaryField editable=False and null=True will make it a LONGBLOB field (4 gig max size) in Django 3.2 and above
     content_type = models.CharField(max_length=64)
@@ -17,6 +36,39 @@ class Image(models.Model):
       # unique_search_image is unique to enforce a unique (search & image) in the table
       # default value is required by python migrations for reasons that sound dubious 
 
+    # Precomputed metadata, filled in at ingest (or by 'manage.py backfill_image_metadata' for older rows)
+    # so galleries can filter and sort on these columns without loading or decoding the image blob.
+    width = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    height = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    byte_size = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    image_format = models.CharField(max_length=16, blank=True, default='', db_index=True)
+      # image_format is sniffed from the magic bytes of the image data, not taken from the content-type header
+    frame_count = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+      # frame_count is more than 1 for animated GIF/WebP/PNG
+    content_hash = models.CharField(max_length=32, blank=True, default='', db_index=True)
+      # content_hash is the md5 checksum of the image data, the same one used in unique_search_image
+
+    # Display filename, source host and URL path, worked out from url once at ingest instead of on every render
+    filename = models.CharField(max_length=255, blank=True, default='', db_index=True)
+    host = models.CharField(max_length=255, blank=True, default='', db_index=True)
+      # host is the lowercase hostname of url, without port, e.g. 'www.umich.edu' ('' for data: and screen shot images)
+    path = models.CharField(max_length=255, blank=True, default='')
+
+    # When transcoding at ingest is on (settings.IMAGE_TRANSCODING), image holds the compact version and
+    # these record what was downloaded. original is only kept if settings.IMAGE_TRANSCODE_KEEP_ORIGINAL is set.
+    original = models.BinaryField(editable=False, null=True)
+    original_content_type = models.CharField(max_length=64, blank=True, default='')
+    original_byte_size = models.PositiveIntegerField(null=True, blank=True)
+    bytes_saved = models.PositiveIntegerField(default=0)
+
+    # HTTP validators from the response the image was downloaded with, so a refresh of the search can ask
+    # the site for it again with a conditional GET, and vanished_at is set when a refresh no longer finds it
+    etag = models.CharField(max_length=255, blank=True, default='')
+    last_modified = models.CharField(max_length=64, blank=True, default='')
+    vanished_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    found_by = models.CharField(max_length=8, default=FOUND_IN_HTML)
+      # found_by is FOUND_BY_BROWSER for images the webdriver pass found, which a refresh (parsing just the HTML) can't check for
+
     # This attempt at constraining search & image field to combined uniqueness also failed
     #
     # Constraint should throw ValidationError exception if we
@@ -0,0 +1,149 @@
+import hashlib # For cache keys from URLs
+import requests # For the errors fetching a cached final URL can raise
+from urllib.parse import urljoin, urlparse # For resolving Location headers and adding a scheme
+from django.conf import settings # For the redirect limit and cache timeout set in settings.py
+from django.core.cache import cache # Entered URL -> final URL mappings
+from .caching import count_cache_lookup # Hit and miss counts for the resolved URL cache
+from .fetch_scheduler import HostCircuitOpen, fetch, async_fetch # Every hop goes through the per-host scheduler
+from .metrics import incr, timer # Each hop is timed and counted as a page fetch
+
+try:
+    import httpx # Only needed for async_fetch_page() (see scrape_web_page_async)
+except ImportError:
+    httpx = None
+
+# Redirect resolution for the page a search scrapes. fetch_page() (and async_fetch_page() for the
+# httpx pipeline) follow a chain of redirects one hop at a time, up to settings.MAX_REDIRECTS hops,
+# resolving relative Location headers and keeping their query strings, and stop with RedirectError
+# if a URL comes round again.
+#
+# Where a URL ends up is cached, so searching for "google.com" again goes straight to
+# https://www.google.com/ instead of through the http -> https -> www hops. A chain made only of
+# permanent redirects (301 / 308) is cached for settings.REDIRECT_CACHE_TIMEOUT seconds, one with any
+# temporary redirect in it for settings.REDIRECT_TEMPORARY_CACHE_TIMEOUT. If fetching the cached final
+# URL redirects, fails or raises, the mapping is dropped and the chain is followed again from the start.
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+PERMANENT_REDIRECT_STATUSES = (301, 308)
+
+class RedirectError(Exception):
+    pass
+
+# The URL entered by the user, with http:// added if it has no scheme. The query string is kept.
+def add_scheme(url_entered):
+    parsed_url = urlparse(url_entered)
+    scheme = parsed_url.scheme if parsed_url.scheme else 'http'
+    url = f"{scheme}://{parsed_url.netloc}{parsed_url.path}"
+    return f"{url}?{parsed_url.query}" if parsed_url.query else url
+
+def resolved_url_key(url):
+    return f"resolved-url:{hashlib.md5(url.encode()).hexdigest()}"
+
+# (final URL, number of hops to it) for where url redirected to last time, or None
+def cached_final_url(url):
+    resolved = cache.get(resolved_url_key(url))
+    count_cache_lookup('resolved_url', resolved is not None)
+    return resolved
+
+# Caches where a redirect chain (a list of URLs, starting with the one fetched) ended up. statuses
+# are the status codes of its redirects, one per hop.
+def remember_final_url(chain, statuses):
+    if len(chain) > 1:
+        if all(status in PERMANENT_REDIRECT_STATUSES for status in statuses):
+            timeout = getattr(settings, 'REDIRECT_CACHE_TIMEOUT', 24 * 60 * 60)
+        else:
+            timeout = getattr(settings, 'REDIRECT_TEMPORARY_CACHE_TIMEOUT', 5 * 60)
+        cache.set(resolved_url_key(chain[0]), (chain[-1], len(chain) - 1), timeout=timeout)
+
+# Where url is known to end up (without fetching it): the cached final URL, or url itself
+def known_final_url(url):
+    resolved = cache.get(resolved_url_key(url))
+    return resolved[0] if resolved else url
+
+def forget_final_url(url):
+    cache.delete(resolved_url_key(url))
+
+def _is_redirect(response):
+    return response.status_code in REDIRECT_STATUSES and 'location' in response.headers
+
+# The URL a redirect response from chain[-1] points to. Raises RedirectError if it's already in the
+# chain, or if the chain is already settings.MAX_REDIRECTS hops long.
+def _next_url(chain, response):
+    next_url = urljoin(chain[-1], response.headers['location'])
+    if next_url in chain:
+        raise RedirectError(f"Redirect loop: {' -> '.join(chain + [next_url])}")
+    if len(chain) > getattr(settings, 'MAX_REDIRECTS', 10):
+        raise RedirectError(f"Too many redirects from {chain[0]}")
+    return next_url
+
+def _count_page_fetch(response):
+    incr('page_fetch', status=response.status_code)
+    incr('page_fetch_bytes', len(response.content))
+
+def _fetch_hop(url):
+    with timer('page_fetch'):
+        response = fetch(url, allow_redirects=False)
+    _count_page_fetch(response)
+    return response
+
+async def _async_fetch_hop(client, url):
+    with timer('page_fetch'):
+        response = await async_fetch(client, url, follow_redirects=False)
+    _count_page_fetch(response)
+    return response
+
+# The errors fetching a cached final URL can raise, after which the chain is followed from the start
+def _cached_fetch_errors():
+    errors = (requests.exceptions.RequestException, HostCircuitOpen)
+    return errors + (httpx.HTTPError,) if httpx else errors
+
+# Fetches url, following redirects. Returns (final URL, its response), which may be an error status.
+# Raises RedirectError, or whatever fetch() raises.
+def fetch_page(url):
+    resolved = cached_final_url(url)
+    if resolved:
+        final_url, hops = resolved
+        try:
+            response = _fetch_hop(final_url)
+        except _cached_fetch_errors():
+            response = None
+        if response is not None and 200 <= response.status_code < 300:
+            incr('redirect_hops_skipped', hops)
+            return final_url, response
+        forget_final_url(url) # it moved again, or is failing: start over from url
+
+    chain, statuses = [url], []
+    response = _fetch_hop(url)
+    while _is_redirect(response):
+        chain.append(_next_url(chain, response))
+        statuses.append(response.status_code)
+        response = _fetch_hop(chain[-1])
+    incr('redirect_hops', len(chain) - 1)
+    if 200 <= response.status_code < 300:
+        remember_final_url(chain, statuses)
+    return chain[-1], response
+
+# Async version of fetch_page(), with an httpx.AsyncClient
+async def async_fetch_page(client, url):
+    resolved = cached_final_url(url)
+    if resolved:
+        final_url, hops = resolved
+        try:
+            response = await _async_fetch_hop(client, final_url)
+        except _cached_fetch_errors():
+            response = None
+        if response is not None and 200 <= response.status_code < 300:
+            incr('redirect_hops_skipped', hops)
+            return final_url, response
+        forget_final_url(url) # it moved again, or is failing: start over from url
+
+    chain, statuses = [url], []
+    response = await _async_fetch_hop(client, url)
+    while _is_redirect(response):
+        chain.append(_next_url(chain, response))
+        statuses.append(response.status_code)
+        response = await _async_fetch_hop(client, chain[-1])
+    incr('redirect_hops', len(chain) - 1)
+    if 200 <= response.status_code < 300:
+        remember_final_url(chain, statuses)
+    return chain[-1], response
@@ -0,0 +1,178 @@
+import time # For pausing between purge chunks
+from datetime import timedelta # For the maximum search age
+from django.conf import settings # For the retention policy set in settings.py
+from django.db import connections, router # For deleting without signals, and reclaiming storage after a purge
+from django.db.models import Case, Sum, When, Value # For adding up stored bytes in the database
+from django.db.models.functions import Coalesce # Never-viewed searches count as viewed when they were made
+from django.utils import timezone # For ages and view times
+from .caching import invalidate_searches, invalidate_site_counts # A purge changes the galleries and counts
+from .models import Image, Search
+
+# Retention policies for stored images, applied by 'manage.py purge_images' (run it regularly, e.g.
+# from cron). Each policy is off when its setting is None:
+#
+# * settings.RETENTION_MAX_SEARCH_AGE_DAYS: searches scraped (and last refreshed, and last reused)
+#   longer ago than this are deleted.
+# * settings.RETENTION_MAX_TOTAL_BYTES: while all the images take more than this, the least recently
+#   viewed searches are deleted (by Search.last_viewed, or when they were made if never viewed).
+# * settings.RETENTION_MAX_BYTES_PER_HOST: while the images from one host (Image.host) take more than
+#   this, that host's images from the least recently viewed searches are deleted.
+#
+# Rows are deleted a chunk at a time with a pause in between, so a purge never holds long locks on
+# the image table. The freed space is only handed back to the filesystem if asked for (see
+# reclaim_storage()), since that can rewrite the whole table.
+
+# Bytes an image takes in the database: its blob, plus the original download if that was kept too
+def stored_bytes_expression():
+    return Coalesce('byte_size', 0) + Case(When(original__isnull=False, then=Coalesce('original_byte_size', 0)), default=Value(0))
+
+def stored_bytes(images):
+    return images.aggregate(total=Sum(stored_bytes_expression()))['total'] or 0
+
+# Records that a search's gallery was viewed, for LRU eviction. It's an UPDATE of one row at most
+# once per settings.SEARCH_VIEW_RECORD_INTERVAL seconds per search (checked against the Search the
+# view already loaded), so busy galleries don't write on every request.
+def record_search_view(search):
+    now = timezone.now()
+    interval = getattr(settings, 'SEARCH_VIEW_RECORD_INTERVAL', 60 * 60)
+    if search.last_viewed is not None and now - search.last_viewed < timedelta(seconds=interval):
+        return
+    Search.objects.filter(pk=search.pk).update(last_viewed=now)
+
+# Searches in least recently viewed order
+def searches_least_recently_viewed():
+    return Search.objects.annotate(viewed=Coalesce('last_viewed', 'timestamp')).order_by('viewed', 'id')
+
+# Ids of searches scraped more than max_age_days ago, and not refreshed or reused since (deleting a
+# search deletes the searches that reuse it too)
+def searches_past_max_age(max_age_days):
+    if max_age_days is None:
+        return []
+    cutoff = timezone.now() - timedelta(days=max_age_days)
+    return list(Search.objects.filter(timestamp__lt=cutoff).exclude(last_refreshed__gte=cutoff).exclude(reuses__timestamp__gte=cutoff)
+                .distinct().values_list('id', flat=True))
+
+# Ids of the least recently viewed searches to delete to bring the total stored bytes under
+# max_total_bytes, not counting searches in already_deleting (which are going anyway). Searches holding
+# no images (like ones that reused another search's scrape) free nothing, so they're left alone.
+def searches_over_quota(max_total_bytes, already_deleting=()):
+    if max_total_bytes is None:
+        return []
+    bytes_by_search = dict(Image.objects.values('search_id').annotate(total=Sum(stored_bytes_expression())).values_list('search_id', 'total'))
+    already_deleting = set(already_deleting)
+    total = sum(search_bytes or 0 for search_id, search_bytes in bytes_by_search.items() if search_id not in already_deleting)
+
+    evict = []
+    for search_id in searches_least_recently_viewed().values_list('id', flat=True).iterator():
+        if total <= max_total_bytes:
+            break
+        if search_id in already_deleting or not bytes_by_search.get(search_id):
+            continue
+        evict.append(search_id)
+        total -= bytes_by_search.get(search_id) or 0
+    return evict
+
+# Ids of images to delete so no host has more than max_bytes_per_host stored, taking each host's
+# images from the least recently viewed searches first, and not counting searches in already_deleting
+def images_over_host_caps(max_bytes_per_host, already_deleting=()):
+    if max_bytes_per_host is None:
+        return []
+    images = Image.objects.exclude(host='').exclude(search_id__in=list(already_deleting))
+    over_cap = {host: total for host, total in images.values('host').annotate(total=Sum(stored_bytes_expression())).values_list('host', 'total')
+                if total > max_bytes_per_host}
+
+    evict = []
+    for host, total in over_cap.items():
+        host_images = (images.filter(host=host)
+                       .annotate(viewed=Coalesce('search__last_viewed', 'search__timestamp'), stored=stored_bytes_expression())
+                       .order_by('viewed', 'id').values_list('id', 'stored'))
+        for image_id, image_bytes in host_images.iterator():
+            if total <= max_bytes_per_host:
+                break
+            evict.append(image_id)
+            total -= image_bytes or 0
+    return evict
+
+# Deletes images (an Image queryset) chunk_size rows at a time, pausing pause seconds between chunks.
+# Only ids and search ids are loaded, never the blobs. Each chunk is one DELETE, without the
+# per-image delete signals; the searches it took images from are invalidated together afterwards.
+# Returns (images deleted, bytes freed), and calls progress(images deleted, bytes freed) after each
+# chunk if given.
+def delete_images_in_chunks(images, chunk_size, pause, progress=None):
+    deleted = freed = 0
+    last_id = 0
+    while True:
+        chunk_rows = list(images.filter(pk__gt=last_id).order_by('pk').values_list('pk', 'search_id')[:chunk_size])
+        if not chunk_rows:
+            break
+        chunk_ids = [image_id for image_id, _ in chunk_rows]
+        last_id = chunk_ids[-1]
+        chunk_bytes = stored_bytes(Image.objects.filter(pk__in=chunk_ids))
+        delete_rows(Image, chunk_ids)
+        invalidate_searches({search_id for _, search_id in chunk_rows if search_id is not None})
+
+        deleted += len(chunk_ids)
+        freed += chunk_bytes
+        if progress:
+            progress(deleted, freed)
+        if pause:
+            time.sleep(pause)
+    return deleted, freed
+
+# DELETE of the rows of model with the given primary keys, as one query and without sending the
+# delete signals or collecting related objects (so only for models nothing else references)
+def delete_rows(model, ids):
+    connection = connections[router.db_for_write(model)]
+    table = connection.ops.quote_name(model._meta.db_table)
+    pk_column = connection.ops.quote_name(model._meta.pk.column)
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {table} WHERE {pk_column} IN ({', '.join(['%s'] * len(ids))})", ids)
+
+# Deletes whole searches, their images first in chunks (so it isn't one giant cascading delete), then
+# the empty Search rows. Returns (images deleted, bytes freed).
+def delete_searches_in_chunks(search_ids, chunk_size, pause, progress=None):
+    deleted = freed = 0
+    for search_id in search_ids:
+        search_deleted, search_freed = delete_images_in_chunks(Image.objects.filter(search_id=search_id), chunk_size, pause)
+        Search.objects.filter(pk=search_id).delete()
+        deleted += search_deleted
+        freed += search_freed
+        if progress:
+            progress(deleted, freed)
+    invalidate_site_counts()
+    return deleted, freed
+
+# Hands the space freed by deleted rows back. A SQLite file with auto_vacuum=INCREMENTAL (see
+# settings.SQLITE_PRAGMAS) gives its free pages back chunk_pages at a time, pausing pause seconds in
+# between, so writers only wait for one chunk. Otherwise the table is rebuilt (SQLite VACUUM of the
+# whole file, MySQL OPTIMIZE TABLE, PostgreSQL VACUUM), which can lock it for a long time on a big
+# database. Returns the SQL run, or None if the database isn't one of those.
+def reclaim_storage(using='default', chunk_pages=2560, pause=0):
+    connection = connections[using]
+    table = connection.ops.quote_name(Image._meta.db_table)
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA auto_vacuum')
+            if cursor.fetchone()[0] == 2: # INCREMENTAL
+                return incremental_vacuum(cursor, chunk_pages, pause)
+    statement = {
+        'sqlite': 'VACUUM',
+        'mysql': f'OPTIMIZE TABLE {table}',
+        'postgresql': f'VACUUM {table}',
+    }.get(connection.vendor)
+    if statement is None:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(statement)
+        if connection.vendor == 'mysql':
+            cursor.fetchall() # OPTIMIZE TABLE returns a status result set
+    return statement
+
+def incremental_vacuum(cursor, chunk_pages, pause):
+    statement = f'PRAGMA incremental_vacuum({int(chunk_pages)})'
+    while True:
+        cursor.execute('PRAGMA freelist_count')
+        if not cursor.fetchone()[0]:
+            return statement
+        cursor.executescript(statement) # executescript runs it to completion; execute() frees just one page
+        time.sleep(pause)
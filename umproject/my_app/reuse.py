@@ -0,0 +1,51 @@
+from datetime import timedelta # For the freshness window
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit # For normalizing URLs
+from django.conf import settings # For SCRAPE_REUSE_WINDOW set in settings.py
+from django.db.models import Q # A search is fresh if it was made or refreshed recently
+from django.utils import timezone # For the freshness window
+from .metrics import incr # Counts of the work reuse saved
+from .models import Image, Search
+from .retention import stored_bytes # Bytes a reused search didn't store again
+
+# Reuse of recent scrape results. Scraping a page that was scraped less than
+# settings.SCRAPE_REUSE_WINDOW seconds ago (by when the search was made, or last refreshed) doesn't
+# scrape it again: a new Search is made with reused_from pointing at the recent one, and its gallery,
+# export and refreshes use that search's images. Pages are matched by normalize_url() of where they
+# ended up after redirects (Search.final_url), so "google.com" and "https://www.google.com/" match.
+#
+# The scrape form's "force fresh" box skips this. What reuse saved (scrapes, images, stored bytes and
+# scraping seconds) is counted in the scrape_reuse* metrics.
+
+# The URL with its scheme and host in lowercase, the default port dropped, an empty path as /, the
+# query parameters sorted and no fragment. '' if that's too long for Search.final_url.
+def normalize_url(url):
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if parts.port and (scheme, parts.port) not in (('http', 80), ('https', 443)):
+        netloc = f"{netloc}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    normalized = urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+    return normalized if len(normalized) <= Search._meta.get_field('final_url').max_length else ''
+
+# The most recent finished, original (not itself reused) search of the page at final_url made or
+# refreshed within the reuse window, or None
+def find_reusable_search(final_url):
+    window = getattr(settings, 'SCRAPE_REUSE_WINDOW', 0)
+    final_url = normalize_url(final_url)
+    if not window or not final_url:
+        return None
+    cutoff = timezone.now() - timedelta(seconds=window)
+    return (Search.objects.filter(final_url=final_url, reused_from__isnull=True, timing_summary__isnull=False) # timing_summary is saved when the scrape finishes
+            .filter(Q(timestamp__gte=cutoff) | Q(last_refreshed__gte=cutoff))
+            .order_by('-timestamp', '-id').first())
+
+# Makes a search for url_entered that shows source's images, and counts the work that saved
+def reuse_search(url_entered, source):
+    search = Search.objects.create(url=url_entered, final_url=source.final_url, reused_from=source)
+    images = Image.objects.filter(search=source)
+    incr('scrape_reuses')
+    incr('scrape_reuse_images', images.count())
+    incr('scrape_reuse_bytes', stored_bytes(images))
+    incr('scrape_reuse_seconds', (source.timing_summary or {}).get('total_seconds', 0))
+    return search
@@ -0,0 +1,21 @@
+from django.db.models.signals import post_save, post_delete # Model save/delete hooks
+from django.dispatch import receiver
+from .models import Image, Search
+from .caching import invalidate_search, invalidate_site_counts
+
+# Cache invalidation hooks, connected when the app is ready (see apps.py).
+# Bulk operations that skip model signals (bulk_create, QuerySet.update) must call
+# invalidate_search() / invalidate_site_counts() themselves. Saving many images in a loop should
+# be done inside caching.invalidation_batch(), so it's one version bump per search, not per image.
+
+# An image was added to or deleted from a search, so its cached gallery and the counts are stale
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+def image_changed(sender, instance, **kwargs):
+    invalidate_search(instance.search_id)
+
+# A search was added or deleted, so the past searches list and the counts are stale
+@receiver(post_save, sender=Search)
+@receiver(post_delete, sender=Search)
+def search_changed(sender, instance, **kwargs):
+    invalidate_site_counts()
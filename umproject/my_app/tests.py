@@ -1,3 +1,863 @@
-from django.test import TestCase
+import csv # For reading exported manifests
+import hashlib # For image content hashes
+import io # For opening exported archives in memory
+import os # For random image bytes
+import tempfile # For files the export command writes
+import time # For Retry-After dates and circuit breaker cooldowns
+import unittest # For skipping tests that need optional packages
+import zipfile # For checking exported archives with the standard library's own ZIP reader
+from concurrent.futures.process import BrokenProcessPool # For breaking the transcoding pool
+from datetime import timedelta # For search ages in the reuse tests
+from email.utils import formatdate # For Retry-After given as an HTTP date
+from asgiref.sync import sync_to_async # For the synchronous parts of async tests
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image as PILImage # For JPEGs to transcode
+from . import fetch_scheduler
+from .caching import cache_stats, gallery_count_key, gallery_key, invalidation_batch
+from .database import read_alias
+from .export import ExportSizeMismatch, SearchExport, parse_range_header
+from .fetch_scheduler import HostCircuitOpen, fetch, host_key, retry_after_seconds, retry_delay
+from .image_metadata import describe_image_url
+from .management.fixture_site import FixtureSite
+from .metrics import counter_value
+from .models import FOUND_BY_BROWSER, Image, Search
+from .redirects import RedirectError, add_scheme, async_fetch_page, cached_final_url, fetch_page, remember_final_url
+from .retention import delete_images_in_chunks, reclaim_storage, searches_over_quota, searches_past_max_age
+from .reuse import find_reusable_search, normalize_url
+from .transcode import transcode_batch_for_storage, transcode_pool
+from .views import database_save_batch, gallery_variant, refresh_search_images
 
-# Create your tests here.
+try:
+    import httpx # Only needed for the async redirect tests
+except ImportError:
+    httpx = None
+
+# Run with: UMPROJECT_DB_PROFILE=sqlite python manage.py test my_app
+
+# The databases a test of views that read from the replica (see database.reads_from_replica) needs:
+# the read alias as well as 'default', under the profiles that have one
+REPLICA_DATABASES = {'default', read_alias()} if read_alias() else {'default'}
+
+# Makes a stored image for search from data, with the metadata columns filled in as at ingest
+def make_image(search, data, url, **fields):
+    content_hash = hashlib.md5(data).hexdigest()
+    fields = {'content_type': 'image/png', 'image_format': 'png', 'byte_size': len(data), 'content_hash': content_hash, **fields}
+    return Image.objects.create(search=search, url=url, image=data, unique_search_image=f"{search.id}-{content_hash}", **fields)
+
+class ParseRangeHeaderTests(SimpleTestCase):
+    def test_missing_or_unusable_ranges_mean_the_whole_archive(self):
+        for header in (None, '', 'bytes=-', 'items=0-10', 'bytes=0-10,20-30', 'bytes=a-b'):
+            self.assertIsNone(parse_range_header(header, 1000), header)
+
+    def test_start_and_end(self):
+        self.assertEqual(parse_range_header('bytes=0-0', 1000), (0, 0))
+        self.assertEqual(parse_range_header('bytes=100-199', 1000), (100, 199))
+        self.assertEqual(parse_range_header(' bytes=999-999 ', 1000), (999, 999))
+
+    def test_open_ended_range_runs_to_the_end(self):
+        self.assertEqual(parse_range_header('bytes=500-', 1000), (500, 999))
+
+    def test_end_past_the_archive_is_clamped(self):
+        self.assertEqual(parse_range_header('bytes=900-5000', 1000), (900, 999))
+
+    def test_suffix_range_is_the_last_bytes(self):
+        self.assertEqual(parse_range_header('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range_header('bytes=-5000', 1000), (0, 999))
+
+    def test_unsatisfiable_ranges(self):
+        for header in ('bytes=1000-', 'bytes=1000-1200', 'bytes=500-400', 'bytes=-0'):
+            with self.assertRaises(ValueError, msg=header):
+                parse_range_header(header, 1000)
+
+class SearchExportTests(TestCase):
+    databases = REPLICA_DATABASES
+    def setUp(self):
+        self.search = Search.objects.create(url='example.com')
+        self.blobs = [os.urandom(size) for size in (1, 700, 5000, 12345)]
+        self.images = [make_image(self.search, data, f"https://example.com/img/{number}.png") for number, data in enumerate(self.blobs)]
+        make_image(Search.objects.create(url='other.com'), os.urandom(100), 'https://other.com/a.png') # another search's image
+
+    def archive(self, export):
+        return b''.join(export.stream())
+
+    def test_archive_round_trips_through_zipfile(self):
+        export = SearchExport(self.search)
+        data = self.archive(export)
+        self.assertEqual(len(data), export.total_size)
+
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertIsNone(archive.testzip()) # every CRC matches
+            names = archive.namelist()
+            self.assertEqual(names[-1], 'manifest.csv')
+            self.assertEqual(len(names), len(self.blobs) + 1)
+            for number, (image, blob, name) in enumerate(zip(self.images, self.blobs, names)):
+                self.assertEqual(name, f"{image.id}-{number}.png")
+                self.assertEqual(archive.read(name), blob)
+                info = archive.getinfo(name)
+                self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+                self.assertEqual(info.file_size, len(blob))
+
+            manifest = list(csv.DictReader(io.StringIO(archive.read('manifest.csv').decode('utf-8'))))
+            self.assertEqual([row['file'] for row in manifest], names[:-1])
+            self.assertEqual([int(row['size']) for row in manifest], [len(blob) for blob in self.blobs])
+            self.assertEqual([row['hash'] for row in manifest], [hashlib.md5(blob).hexdigest() for blob in self.blobs])
+
+    def test_manifest_hashes_the_exported_file_and_labels_the_download_hash(self):
+        transcoded = make_image(self.search, b'webp bytes', 'https://example.com/img/photo.jpg', image_format='webp',
+                                content_hash=hashlib.md5(b'the jpeg as downloaded').hexdigest())
+        with zipfile.ZipFile(io.BytesIO(self.archive(SearchExport(self.search)))) as archive:
+            manifest = {row['file']: row for row in csv.DictReader(io.StringIO(archive.read('manifest.csv').decode('utf-8')))}
+            row = manifest[f"{transcoded.id}-photo.jpg"]
+            self.assertEqual(row['hash'], hashlib.md5(archive.read(row['file'])).hexdigest())
+            self.assertEqual(row['download_hash'], transcoded.content_hash)
+
+    def test_local_headers_are_at_the_recorded_offsets(self):
+        export = SearchExport(self.search)
+        data = self.archive(export)
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            offsets = [info.header_offset for info in archive.infolist()]
+        self.assertEqual(offsets, [entry['offset'] for entry in export.entries])
+        for offset in offsets:
+            self.assertEqual(data[offset:offset + 4], b'PK\x03\x04')
+        self.assertEqual(data[export.central_directory_offset:export.central_directory_offset + 4], b'PK\x01\x02')
+
+    def test_partial_ranges_match_the_whole_archive(self):
+        export = SearchExport(self.search)
+        whole = self.archive(export)
+        size = export.total_size
+        second_image = export.entries[1]['offset']
+        ranges = [(0, 0), (0, size - 1), (10, 40), (second_image - 5, second_image + 5000), (second_image + 1, size - 30),
+                  (export.manifest_offset - 1, export.manifest_offset + 10), (export.manifest_offset + 40, size - 1),
+                  (export.central_directory_offset - 1, export.central_directory_offset + 10),
+                  (export.central_directory_offset + 3, size - 1), (size - 22, size - 1), (size - 1, size - 1)]
+        for start, end in ranges:
+            part = b''.join(SearchExport(self.search).stream(start, end)) # a fresh export, as a resumed download would get
+            self.assertEqual(part, whole[start:end + 1], (start, end))
+
+    def test_etag_changes_with_the_contents(self):
+        etag = SearchExport(self.search).etag
+        self.assertEqual(SearchExport(self.search).etag, etag)
+        make_image(self.search, os.urandom(10), 'https://example.com/img/new.png')
+        self.assertNotEqual(SearchExport(self.search).etag, etag)
+
+    def test_wrong_recorded_size_is_an_error_not_a_corrupt_archive(self):
+        Image.objects.filter(pk=self.images[1].pk).update(byte_size=701)
+        with self.assertRaises(ExportSizeMismatch):
+            self.archive(SearchExport(self.search))
+
+    def test_export_view_resumes_with_a_range(self):
+        export = SearchExport(self.search)
+        whole = self.archive(export)
+
+        response = self.client.get(f'/export/{self.search.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), whole)
+        self.assertEqual(int(response['Content-Length']), len(whole))
+
+        response = self.client.get(f'/export/{self.search.id}/', HTTP_RANGE='bytes=100-', HTTP_IF_RANGE=export.etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f"bytes 100-{len(whole) - 1}/{len(whole)}")
+        self.assertEqual(b''.join(response.streaming_content), whole[100:])
+
+        response = self.client.get(f'/export/{self.search.id}/', HTTP_RANGE='bytes=100-', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200) # the archive changed since, so start over
+
+        response = self.client.get(f'/export/{self.search.id}/', HTTP_RANGE=f'bytes={len(whole)}-')
+        self.assertEqual(response.status_code, 416)
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}) # always render the gallery
+class StreamingUnderASGITests(TestCase):
+    databases = REPLICA_DATABASES
+    def setUp(self):
+        self.search = Search.objects.create(url='example.com')
+        self.blobs = [os.urandom(size) for size in (300, 4000, 20000)]
+        for number, data in enumerate(self.blobs):
+            make_image(self.search, data, f"https://example.com/img/{number}.png")
+
+    async def async_content(self, path, headers=None):
+        response = await AsyncClient().get(path, headers=headers)
+        self.assertTrue(response.is_async) # an async iterator, not one Django reads into a list first
+        return response, b''.join([chunk async for chunk in response])
+
+    async def test_gallery_streams_the_same_page(self):
+        path = f'/success/{self.search.id}/?stream=1'
+        expected = await sync_to_async(lambda: b''.join(self.client.get(path).streaming_content))()
+        response, content = await self.async_content(path)
+        self.assertEqual(content, expected)
+
+    async def test_export_streams_the_same_archive(self):
+        export = await sync_to_async(SearchExport)(self.search)
+        whole = await sync_to_async(lambda: b''.join(export.stream()))()
+        response, content = await self.async_content(f'/export/{self.search.id}/')
+        self.assertEqual(content, whole)
+        response, content = await self.async_content(f'/export/{self.search.id}/', {'Range': 'bytes=50-'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(content, whole[50:])
+
+@override_settings(SCRAPE_WITH_WEBDRIVER=False, FETCH_HOST_MAX_REQUESTS_PER_SECOND=0, ASYNC_SCRAPE_DB_BATCH_SIZE=2)
+class AsyncScrapeTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.site = FixtureSite(images_per_page=5, srcset_variants=2, lazy_fraction=0.4, redirect_hops=1, slow_fraction=0, oversized_fraction=0, data_uris=1)
+        cls.site.start()
+        cls.addClassCleanup(cls.site.stop)
+
+    def setUp(self):
+        cache.clear()
+
+    async def scrape(self):
+        response = await AsyncClient().post('/scrape_web_page_async/', {'url': self.site.page_url(1)})
+        self.assertEqual(response.status_code, 302)
+        return await Search.objects.aget(pk=response['Location'].rstrip('/').split('/')[-1])
+
+    @unittest.skipIf(httpx is None, "needs httpx")
+    async def test_scrape_stores_every_image(self):
+        search = await self.scrape()
+        self.assertEqual(search.final_url, normalize_url(f"{self.site.base_url}/page/1.html")) # after the redirect
+        self.assertIsNotNone(search.timing_summary)
+        urls = [url async for url in Image.objects.filter(search=search).values_list('url', flat=True)]
+        self.assertEqual(len(urls), 6) # five from srcsets (in three batches), one data: URI
+        self.assertTrue(all(url.endswith('-240.png') for url in urls if not url.startswith('data:'))) # the largest variant
+
+# A TransactionTestCase, since it checks when database_save_batch() opens its transaction
+@override_settings(IMAGE_TRANSCODING=True, IMAGE_TRANSCODE_MIN_BYTES=0)
+class SaveBatchTests(TransactionTestCase):
+    def test_images_are_transcoded_before_the_transaction(self):
+        search = Search.objects.create(url='example.com')
+        images = [(make_jpeg(120 + number), f"https://example.com/{number}.jpg", 'image/jpeg', None) for number in range(3)]
+        with CaptureQueriesContext(connection) as queries:
+            database_save_batch(search, images)
+        sql = [query['sql'] for query in queries.captured_queries]
+        stored_check = next(number for number, statement in enumerate(sql) if '"unique_search_image" IN' in statement) # transcode_image_rows()
+        self.assertLess(stored_check, sql.index('BEGIN'))
+        self.assertEqual(list(Image.objects.filter(search=search).values_list('image_format', flat=True)), ['webp'] * 3)
+
+# Tests against a local FixtureSite, started once per class, with the scheduler's per-host state reset for each test
+class FixtureSiteTestCase(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.site = FixtureSite(redirect_hops=0, slow_fraction=0, oversized_fraction=0, data_uris=0)
+        cls.base_url = cls.site.start()
+        cls.addClassCleanup(cls.site.stop)
+
+    def setUp(self):
+        with fetch_scheduler._lock:
+            fetch_scheduler._hosts.clear()
+
+    def host_state(self):
+        return fetch_scheduler._hosts[host_key(self.base_url)]
+
+    def try_start(self):
+        with fetch_scheduler._lock:
+            return fetch_scheduler._try_start(host_key(self.base_url))
+
+@override_settings(FETCH_BACKOFF_BASE=0.01, FETCH_MAX_RETRIES=3, FETCH_HOST_MAX_REQUESTS_PER_SECOND=0)
+class FetchRetryTests(FixtureSiteTestCase):
+    def test_flaky_image_is_retried(self):
+        retries = counter_value('fetch_retries', reason=503)
+        response = fetch(f"{self.base_url}/flaky/img/1-0-120.png")
+        self.assertEqual(response.status_code, 200) # the 503 (with Retry-After: 0) was retried
+        self.assertEqual(counter_value('fetch_retries', reason=503), retries + 1)
+
+    @override_settings(FETCH_MAX_RETRIES=0)
+    def test_no_retries_returns_the_error_response(self):
+        response = fetch(f"{self.base_url}/flaky/img/1-1-120.png")
+        self.assertEqual(response.status_code, 503)
+
+    def test_gives_up_after_max_retries(self):
+        retries = counter_value('fetch_retries', reason=502)
+        response = fetch(f"{self.base_url}/status/502")
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(counter_value('fetch_retries', reason=502), retries + 3)
+
+    def test_client_errors_are_not_retried(self):
+        retries = counter_value('fetch_retries')
+        self.assertEqual(fetch(f"{self.base_url}/status/404").status_code, 404)
+        self.assertEqual(counter_value('fetch_retries'), retries)
+
+    @override_settings(FETCH_RETRY_AFTER_MAX=60)
+    def test_long_retry_after_gives_up_and_holds_back_the_host_for_at_most_the_maximum(self):
+        retries = counter_value('fetch_retries')
+        response = fetch(f"{self.base_url}/status/429/retry-after/100")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(counter_value('fetch_retries'), retries) # not worth waiting 100s for
+        self.assertAlmostEqual(self.try_start(), 60, delta=1) # and other requests only wait up to FETCH_RETRY_AFTER_MAX
+
+    @override_settings(FETCH_RETRY_AFTER_MAX=0.2)
+    def test_later_requests_are_not_held_for_an_hour(self):
+        self.assertEqual(fetch(f"{self.base_url}/status/429/retry-after/3600").status_code, 429)
+        start = time.perf_counter()
+        self.assertEqual(fetch(f"{self.base_url}/img/1-0-120.png").status_code, 200)
+        self.assertLess(time.perf_counter() - start, 1)
+
+    def test_short_retry_after_holds_back_the_host(self):
+        self.assertEqual(self.try_start(), 0)
+        fetch_scheduler._finish(host_key(self.base_url), 'throttled', 0.1, retry_after=5)
+        self.assertAlmostEqual(self.try_start(), 5, delta=0.5)
+
+    def test_backoff_is_jittered_up_to_the_exponential_bound(self):
+        for attempt in range(4):
+            delays = [retry_delay(attempt) for _ in range(200)]
+            self.assertTrue(all(0 <= delay <= 0.01 * 2 ** attempt for delay in delays), attempt)
+            self.assertGreater(len(set(delays)), 1)
+
+    @override_settings(FETCH_BACKOFF_MAX=0.05)
+    def test_backoff_is_capped(self):
+        self.assertTrue(all(retry_delay(20) <= 0.05 for _ in range(50)))
+
+    @override_settings(FETCH_RETRY_AFTER_MAX=60)
+    def test_retry_after_is_a_minimum_delay(self):
+        self.assertEqual(retry_delay(0, 5), 5)
+        self.assertIsNone(retry_delay(0, 61))
+
+class RetryAfterTests(SimpleTestCase):
+    def test_seconds(self):
+        self.assertEqual(retry_after_seconds('120'), 120)
+        self.assertEqual(retry_after_seconds(' 0 '), 0)
+
+    def test_http_date(self):
+        self.assertAlmostEqual(retry_after_seconds(formatdate(time.time() + 30, usegmt=True)), 30, delta=2)
+        self.assertEqual(retry_after_seconds(formatdate(time.time() - 30, usegmt=True)), 0) # already passed
+
+    def test_missing_or_unparseable(self):
+        for value in (None, '', '-5', '1.5', 'soon'):
+            self.assertIsNone(retry_after_seconds(value), value)
+
+@override_settings(FETCH_HOST_MAX_REQUESTS_PER_SECOND=20, FETCH_HOST_BURST=3, FETCH_HOST_INITIAL_CONCURRENCY=10)
+class TokenBucketTests(FixtureSiteTestCase):
+    def test_burst_then_rate_limited(self):
+        self.assertEqual([self.try_start() for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(self.try_start(), 1 / 20, delta=0.01) # until the next token
+        time.sleep(0.06)
+        self.assertEqual(self.try_start(), 0)
+
+    def test_requests_are_spaced_out(self):
+        start = time.perf_counter()
+        for number in range(7):
+            fetch(f"{self.base_url}/img/1-{number}-120.png")
+        self.assertGreaterEqual(time.perf_counter() - start, (7 - 3) / 20 * 0.9) # 3 at once, then 20 a second
+
+@override_settings(FETCH_MAX_RETRIES=0, FETCH_CIRCUIT_BREAKER_FAILURES=3, FETCH_CIRCUIT_BREAKER_COOLDOWN=0.2, FETCH_HOST_MAX_REQUESTS_PER_SECOND=0)
+class CircuitBreakerTests(FixtureSiteTestCase):
+    def open_circuit(self):
+        for _ in range(3):
+            self.assertEqual(fetch(f"{self.base_url}/status/503").status_code, 503)
+
+    def test_opens_after_failures_in_a_row(self):
+        fetch(f"{self.base_url}/status/503")
+        fetch(f"{self.base_url}/status/503")
+        fetch(f"{self.base_url}/img/1-0-120.png") # a success starts the count again
+        fetch(f"{self.base_url}/status/503")
+        fetch(f"{self.base_url}/status/503")
+        fetch(f"{self.base_url}/img/1-0-120.png")
+
+        opened = counter_value('fetch_circuit_opened')
+        self.open_circuit()
+        self.assertEqual(counter_value('fetch_circuit_opened'), opened + 1)
+        with self.assertRaises(HostCircuitOpen):
+            fetch(f"{self.base_url}/img/1-0-120.png")
+
+    def test_throttling_does_not_open_it(self):
+        for _ in range(5):
+            fetch(f"{self.base_url}/status/503/retry-after/0") # come back later, rather than broken
+        self.assertEqual(fetch(f"{self.base_url}/img/1-0-120.png").status_code, 200)
+
+    def test_half_open_lets_one_request_through(self):
+        self.open_circuit()
+        time.sleep(0.25)
+        self.assertEqual(self.try_start(), 0) # the trial request
+        self.assertEqual(self.try_start(), fetch_scheduler.SLOT_POLL_SECONDS) # everything else waits for it
+
+    def test_closes_when_the_trial_request_succeeds(self):
+        self.open_circuit()
+        time.sleep(0.25)
+        self.assertEqual(fetch(f"{self.base_url}/img/1-0-120.png").status_code, 200)
+        self.assertEqual(self.host_state().open_until, 0)
+        self.assertEqual([self.try_start() for _ in range(2)], [0, 0]) # no longer one at a time
+
+    def test_reopens_when_the_trial_request_fails(self):
+        self.open_circuit()
+        time.sleep(0.25)
+        self.assertEqual(fetch(f"{self.base_url}/status/503").status_code, 503)
+        with self.assertRaises(HostCircuitOpen):
+            fetch(f"{self.base_url}/img/1-0-120.png")
+
+@override_settings(FETCH_HOST_MAX_REQUESTS_PER_SECOND=0, IMAGE_TRANSCODING=False)
+class RefreshSearchImagesTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.site = FixtureSite(images_per_page=2, srcset_variants=3, lazy_fraction=0, redirect_hops=0, slow_fraction=0, oversized_fraction=0, data_uris=0)
+        cls.site.start()
+        cls.addClassCleanup(cls.site.stop)
+
+    def setUp(self):
+        self.search = Search.objects.create(url='fixture')
+        self.page_url = self.site.page_url(1)
+
+    def refresh(self, mark_vanished=False):
+        return refresh_search_images(self.search, self.page_url, self.site.page_html(1), mark_vanished)
+
+    def test_new_images_are_downloaded_once(self):
+        requests_before = self.site.requests_served
+        counts = self.refresh()
+        self.assertEqual(counts['new'], 2)
+        self.assertEqual(self.site.requests_served - requests_before, 2 * 4) # src and the 3 srcset sizes of each tag, and no second download of the chosen one
+        biggest = self.site.image_width * 3
+        self.assertEqual(sorted(Image.objects.filter(search=self.search).values_list('url', flat=True)),
+                         [f"{self.site.base_url}/img/1-{number}-{biggest}.png" for number in range(2)])
+
+    def test_browser_only_images_are_not_counted_as_removed(self):
+        self.refresh()
+        gone = make_image(self.search, b'gone from the html', f"{self.site.base_url}/img/9-0-120.png")
+        browser_only = make_image(self.search, b'added by a script', f"{self.site.base_url}/img/9-1-120.png", found_by=FOUND_BY_BROWSER)
+        screen_shot = make_image(self.search, b'svg screen shot', '(screen shot)', found_by=FOUND_BY_BROWSER)
+
+        counts = self.refresh(mark_vanished=True)
+        self.assertEqual((counts['new'], counts['unchanged'], counts['removed'], counts['not_checked']), (0, 2, 1, 2))
+        self.assertIsNotNone(Image.objects.get(pk=gone.pk).vanished_at)
+        self.assertIsNone(Image.objects.get(pk=browser_only.pk).vanished_at)
+        self.assertIsNone(Image.objects.get(pk=screen_shot.pk).vanished_at)
+
+# A TransactionTestCase, since vacuuming can't happen inside the transaction a TestCase wraps each test in
+@override_settings(RETENTION_MAX_SEARCH_AGE_DAYS=None, RETENTION_MAX_BYTES_PER_HOST=None)
+class PurgeReclaimTests(TransactionTestCase):
+    def setUp(self):
+        self.search = Search.objects.create(url='example.com')
+        for number in range(40):
+            make_image(self.search, os.urandom(20000), f"https://example.com/img/{number}.png")
+
+    def free_pages(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA freelist_count')
+            return cursor.fetchone()[0]
+
+    def purge(self, *args):
+        output = io.StringIO()
+        call_command('purge_images', '--max-total-bytes', '0', '--pause', '0', *args, stdout=output)
+        return output.getvalue()
+
+    def test_space_is_only_reclaimed_when_asked_for(self):
+        output = self.purge()
+        self.assertEqual(Image.objects.count(), 0)
+        self.assertNotIn('Reclaimed', output)
+        self.assertGreater(self.free_pages(), 100)
+
+    def test_sqlite_reclaims_incrementally_in_chunks(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest("SQLite only")
+        self.purge()
+        self.assertEqual(reclaim_storage(chunk_pages=50), 'PRAGMA incremental_vacuum(50)')
+        self.assertEqual(self.free_pages(), 0)
+
+    def test_reclaim_option(self):
+        output = self.purge('--reclaim')
+        self.assertIn('Reclaimed storage with', output)
+        self.assertEqual(self.free_pages(), 0)
+
+@override_settings(MAX_REDIRECTS=4, FETCH_HOST_MAX_REQUESTS_PER_SECOND=0)
+class RedirectTests(FixtureSiteTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.site.redirect_hops = 3
+        self.site.relative_redirects = False
+        self.site.redirect_status = 302
+
+    def test_follows_the_chain_and_caches_where_it_ends(self):
+        final_url, response = fetch_page(self.site.page_url(1))
+        self.assertEqual(final_url, f"{self.base_url}/page/1.html")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(cached_final_url(self.site.page_url(1)), (final_url, 3))
+
+        requests_before = self.site.requests_served
+        skipped = counter_value('redirect_hops_skipped')
+        self.assertEqual(fetch_page(self.site.page_url(1))[0], final_url)
+        self.assertEqual(self.site.requests_served - requests_before, 1) # straight to the cached final URL
+        self.assertEqual(counter_value('redirect_hops_skipped'), skipped + 3)
+
+    def test_relative_locations_are_resolved(self):
+        self.site.relative_redirects = True
+        final_url, response = fetch_page(self.site.page_url(2))
+        self.assertEqual(final_url, f"{self.base_url}/page/2.html")
+        self.assertIn(b'Fixture page 2', response.content)
+
+    def test_query_string_is_kept(self):
+        for relative in (False, True):
+            self.site.relative_redirects = relative
+            url = add_scheme(self.site.page_url(3).replace('http://', '') + '?b=2&a=1')
+            self.assertEqual(fetch_page(url)[0], f"{self.base_url}/page/3.html?b=2&a=1", relative)
+
+    def test_loop_is_detected(self):
+        with self.assertRaisesMessage(RedirectError, 'Redirect loop'):
+            fetch_page(f"{self.base_url}/loop/3/0")
+        with self.assertRaisesMessage(RedirectError, 'Redirect loop'):
+            fetch_page(f"{self.base_url}/loop/1/0") # redirects to itself
+
+    def test_max_redirects(self):
+        self.site.redirect_hops = 4
+        self.assertEqual(fetch_page(self.site.page_url(4))[0], f"{self.base_url}/page/4.html")
+        self.site.redirect_hops = 5
+        with self.assertRaisesMessage(RedirectError, 'Too many redirects'):
+            fetch_page(self.site.page_url(4))
+        with self.assertRaisesMessage(RedirectError, 'Too many redirects'):
+            fetch_page(f"{self.base_url}/loop/50/0") # a loop too long to notice before the limit
+
+    def test_stale_cached_final_url_is_dropped(self):
+        url = self.site.page_url(5)
+        for stale_url in (f"{self.base_url}/status/404", self.site.page_url(6)): # gone, or redirecting somewhere else now
+            remember_final_url([url, stale_url], [301])
+            final_url, response = fetch_page(url)
+            self.assertEqual(final_url, f"{self.base_url}/page/5.html")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(cached_final_url(url), (final_url, 3)) # replaced by where it goes now
+
+    @override_settings(FETCH_MAX_RETRIES=0)
+    def test_unreachable_cached_final_url_is_dropped(self):
+        url = self.site.page_url(5)
+        remember_final_url([url, "http://127.0.0.1:1/page/5.html"], [301]) # nothing listens on port 1
+        final_url, response = fetch_page(url)
+        self.assertEqual(final_url, f"{self.base_url}/page/5.html")
+        self.assertEqual(cached_final_url(url), (final_url, 3))
+
+    @override_settings(REDIRECT_TEMPORARY_CACHE_TIMEOUT=0) # i.e. expired at once
+    def test_only_permanent_redirects_are_cached_for_long(self):
+        self.assertEqual(fetch_page(self.site.page_url(6))[0], f"{self.base_url}/page/6.html")
+        self.assertIsNone(cached_final_url(self.site.page_url(6))) # 302s
+        for status in (301, 308):
+            self.site.redirect_status = status
+            final_url = fetch_page(self.site.page_url(6))[0]
+            self.assertEqual(cached_final_url(self.site.page_url(6)), (final_url, 3), status)
+            cache.clear()
+        remember_final_url(['http://a.example/', 'http://b.example/', 'http://c.example/'], [301, 307])
+        self.assertIsNone(cached_final_url('http://a.example/')) # one temporary hop is enough
+
+    def test_error_responses_are_not_cached(self):
+        url = f"{self.base_url}/redirect/1/page/x.html" # not a page number, so no redirect: a 404
+        self.assertEqual(fetch_page(url)[1].status_code, 404)
+        self.assertIsNone(cached_final_url(url))
+
+    @unittest.skipIf(httpx is None, "needs httpx")
+    async def test_async_fetch_page(self):
+        self.site.relative_redirects = True
+        async with httpx.AsyncClient() as client:
+            final_url, response = await async_fetch_page(client, self.site.page_url(7) + '?a=1')
+            self.assertEqual(final_url, f"{self.base_url}/page/7.html?a=1")
+            self.assertEqual(response.status_code, 200)
+            with self.assertRaisesMessage(RedirectError, 'Redirect loop'):
+                await async_fetch_page(client, f"{self.base_url}/loop/2/1")
+
+    @unittest.skipIf(httpx is None, "needs httpx")
+    @override_settings(FETCH_MAX_RETRIES=0)
+    async def test_async_unreachable_cached_final_url_is_dropped(self):
+        url = self.site.page_url(8)
+        remember_final_url([url, "http://127.0.0.1:1/page/8.html"], [301])
+        async with httpx.AsyncClient() as client:
+            final_url, response = await async_fetch_page(client, url)
+        self.assertEqual(final_url, f"{self.base_url}/page/8.html")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(cached_final_url(url), (final_url, 3))
+
+class NormalizeUrlTests(SimpleTestCase):
+    def test_default_ports_are_dropped(self):
+        self.assertEqual(normalize_url('http://example.com:80/a'), 'http://example.com/a')
+        self.assertEqual(normalize_url('https://example.com:443/a'), 'https://example.com/a')
+        self.assertEqual(normalize_url('https://example.com:80/a'), 'https://example.com:80/a')
+        self.assertEqual(normalize_url('http://example.com:8080/a'), 'http://example.com:8080/a')
+
+    def test_query_parameters_are_sorted(self):
+        self.assertEqual(normalize_url('https://example.com/?b=2&a=1&a=0&c='), 'https://example.com/?a=0&a=1&b=2&c=')
+        self.assertEqual(normalize_url('https://example.com/?b=2&a=1'), normalize_url('https://example.com/?a=1&b=2'))
+
+    def test_scheme_and_host_case_but_not_path_case(self):
+        self.assertEqual(normalize_url('HTTPS://WWW.Example.COM/Path/Page.html'), 'https://www.example.com/Path/Page.html')
+
+    def test_empty_path_and_fragment(self):
+        self.assertEqual(normalize_url('https://example.com'), 'https://example.com/')
+        self.assertEqual(normalize_url('https://example.com/a#top'), 'https://example.com/a')
+
+    def test_too_long_for_final_url(self):
+        self.assertEqual(normalize_url('https://example.com/' + 'a' * 300), '')
+
+@override_settings(SCRAPE_REUSE_WINDOW=600)
+class FindReusableSearchTests(TestCase):
+    def make_search(self, age, refreshed_age=None, **fields):
+        search = Search.objects.create(url='example.com', final_url='https://www.example.com/', timing_summary={'total_seconds': 2}, **fields)
+        now = timezone.now()
+        Search.objects.filter(pk=search.pk).update(timestamp=now - timedelta(seconds=age),
+                                                   last_refreshed=None if refreshed_age is None else now - timedelta(seconds=refreshed_age))
+        return search
+
+    def test_recent_search_is_reused(self):
+        search = self.make_search(age=60)
+        self.assertEqual(find_reusable_search('https://WWW.example.com:443'), search)
+
+    def test_search_older_than_the_window_is_not(self):
+        self.make_search(age=601)
+        self.assertIsNone(find_reusable_search('https://www.example.com/'))
+
+    def test_recently_refreshed_search_is_reused(self):
+        search = self.make_search(age=10000, refreshed_age=60)
+        self.assertEqual(find_reusable_search('https://www.example.com/'), search)
+        Search.objects.filter(pk=search.pk).update(last_refreshed=timezone.now() - timedelta(seconds=601))
+        self.assertIsNone(find_reusable_search('https://www.example.com/'))
+
+    def test_most_recent_original_finished_search_is_picked(self):
+        older = self.make_search(age=300)
+        newer = self.make_search(age=100)
+        self.make_search(age=50, reused_from=older) # a reuse is never reused itself
+        unfinished = self.make_search(age=10)
+        Search.objects.filter(pk=unfinished.pk).update(timing_summary=None) # still scraping
+        self.assertEqual(find_reusable_search('https://www.example.com/'), newer)
+
+    @override_settings(SCRAPE_REUSE_WINDOW=0)
+    def test_window_of_zero_turns_reuse_off(self):
+        self.make_search(age=0)
+        self.assertIsNone(find_reusable_search('https://www.example.com/'))
+
+@override_settings(SCRAPE_REUSE_WINDOW=600, SCRAPE_WITH_WEBDRIVER=False, IMAGE_TRANSCODING=False, FETCH_HOST_MAX_REQUESTS_PER_SECOND=0)
+class ScrapeReuseTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.site = FixtureSite(images_per_page=3, srcset_variants=1, lazy_fraction=0, redirect_hops=1, slow_fraction=0, oversized_fraction=0, data_uris=0)
+        cls.site.start()
+        cls.addClassCleanup(cls.site.stop)
+
+    def setUp(self):
+        cache.clear()
+
+    def scrape(self, url, force_fresh=False):
+        response = self.client.post('/scrape_web_page/', {'url': url, **({'force_fresh': 'on'} if force_fresh else {})})
+        self.assertEqual(response.status_code, 302)
+        return Search.objects.get(pk=response['Location'].rstrip('/').split('/')[-1])
+
+    def test_second_scrape_reuses_the_first(self):
+        source = self.scrape(self.site.page_url(1))
+        self.assertIsNone(source.reused_from)
+        self.assertEqual(Image.objects.filter(search=source).count(), 3)
+
+        requests_before, reuses = self.site.requests_served, counter_value('scrape_reuses')
+        search = self.scrape(self.site.page_url(1))
+        self.assertEqual(search.reused_from, source)
+        self.assertEqual(self.site.requests_served, requests_before) # where it redirects to was cached, so not even the page was fetched
+        self.assertEqual(counter_value('scrape_reuses'), reuses + 1)
+        self.assertFalse(Image.objects.filter(search=search).exists())
+
+    def test_different_url_for_the_same_page_is_reused(self):
+        source = self.scrape(self.site.page_url(2) + '?b=2&a=1')
+        search = self.scrape(f"{self.site.base_url}/page/2.html?a=1&b=2#images") # no redirect, parameters in another order
+        self.assertEqual(search.reused_from, source)
+
+    def test_scrape_bumps_the_cache_version_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            search = self.scrape(self.site.page_url(5), force_fresh=True)
+        self.assertEqual(Image.objects.filter(search=search).count(), 3)
+        self.assertEqual(len([query for query in queries.captured_queries if 'SET "content_version"' in query['sql']]), 1)
+
+    def test_force_fresh_scrapes_again(self):
+        source = self.scrape(self.site.page_url(3))
+        requests_before = self.site.requests_served
+        search = self.scrape(self.site.page_url(3), force_fresh=True)
+        self.assertIsNone(search.reused_from)
+        self.assertNotEqual(search, source)
+        self.assertGreater(self.site.requests_served, requests_before)
+        self.assertEqual(Image.objects.filter(search=search).count(), 3)
+
+    def test_refreshed_source_is_reused(self):
+        source = self.scrape(self.site.page_url(4))
+        Search.objects.filter(pk=source.pk).update(timestamp=timezone.now() - timedelta(days=1))
+        self.assertIsNone(self.scrape(self.site.page_url(4)).reused_from) # too old, so scraped again
+
+        Search.objects.filter(final_url=source.final_url).update(timestamp=timezone.now() - timedelta(days=1)) # both too old now
+        self.client.post(f'/refresh/{source.id}/')
+        self.assertEqual(self.scrape(self.site.page_url(4)).reused_from, source)
+
+class SearchImagesTests(TestCase):
+    databases = REPLICA_DATABASES
+
+    def setUp(self):
+        search = Search.objects.create(url='example.com')
+        self.urls = ["https://example.com/photos/2023/campus-" + 'x' * 70 + "-Sunset.jpg?w=800", # display filename cut to 60 characters
+                     "https://example.com/logos/umich-logo.png", "https://other.com/img/team-photo.png"]
+        for url in self.urls:
+            make_image(search, os.urandom(100), url, **describe_image_url(url))
+
+    def found(self, **query):
+        response = self.client.get('/search_images/', query)
+        return sorted(image.url for image in response.context['images'])
+
+    def test_filename_is_matched_anywhere_in_the_path(self):
+        self.assertEqual(self.found(filename='sunset'), [self.urls[0]]) # past where the display filename is cut
+        self.assertEqual(self.found(filename='LOGO'), [self.urls[1]])
+        self.assertEqual(self.found(filename='photo'), [self.urls[0], self.urls[2]]) # a directory, and mid-filename
+        self.assertEqual(self.found(filename='photo', host='other.com'), [self.urls[2]])
+        self.assertEqual(self.found(filename='w=800'), []) # not the query string
+
+class GalleryCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.search = Search.objects.create(url='example.com')
+        for number in range(3):
+            make_image(self.search, os.urandom(100), f"https://example.com/img/{number}.png")
+
+    def version(self):
+        return Search.objects.get(pk=self.search.pk).content_version
+
+    def version_bumps(self, queries):
+        return [query['sql'] for query in queries.captured_queries if 'SET "content_version"' in query['sql']]
+
+    def gallery(self):
+        stats = cache_stats()['gallery']
+        content = self.client.get(f'/success/{self.search.id}/?stream=0').content.decode()
+        hit = cache_stats()['gallery']['hits'] > stats['hits']
+        return content.count('class="image-container"'), hit
+
+    def test_keys_include_the_version_and_the_canonical_variant(self):
+        variant = gallery_variant({'sort': 'Width', 'format': ' PNG', 'page': '2'}) # unrelated parameters are ignored
+        self.assertEqual(variant, gallery_variant({'format': 'png', 'sort': 'width'}))
+        self.assertNotEqual(variant, gallery_variant({'format': 'png'}))
+        self.assertNotEqual(gallery_key(1, 1, variant), gallery_key(1, 2, variant))
+        self.assertNotEqual(gallery_key(1, 1, variant), gallery_key(2, 1, variant))
+        self.assertNotEqual(gallery_key(1, 1, variant), gallery_count_key(1, 1, variant))
+
+    def test_saving_or_deleting_an_image_bumps_the_version(self):
+        version = self.version()
+        image = make_image(self.search, b'new', 'https://example.com/img/new.png')
+        self.assertEqual(self.version(), version + 1)
+        image.delete()
+        self.assertEqual(self.version(), version + 2)
+
+    def test_batch_bumps_each_search_once(self):
+        other = Search.objects.create(url='other.com')
+        version, other_version = self.version(), Search.objects.get(pk=other.pk).content_version
+        with CaptureQueriesContext(connection) as queries, invalidation_batch():
+            for number in range(5):
+                make_image(self.search, os.urandom(50), f"https://example.com/img/batch-{number}.png")
+                make_image(other, os.urandom(50), f"https://other.com/img/batch-{number}.png")
+            with invalidation_batch(): # nested: left to the outer batch
+                make_image(self.search, b'nested', 'https://example.com/img/nested.png')
+            self.assertEqual(self.version(), version) # not until the batch ends
+        self.assertEqual(len(self.version_bumps(queries)), 1)
+        self.assertEqual(self.version(), version + 1)
+        self.assertEqual(Search.objects.get(pk=other.pk).content_version, other_version + 1)
+
+    def test_stale_gallery_is_not_served(self):
+        self.assertEqual(self.gallery(), (3, False))
+        self.assertEqual(self.gallery(), (3, True))
+
+        image = make_image(self.search, b'added', 'https://example.com/img/added.png')
+        self.assertEqual(self.gallery(), (4, False))
+        image.delete()
+        self.assertEqual(self.gallery(), (3, False))
+
+        Search.objects.filter(pk=self.search.pk).update(content_version=F('content_version') + 1) # as another process would
+        self.assertEqual(self.gallery(), (3, False))
+        self.assertEqual(self.gallery(), (3, True))
+
+class RetentionTests(TestCase):
+    def make_search(self, age_days, refreshed_days=None, **fields):
+        search = Search.objects.create(url='example.com', **fields)
+        now = timezone.now()
+        Search.objects.filter(pk=search.pk).update(timestamp=now - timedelta(days=age_days),
+                                                   last_refreshed=None if refreshed_days is None else now - timedelta(days=refreshed_days))
+        return search
+
+    def test_chunks_are_deleted_without_a_query_per_image(self):
+        searches = [Search.objects.create(url=f"site{number}.com") for number in range(2)]
+        for number in range(50):
+            make_image(searches[number % 2], os.urandom(10), f"https://example.com/img/{number}.png")
+        versions = [search.content_version for search in Search.objects.filter(pk__in=[search.pk for search in searches]).order_by('pk')]
+
+        with CaptureQueriesContext(connection) as queries:
+            deleted, freed = delete_images_in_chunks(Image.objects.all(), chunk_size=25, pause=0)
+        self.assertEqual((deleted, freed), (50, 500))
+        self.assertFalse(Image.objects.exists())
+        self.assertLessEqual(len(queries.captured_queries), 2 * 4 + 1) # per chunk: ids, bytes, DELETE, one version bump
+        self.assertEqual([search.content_version for search in Search.objects.filter(pk__in=[search.pk for search in searches]).order_by('pk')],
+                         [version + 2 for version in versions]) # each search had images in both chunks
+
+    def test_max_age_counts_refreshes_and_reuses(self):
+        old = self.make_search(age_days=40)
+        self.make_search(age_days=40, refreshed_days=1)
+        reused = self.make_search(age_days=40)
+        self.make_search(age_days=1, reused_from=reused)
+        old_reuse = self.make_search(age_days=35, reused_from=old)
+        self.make_search(age_days=1)
+        self.assertEqual(sorted(searches_past_max_age(30)), sorted([old.pk, old_reuse.pk]))
+
+    def test_quota_skips_searches_holding_nothing(self):
+        source = self.make_search(age_days=5, last_viewed=timezone.now())
+        make_image(source, os.urandom(100), 'https://example.com/a.png')
+        self.make_search(age_days=10, reused_from=source) # viewed least recently, but its images are source's
+        other = self.make_search(age_days=3)
+        make_image(other, os.urandom(100), 'https://example.com/b.png')
+        self.assertEqual(searches_over_quota(150), [other.pk])
+
+    def test_export_command_exports_the_reused_scrape(self):
+        source = self.make_search(age_days=1)
+        data = os.urandom(300)
+        make_image(source, data, 'https://example.com/a.png')
+        search = self.make_search(age_days=0, reused_from=source)
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'export.zip')
+            call_command('export_search', search.id, output, stdout=io.StringIO())
+            with zipfile.ZipFile(output) as archive:
+                self.assertIn(data, [archive.read(name) for name in archive.namelist()])
+
+# A noisy JPEG, big enough that re-encoding it is worth it and takes a moment
+def make_jpeg(width):
+    output = io.BytesIO()
+    PILImage.effect_noise((width, width * 3 // 4), 64).convert('RGB').save(output, format='JPEG', quality=98)
+    return output.getvalue()
+
+@override_settings(IMAGE_TRANSCODING=True, IMAGE_TRANSCODE_FORMAT='WEBP', IMAGE_TRANSCODE_MIN_BYTES=1000, IMAGE_TRANSCODE_KEEP_ORIGINAL=False)
+class TranscodeTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.jpegs = [make_jpeg(200 + 10 * number) for number in range(4)]
+
+    def batch(self, jpegs=None):
+        return transcode_batch_for_storage([(data, 'jpeg', 'image/jpeg') for data in (jpegs or self.jpegs)])
+
+    def test_batch_is_transcoded(self):
+        results = self.batch() + transcode_batch_for_storage([(b'tiny', 'jpeg', 'image/jpeg'), (b'<svg/>', 'svg', 'image/svg+xml')])
+        self.assertEqual(results[-2:], [None, None]) # too small, and a format that isn't transcoded
+        for data, fields in zip(self.jpegs, results):
+            self.assertEqual((fields['image_format'], fields['content_type']), ('webp', 'image/webp'))
+            self.assertEqual(fields['bytes_saved'], len(data) - len(fields['image']))
+            self.assertNotIn('original', fields)
+
+    @override_settings(IMAGE_TRANSCODE_KEEP_ORIGINAL=True)
+    def test_keeping_the_original_saves_nothing(self):
+        fields = self.batch()[0]
+        self.assertEqual(fields['original'], self.jpegs[0])
+        self.assertEqual(fields['bytes_saved'], 0) # both are stored, so storage grew
+
+    @override_settings(IMAGE_TRANSCODING=False)
+    def test_off(self):
+        self.assertEqual(self.batch(), [None] * len(self.jpegs))
+
+    @override_settings(IMAGE_TRANSCODE_TIMEOUT=0)
+    def test_timed_out_image_is_stored_as_downloaded(self):
+        timeouts, fallbacks = counter_value('transcode_timeouts'), counter_value('transcode_fallbacks')
+        results = self.batch([make_jpeg(2000)])
+        self.assertEqual(results, [None])
+        self.assertEqual(counter_value('transcode_timeouts'), timeouts + 1)
+        self.assertEqual(counter_value('transcode_fallbacks'), fallbacks) # not transcoded again in the request
+
+    def test_broken_pool_is_started_again(self):
+        pool = transcode_pool()
+        with self.assertRaises(BrokenProcessPool):
+            pool.submit(os._exit, 1).result(timeout=30) # a worker dying breaks the whole pool
+        self.assertEqual(self.batch()[0]['image_format'], 'webp')
+        self.assertIsNot(transcode_pool(), pool)
@@ -0,0 +1,148 @@
+import atexit # To shut the worker processes down with the server
+from io import BytesIO # Handle image data in memory
+from concurrent.futures import ProcessPoolExecutor, TimeoutError # Transcoding is CPU bound, so it runs in worker processes
+from concurrent.futures.process import BrokenProcessPool # A worker died, so the pool has to be started again
+from PIL import Image as PILImage, features # For re-encoding images, and checking which encoders are available
+from django.conf import settings # For the transcoding policy set in settings.py
+from .metrics import incr # Counts of transcodes that timed out or fell back to the request
+
+# Optional ingest-time transcoding of images to more compact formats (settings.IMAGE_TRANSCODING).
+#
+# * Photos (JPEG, BMP, TIFF) are re-encoded to settings.IMAGE_TRANSCODE_FORMAT ('WEBP', 'AVIF' or 'JPEG')
+#   at settings.IMAGE_TRANSCODE_QUALITY.
+# * PNGs (including the screen shot crops of inline SVGs) and still GIFs are recompressed losslessly as
+#   optimized PNGs.
+# * Animated images, SVG and formats that are already compact (WebP, AVIF) are left alone.
+#
+# The compact version is only used if it's actually smaller. A batch of images (e.g. one database
+# batch of a scrape) is transcoded in parallel in the worker pool. An image that takes longer than
+# settings.IMAGE_TRANSCODE_TIMEOUT is stored as downloaded, rather than transcoded a second time in
+# the request while its worker is still busy with it. The worker processes only import PIL, so
+# they don't need Django set up.
+
+PHOTO_FORMATS = ('jpeg', 'bmp', 'tiff')
+LOSSLESS_FORMATS = ('png', 'gif')
+
+CONTENT_TYPES = {'webp': 'image/webp', 'avif': 'image/avif', 'jpeg': 'image/jpeg', 'png': 'image/png'}
+
+# Re-encodes image_data (whose sniffed format is image_format) per the transcoding policy.
+# Returns (new_image_data, new_content_type, new_image_format), or None if the image should be
+# stored as it is (not a format we transcode, can't be decoded, or the result isn't smaller).
+# Runs in a worker process, so it only takes and returns plain picklable values.
+def transcode_image(image_data, image_format, target_format, quality):
+    if image_format not in PHOTO_FORMATS and image_format not in LOSSLESS_FORMATS:
+        return None
+
+    try:
+        with PILImage.open(BytesIO(image_data)) as pil_image:
+            if getattr(pil_image, 'n_frames', 1) > 1:
+                return None # don't flatten animations
+
+            output = BytesIO()
+            if image_format in PHOTO_FORMATS:
+                new_format = target_format.lower()
+                if new_format == 'avif' and not features.check('avif'):
+                    new_format = 'webp' # this Pillow wasn't built with AVIF support
+                if new_format == 'jpeg' and pil_image.mode not in ('RGB', 'L'):
+                    pil_image = pil_image.convert('RGB')
+                if new_format == 'jpeg':
+                    pil_image.save(output, format='JPEG', quality=quality, optimize=True)
+                else:
+                    pil_image.save(output, format=new_format.upper(), quality=quality)
+            else:
+                new_format = 'png'
+                pil_image.save(output, format='PNG', optimize=True) # lossless
+    except Exception:
+        return None # can't decode or encode it, so keep what we downloaded
+
+    new_image_data = output.getvalue()
+    if len(new_image_data) >= len(image_data):
+        return None
+    return new_image_data, CONTENT_TYPES[new_format], new_format
+
+_pool = None
+
+# Returns the shared pool of transcoding worker processes, starting it the first time it's needed
+# (and again after a worker died, which breaks the whole pool)
+def transcode_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=getattr(settings, 'IMAGE_TRANSCODE_WORKERS', 2))
+        atexit.register(_pool.shutdown, wait=False)
+    return _pool
+
+def _discard_pool(pool):
+    global _pool
+    if _pool is pool:
+        _pool = None
+        pool.shutdown(wait=False)
+
+# Starts transcode_image(*arguments) in the pool. Returns (pool, future), or None if the pool can't
+# take it even after being started again.
+def _submit(arguments):
+    for _ in range(2):
+        pool = transcode_pool()
+        try:
+            return pool, pool.submit(transcode_image, *arguments)
+        except BrokenProcessPool:
+            _discard_pool(pool)
+    return None
+
+# Waits for a transcode started by _submit(). Returns what transcode_image() did, or None if it
+# took too long (the image is stored as downloaded).
+def _result(submitted, arguments, timeout):
+    if submitted is None:
+        incr('transcode_fallbacks')
+        return transcode_image(*arguments)
+    pool, future = submitted
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        future.cancel() # if it hasn't started yet
+        incr('transcode_timeouts')
+        return None
+    except BrokenProcessPool: # a worker died (e.g. killed for using too much memory), so start a new pool next time
+        _discard_pool(pool)
+        incr('transcode_fallbacks')
+        return transcode_image(*arguments)
+
+# Applies the transcoding policy to a batch of images about to be stored, as (image_data,
+# image_format, content_type) tuples, transcoding them all at once in the worker pool. Returns a
+# list with, for each image, None when transcoding is off or doesn't help, otherwise a dict of the
+# Image fields to store instead of the original: image, content_type, image_format, byte_size,
+# original_byte_size, bytes_saved, and (when settings.IMAGE_TRANSCODE_KEEP_ORIGINAL is set) original
+# and original_content_type. bytes_saved is what the database is spared: nothing if the original is
+# kept too.
+def transcode_batch_for_storage(images):
+    if not getattr(settings, 'IMAGE_TRANSCODING', False):
+        return [None] * len(images)
+
+    target_format, quality = getattr(settings, 'IMAGE_TRANSCODE_FORMAT', 'WEBP'), getattr(settings, 'IMAGE_TRANSCODE_QUALITY', 80)
+    min_bytes = getattr(settings, 'IMAGE_TRANSCODE_MIN_BYTES', 0) # smaller ones aren't worth the CPU
+    arguments = [(image_data, image_format, target_format, quality) if len(image_data) >= min_bytes else None
+                 for image_data, image_format, content_type in images]
+    submitted = [_submit(image_arguments) if image_arguments else None for image_arguments in arguments]
+
+    timeout = getattr(settings, 'IMAGE_TRANSCODE_TIMEOUT', 30)
+    keep_original = getattr(settings, 'IMAGE_TRANSCODE_KEEP_ORIGINAL', False)
+    batch_fields = []
+    for (image_data, image_format, content_type), image_arguments, image_submitted in zip(images, arguments, submitted):
+        result = _result(image_submitted, image_arguments, timeout) if image_arguments else None
+        if result is None:
+            batch_fields.append(None)
+            continue
+
+        new_image_data, new_content_type, new_image_format = result
+        fields = {
+            'image': new_image_data,
+            'content_type': new_content_type,
+            'image_format': new_image_format,
+            'byte_size': len(new_image_data),
+            'original_byte_size': len(image_data),
+            'bytes_saved': 0 if keep_original else len(image_data) - len(new_image_data),
+        }
+        if keep_original:
+            fields['original'] = image_data
+            fields['original_content_type'] = content_type[:64]
+        batch_fields.append(fields)
+    return batch_fields
@@ -1,69 +1,72 @@
 import requests # Handles http requests
 import base64 # base64 encoding for sending BLOBs to template as text
-import sys # for debug flushes
+import logging # for leveled log messages as the program runs
 import math # used for floor() and ceil() functions
 import time # used for time.sleep() to delay after loading web page
-import hashlib # used for a checksum stored in the Image table
+import datetime # used for the date range in the image search
+import asyncio # For the async scrape (scrape_web_page_async)
+import hashlib # For checking whether a refreshed image is one we already have
 from io import BytesIO # Handle binary data to save img_data to database
-from .models import Image, Search # Search and Image models (objects for database)
+from .models import FOUND_BY_BROWSER, FOUND_IN_HTML, Image, Search # Search and Image models (objects for database)
+from .image_metadata import compute_image_metadata, describe_image_url # Precomputed metadata stored with each Image
+from .export import SearchExport, ExportTooLarge, parse_range_header # Streamed ZIP export of a search's images
+from .transcode import transcode_batch_for_storage # Optional ingest-time transcoding to compact formats
+from .database import reads_from_replica # Sends the listing and gallery views' reads to the read database
+from .retention import record_search_view # Last-viewed times for LRU eviction
+from .fetch_scheduler import fetch, async_fetch, HostCircuitOpen # Per-host rate limits, retries and circuit breaking for every request
+from .redirects import add_scheme, fetch_page, async_fetch_page, known_final_url, RedirectError # Follows redirect chains, caching where they end up
+from .reuse import find_reusable_search, normalize_url, reuse_search # Reuses a recent scrape of the same page
+from .metrics import incr, timer, record_stage, search_timing, timing_summary_for_storage, render_prometheus # Pipeline instrumentation
+from .caching import cache_stats, count_cache_lookup, get_or_compute, invalidate_search, invalidation_batch, gallery_key, gallery_count_key, gallery_timeout, listing_timeout, COUNTS_KEY, PAST_SEARCHES_KEY # Page caching
 from PIL import Image as PILImage # For raster based image manipulation
 from django.shortcuts import render, redirect # For rendering templates with context data and returning HTTP responses
+from django.urls import reverse # For redirecting back to a past search after refreshing it
+from django.template.loader import render_to_string # For rendering gallery chunks while streaming
 from django.conf import settings # To allow access to constants set in settings.py
+from django.core.cache import cache # For the cached gallery cards (see caching.py)
 from bs4 import BeautifulSoup # For parsing html content
-from urllib.parse import urljoin, urlparse # For combining relative references to full URL
-from django.http import HttpResponse # For determining HttpResponse types
+from urllib.parse import urljoin # For combining relative references to full URL
+from django.http import HttpResponse, StreamingHttpResponse # For determining HttpResponse types
+from django.core.handlers.asgi import ASGIRequest # Streamed responses need async iterators under ASGI
 from django.utils import timezone # For displaying timezone
+from django.db.models import F # For updating running totals in the database
+from django.db import transaction # For saving scraped images in batches
+from asgiref.sync import sync_to_async # For running database work from the async scrape
 from selenium import webdriver # for webscraping and screencapturing
 from selenium.webdriver.common.by import By
 
-# Used to output debug statements to the console as the program runs
-def debug(str):
-    print(f"DEBUG: {str}")
-    sys.stdout.flush()
-    return
+try:
+    import httpx # Async HTTP client for scrape_web_page_async (optional, pip install httpx)
+except ImportError:
+    httpx = None
+
+# Leveled logging for the scrape pipeline (configured by LOGGING in settings.py). Messages use %s
+# arguments rather than f-strings, so nothing is formatted when the level is turned off.
+logger = logging.getLogger(__name__)
 
 # Handler function to get_web_response for index view
 # Allows extraction of the final URL and the associated response, or handles and logs any errors that occur
 # during the process.
 def get_web_response_handler(request, url_with_scheme, url_entered):
-    # Get HTML content of the URL, but handle redirects manually, to update url to new location
+    # Get HTML content of the URL, following any redirects (see redirects.py), to update url to the final location
     try:
-        response = requests.get(url_with_scheme, allow_redirects=False)
+        url, response = fetch_page(url_with_scheme)
         response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        debug(f"Error trying to get {url_with_scheme}: {e}")
+    except (requests.exceptions.RequestException, HostCircuitOpen, RedirectError) as e:
+        logger.warning("Error trying to get %s: %s", url_with_scheme, e)
         return None, None, f"Failed to get page: {e}"
 
-    debug(f"in index(), returned from requests.get with response={response}")
+    logger.debug("in get_web_response_handler(), got %s from %s, response=%s", url, url_entered, response)
 
-    if response.status_code in {200,201}: # if status ok or created (kinda ok)
-        url = url_entered
-    elif response.status_code in {301,302,307,308}: # temporary or permanent redirect
-        url = response.headers['Location']
-        parsed_url = urlparse(url) 
-        scheme = parsed_url.scheme if parsed_url.scheme else 'http' # Figure out scheme (e.g. http)
-        url = f"{scheme}://{parsed_url.netloc}{parsed_url.path}" # Rebuild URL
-
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            debug(f"Error trying to redirect to {response.headers['Location']}: {e}")
-            return None, None, f"Failed to redirect from {url_entered}, to {url}: {e}"
- 
-        if response.status_code in {200,201}: # if redirected get() status ok or created (kinda ok)
-            debug(f"Successfully redirected to {url}")
-        else:
-            debug(f"Failed redirect to get {url}, status code {response.status_code}")
-            return None, None, f"Failed redirect to get {url_entered} HttpResponse:{response.status_code}"
-    else:
-        debug(f"Status code {response.status_code} trying to get {url_entered}")
-        return render(request, 'fail.html',{'error_message': f"Could not get {url_entered} HttpResponse:{response.status_code}"})
+    if response.status_code not in {200,201}: # if status not ok or created (kinda ok)
+        logger.warning("Status code %s trying to get %s", response.status_code, url_entered)
+        return None, None, f"Could not get {url_entered} HttpResponse:{response.status_code}"
     return url, response, None
 
 # The purpose of this function is to handle the srcset attribute of an img tag, extract the URL-size pairs, and select
 # the URL with the largest size that passes certain checks. It ensures that images with excessive sizes are not chosen
-# and that the selected URL is a valid image.
+# and that the selected URL is a valid image. Returns the URL, data, content type and validators of the chosen image
+# (or Nones), so it doesn't have to be downloaded again to store it.
 def pick_an_image_from_srcset(image_srcset, page_url):
     # an img srcset in html will list URLs of the same image in different sizes,
     # separated by commas, to allow picking the best size for a layout.
@@ -74,10 +77,35 @@ def pick_an_image_from_srcset(image_srcset, page_url):
     # check just the first and last urls, as they're probably in ascending or descending
     # order by size, so one or the other might fit our criteria. 
 
-    debug(f"In pick_an_image_from_srcset(), image_srcset={image_srcset} page_url={page_url}")
+    logger.debug("In pick_an_image_from_srcset(), image_srcset=%s page_url=%s", image_srcset, page_url)
+    srcset_start = time.perf_counter() # the srcset_selection stage includes fetching every candidate (each also timed as image_fetch)
 
     biggest_size = 0
-    biggest_url = None
+    biggest = (None, None, None, None)
+
+    for url_to_check in srcset_candidate_urls(image_srcset, page_url):
+        validators = {} # ETag and Last-Modified, for refreshing the search later
+        response_content, content_type = retrieve_and_validate_img_handler(url_to_check, validators)
+        if response_content is not None:
+            image_size_bytes = len(response_content)
+            
+            logger.debug("url_to_check=%s... was size=%s", url_to_check[:40], image_size_bytes)
+            # Update the biggest area and URL if necessary (only the biggest one's data is kept)
+            if image_size_bytes > biggest_size:
+                biggest_size = image_size_bytes
+                biggest = (url_to_check, response_content, content_type, validators)
+
+    record_stage('srcset_selection', time.perf_counter() - srcset_start)
+    if biggest[0] is None:
+        logger.debug("None of the images were suitable")
+        return biggest
+
+    logger.debug("Chose best size from srcset, img_url = %s, size=%s", biggest[0], biggest_size)
+    return biggest
+
+# Returns the URLs listed in an img srcset (full URLs, joined to page_url if they're relative)
+def srcset_candidate_urls(image_srcset, page_url):
+    candidate_urls = []
 
     # Brute force way to parse image_srcset, first break as left and right of ' ',
     # then if there's another comma, take just the portion right of the comma.
@@ -93,24 +121,8 @@ def pick_an_image_from_srcset(image_srcset, page_url):
         # Join the web page URL prefix to the image URL if the image URL is a relative link
         if not url_to_check.startswith('http') and not url_to_check.startswith('data:'):
             url_to_check = urljoin(page_url, url_to_check)
-
-        response_content, content_type = retrieve_and_validate_img_handler(url_to_check) 
-        if response_content is not None:
-            image_size_bytes = len(response_content)
-            
-            debug(f"url_to_check={url_to_check[:40]}... was size={image_size_bytes}")
-            # Update the biggest area and URL if necessary
-            if image_size_bytes > biggest_size:
-                biggest_size = image_size_bytes
-                biggest_url = url_to_check
-
-    if biggest_url is None:
-        debug(f"None of the images were suitable")
-        return
-
-    img_url = biggest_url
-    debug(f"Chose best size from srcset, img_url = {img_url}, size={biggest_size}")
-    return img_url
+        candidate_urls.append(url_to_check)
+    return candidate_urls
 
 # return everything after a given substring in a string
 def after_substr(string, substring):
@@ -120,19 +132,24 @@ def after_substr(string, substring):
     else:
         return ""
 
-# Retrieve the image data from the URL
-def retrieve_and_validate_img_handler(img_url):
+# Don't store images in database if over max size, currently 1024576.
+# It can handle bigger, but may affect performance at some level,
+# and that seems like a reasonable limit.
+MAXIMUM_IMAGE_SIZE_TO_SAVE = 2000000
 
-    # Don't store images in database if over max size, currently 1024576.
-    # It can handle bigger, but may affect performance at some level,
-    # and that seems like a reasonable limit.
-    maximum_size_to_save = 2000000
+# Retrieve the image data from the URL.
+# If a validators dict is passed, its 'etag' and 'last_modified' (if any) are sent to make it a
+# conditional GET, and it's filled in with the ones from the response, to store with the image.
+# If the image hasn't changed since (304 Not Modified), validators['not_modified'] is set and
+# (None, None) is returned.
+def retrieve_and_validate_img_handler(img_url, validators=None):
+    maximum_size_to_save = MAXIMUM_IMAGE_SIZE_TO_SAVE
 
     if img_url.split('/')[0] == 'data:image':
         # If img_url is simply data, like data:image/x-png;base64,iVBORw0KGgoAAAANSUh..., 
         # then that contains all the data we need without retrieving it from the web.
 
-        debug(f"Using data:image from URL")
+        logger.debug("Using data:image from URL")
     
         if len(img_url) > maximum_size_to_save: # Return None if too big
             return None, None       
@@ -146,75 +163,196 @@ def retrieve_and_validate_img_handler(img_url):
         return image_bytes, content_type
     else:
         try:
-            response = requests.get(img_url)
+            with timer('image_fetch'):
+                response = fetch(img_url, headers=conditional_request_headers(validators)) # retried and rate limited per host (see fetch_scheduler.py)
+            incr('image_fetch', status=response.status_code)
+            incr('image_fetch_bytes', len(response.content))
             response.raise_for_status()
         except Exception as e:
-            debug(f"Error retrieving image {img_url}: {e}")
+            if not isinstance(e, requests.exceptions.HTTPError):
+                incr('image_fetch', status='error')
+            logger.warning("Error retrieving image %s: %s", img_url, e)
             return None, None
+
+        if validators is not None:
+            validators.update(response_validators(response.headers))
+            if response.status_code == 304:
+                validators['not_modified'] = True
+                return None, None
     
         if len(response.content) > maximum_size_to_save: # Return None if too big
             return None, None
 
         content_type = response.headers.get('content-type')
         if not content_type.startswith("image/"): # if not an image type of content, skip it
-        #    debug(f"Invalid image content type for {img_url}: {content_type}")
+        #    logger.debug("Invalid image content type for %s: %s", img_url, content_type)
             return None, None # Not image content_type (maybe "text/html") so skip to next loop iterator
 
-        debug(f"retrieve_and_validate_img_handler() returning content_type: {content_type}")
+        logger.debug("retrieve_and_validate_img_handler() returning content_type: %s", content_type)
         return response.content, content_type
 
+# If-None-Match / If-Modified-Since headers for the validators stored with an image (see retrieve_and_validate_img_handler())
+def conditional_request_headers(validators):
+    headers = {}
+    if validators and validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators and validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+# The ETag and Last-Modified of a response, as stored in Image.etag and Image.last_modified
+def response_validators(headers):
+    return {'etag': (headers.get('etag') or '')[:255], 'last_modified': (headers.get('last-modified') or '')[:64]}
+
 # The purpose of this function is to handle the saving of image data into the database. It converts
 # the image data into a `BytesIO` object, generates a unique identifier for the image, creates an `Image`
-# object, and saves it to the database.
-def database_save_handler(image_data, search, img_url, content_type):
-    debug(f"In database_save_handler, passed image_data, search (.id={search.id}), img_url={img_url}, content_type={content_type}")
+# object, and saves it to the database. found_by is how the scrape found it (see Image.found_by).
+def database_save_handler(image_data, search, img_url, content_type, validators=None, found_by=FOUND_IN_HTML):
+    row = prepare_image_row(image_data, search, img_url, content_type, validators, found_by)
+    if row is None:
+        return
+    transcode_image_rows([row])
+    return save_image_row(search, row)
+
+# Works out what to store for a scraped image: returns a dict of the Image fields (with the metadata
+# computed from the image data), or None if the data can't be used.
+def prepare_image_row(image_data, search, img_url, content_type, validators=None, found_by=FOUND_IN_HTML):
+    logger.debug("In prepare_image_row, passed image_data, search (.id=%s), img_url=%s, content_type=%s", search.id, img_url, content_type)
 
     try:
         img_data = BytesIO(image_data)
     except Exception as e:
-        debug(f"Error setting img_data to BytesIO() for {img_url}: {e}")
+        logger.warning("Error setting img_data to BytesIO() for %s: %s", img_url, e)
         return
-#    debug(f"got img_data from BytesIO, img_data={img_data}")
-
-    unique_search_image = str(search.id) + '+' + hashlib.md5(image_data).hexdigest() # search_id + 32-character checksum of image data
-
+#    logger.debug("got img_data from BytesIO, img_data=%s", img_data)
+
+    metadata = compute_image_metadata(image_data) # width, height, byte_size, image_format, frame_count, content_hash
+    unique_search_image = str(search.id) + '+' + metadata['content_hash'] # search_id + 32-character checksum of image data
+
+    row = {'url': img_url[:255], 'unique_search_image': unique_search_image[:64], 'image': img_data.getvalue(), 'content_type': content_type[:64],
+           'found_by': found_by, **metadata, **describe_image_url(img_url)}
+    if validators:
+        row['etag'] = validators.get('etag', '')
+        row['last_modified'] = validators.get('last_modified', '')
+    return row
+
+# If transcoding is on, replaces the image in each row with a more compact encoding (content_hash stays
+# the checksum of what we downloaded). The images are transcoded in parallel (see transcode.py), skipping
+# ones that are already stored, so we don't spend CPU transcoding an image that won't be saved.
+def transcode_image_rows(rows):
+    if not settings.IMAGE_TRANSCODING:
+        return
+    stored = set(Image.objects.filter(unique_search_image__in=[row['unique_search_image'] for row in rows]).values_list('unique_search_image', flat=True))
+    rows = [row for row in rows if row['unique_search_image'] not in stored]
+    with timer('transcode'):
+        transcoded = transcode_batch_for_storage([(row['image'], row['image_format'], row['content_type']) for row in rows])
+    for row, fields in zip(rows, transcoded):
+        if fields:
+            logger.debug("Transcoded %s from %s to %s, saved %s bytes", row['url'], row['image_format'], fields['image_format'], fields['bytes_saved'])
+            row.update(fields)
+
+# Saves an image row from prepare_image_row(). Returns True if it was saved.
+def save_image_row(search, row):
     try:
-        img_obj = Image(search=search, url=img_url[:255], image=img_data.getvalue(), content_type=content_type[:64], unique_search_image = unique_search_image[:64]) 
-#        debug(f"did Image() call") 
-        img_obj.save()
-#        debug(f"did img_obj.save")
+        img_obj = Image(search=search, **row) 
+#        logger.debug("did Image() call")
+        with timer('db_save'), transaction.atomic(): # a savepoint when saving a batch, so one failure doesn't break the rest
+            img_obj.save()
+#        logger.debug("did img_obj.save")
     except Exception as e:
-        debug(f"Error saving image to database: {e}")
+        incr('image_save_failed')
+        logger.warning("Error saving image to database: %s", e)
         return
+
+    incr('images_saved')
+    incr('image_saved_bytes', img_obj.byte_size or 0)
+
+    if img_obj.bytes_saved:
+        Search.objects.filter(pk=search.pk).update(bytes_saved=F('bytes_saved') + img_obj.bytes_saved) # running total for the search
     return True
 
-# Retrieves and stores image from 'image_url' in database Image table, associating it with a search in Search table.
-# 'page_url' is the web page from which the 'image_url' was found, needed in case 'image_URL' is a relative link.
-def store_image_from_url_in_database(search,image_url,page_url):
-    
-    # Check parameters sent to function
-    if search is None or image_url is None or image_url == '' or page_url is None:
-        return
+# Saves a batch of scraped images, as (image_data, img_url, content_type, validators) tuples, in one
+# transaction. The rows are prepared and transcoded (in parallel, if it's on) before the transaction
+# opens, so the database is only locked for the inserts.
+@invalidation_batch()
+def database_save_batch(search, images, found_by=FOUND_IN_HTML):
+    rows = [prepare_image_row(image_data, search, img_url, content_type, validators, found_by) for image_data, img_url, content_type, validators in images]
+    rows = [row for row in rows if row is not None]
+    transcode_image_rows(rows)
+    with transaction.atomic():
+        for row in rows:
+            save_image_row(search, row)
+
+# Async version of get_web_response_handler(), for scrape_web_page_async(). Follows redirects, and
+# returns the final URL (to resolve relative image links against), the response and an error message.
+async def async_get_web_response(client, url_with_scheme, url_entered):
+    try:
+        url, response = await async_fetch_page(client, url_with_scheme)
+        response.raise_for_status()
+    except (httpx.HTTPError, HostCircuitOpen, RedirectError) as e:
+        logger.warning("Error trying to get %s: %s", url_with_scheme, e)
+        return None, None, f"Failed to get {url_entered}: {e}"
+    return url, response, None
 
-    # Join the web page URL prefix to the image URL if the image URL is a relative link
-    if not image_url.startswith('http'):
-        image_url = urljoin(page_url, image_url)
-    
-    # Call handler function for retrieving and validating img
-    response_content, content_type = retrieve_and_validate_img_handler(image_url) 
-    
-    # If we got a response, call handler function for saving objects to database
-    if response_content:
-        if len(image_url) > 255:
-            image_url = image_url[:255]
-        database_save_handler(response_content, search, image_url, content_type)
-    return
+# Async version of retrieve_and_validate_img_handler(). The semaphore limits how many downloads
+# one scrape has in flight at once.
+async def async_retrieve_and_validate_img(client, semaphore, img_url, validators=None):
+    if img_url.split('/')[0] == 'data:image':
+        return retrieve_and_validate_img_handler(img_url) # nothing to download
+
+    try:
+        async with semaphore:
+            with timer('image_fetch'):
+                response = await async_fetch(client, img_url, headers=conditional_request_headers(validators), follow_redirects=True)
+        incr('image_fetch', status=response.status_code)
+        incr('image_fetch_bytes', len(response.content))
+        response.raise_for_status()
+    except Exception as e:
+        if not isinstance(e, httpx.HTTPStatusError):
+            incr('image_fetch', status='error')
+        logger.warning("Error retrieving image %s: %s", img_url, e)
+        return None, None
+
+    if validators is not None:
+        validators.update(response_validators(response.headers))
+        if response.status_code == 304:
+            validators['not_modified'] = True
+            return None, None
+
+    if len(response.content) > MAXIMUM_IMAGE_SIZE_TO_SAVE: # Return None if too big
+        return None, None
+
+    content_type = response.headers.get('content-type') or ''
+    if not content_type.startswith("image/"): # if not an image type of content, skip it
+        return None, None
+    return response.content, content_type
+
+# Async version of pick_an_image_from_srcset(). Downloads every candidate in the srcset at once, and
+# returns the URL, data, content type and validators of the biggest one that's suitable (or Nones),
+# so the chosen image doesn't have to be downloaded again to store it.
+async def async_pick_an_image_from_srcset(client, semaphore, image_srcset, page_url):
+    srcset_start = time.perf_counter()
+    candidate_urls = srcset_candidate_urls(image_srcset, page_url)
+    candidate_validators = [{} for _ in candidate_urls]
+    candidates = await asyncio.gather(*(async_retrieve_and_validate_img(client, semaphore, url_to_check, validators)
+                                        for url_to_check, validators in zip(candidate_urls, candidate_validators)))
+    record_stage('srcset_selection', time.perf_counter() - srcset_start)
+
+    biggest = (None, None, None, None)
+    for url_to_check, (image_data, content_type), validators in zip(candidate_urls, candidates, candidate_validators):
+        if image_data is not None and len(image_data) > len(biggest[1] or b''):
+            biggest = (url_to_check, image_data, content_type, validators)
+    if biggest[0] is None:
+        logger.debug("None of the images were suitable")
+    return biggest
 
 # The purpose of this function is to use a webdriver to load a web page, capture a screenshot of the page,
 # and process specific elements (img and svg) to save image URLs or image data to the database.
+@invalidation_batch()
 def scrape_page_with_webdriver(search,url):
 
-    debug(f"starting scrape_page_with_webdriver(url), url={url}")
+    logger.debug("starting scrape_page_with_webdriver(url), url=%s", url)
+    stage_start = time.perf_counter() # webdriver_load covers starting the browser and loading the page
 
     # Set Chrome webdriver options and instantiate the driver
     try:
@@ -223,7 +361,7 @@ def scrape_page_with_webdriver(search,url):
         options.add_argument('--disable-gpu') # disable GPU usage (avoids some bugs)
         driver = webdriver.Chrome(executable_path=settings.CHROME_DRIVER_EXECUTABLE_LOCATION, options=options)
     except Exception as e:
-        debug(f"Exception opening Chrome webdriver: {e}")
+        logger.warning("Exception opening Chrome webdriver: %s", e)
 
     # Set Firefox webdriver options and instantiate the driver
     # try:
@@ -232,17 +370,17 @@ def scrape_page_with_webdriver(search,url):
     #     options.binary_location = FIREFOX_BROWSER_EXECUTABLE_LOCATION # Actual firefox location
     #     driver = webdriver.Firefox(executable_path=FIREFOX_DRIVER_EXECUTABLE_LOCATION, options=options)
     # except Exception as e:
-    #     debug(f"Exception opening Firefox webdriver: {e}")
+    #     logger.warning("Exception opening Firefox webdriver: %s", e)
 
     # Get URL using web driver
-    debug(f"Load {url} with webdriver")
+    logger.debug("Load %s with webdriver", url)
     try:
         driver.get(url)
     except Exception as e:
-        debug(f"Exception opening URL {url} with webdriver: {e}")
+        logger.warning("Exception opening URL %s with webdriver: %s", url, e)
         return
     
-    debug(f"Loaded {url} in webdriver")
+    logger.debug("Loaded %s in webdriver", url)
 
     # Set window size for webdriver (virtual window size, since it's operating in 'headless' mode)
     browser_width = 1920
@@ -250,11 +388,14 @@ def scrape_page_with_webdriver(search,url):
     try:
         driver.set_window_size(browser_width, browser_height)
     except Exception as e:
-        debug(f"Exception setting virtual window size webdriver: {e}")
+        logger.warning("Exception setting virtual window size webdriver: %s", e)
         return
  
+    record_stage('webdriver_load', time.perf_counter() - stage_start)
+
     # Sleep to give page time to load
-    time.sleep(3)
+    with timer('webdriver_wait'):
+        time.sleep(3)
 
     # NOTE: Tried using this to wait until Selenium reported the web elements were 
     # all visible, but didn't seem to work. Also tried with presence_of_all_elements.
@@ -273,8 +414,10 @@ def scrape_page_with_webdriver(search,url):
     # except TimeoutException:
     #     return render(request, 'fail.html', {'error_message': f"Timed out waiting for web page elements to load"})
 
-    screen_png = driver.get_screenshot_as_png() # saves screenshot of entire page
-    screen_whole = PILImage.open(BytesIO(screen_png)) # uses PIL library to open image in memory
+    with timer('screenshot'):
+        screen_png = driver.get_screenshot_as_png() # saves screenshot of entire page
+        screen_whole = PILImage.open(BytesIO(screen_png)) # uses PIL library to open image in memory
+    stage_start = time.perf_counter() # webdriver_harvest covers going through the page's elements (including storing their images)
     
     element_tags_to_process = ('img','svg') # WebElement tag_names to process
 
@@ -284,7 +427,7 @@ def scrape_page_with_webdriver(search,url):
     for element_tag in element_tags_to_process:
 #        elements = driver.find_elements_by_tag_name(element_tag)
         elements = driver.find_elements(By.TAG_NAME, element_tag)
-        debug(f"Number of elements found: {len(elements)}")
+        logger.debug("Number of elements found: %s", len(elements))
 
         # Iterate over the web elements and store images if suitable
         for element in elements:
@@ -303,10 +446,11 @@ def scrape_page_with_webdriver(search,url):
                     image_src = None
                     image_srcset = None
             except Exception as e: # (likely StaleElementReferenceException, but could be timeout or something else)
-                debug("Got a stale element or other error processing WebElements from Selenium")
+                logger.warning("Got a stale element or other error processing WebElements from Selenium")
                 continue
 
-            debug(f"IMG SRCSET element name={element.tag_name} text={element.text} size = {element.size} location = {element.location}")
+            if logger.isEnabledFor(logging.DEBUG): # each of these is a round trip to the browser, so skip them unless they'll be logged
+                logger.debug("IMG SRCSET element name=%s text=%s size = %s location = %s", element.tag_name, element.text, element.size, element.location)
             if element_tag == 'img':
                 # Add url from image_src (if any) to image_srcset (if any), to compare image_srcset images all together
                 
@@ -316,227 +460,596 @@ def scrape_page_with_webdriver(search,url):
                     else:
                         image_srcset = image_src + ' 1x,' + image_srcset
 
-                debug(f"           checking {image_srcset}")
+                logger.debug("           checking %s", image_srcset)
 
                 if image_srcset == '':
-                    debug(f"Skipping img element loop (img={img})")
+                    logger.debug("Skipping img element loop (img=%s)", element)
                     continue  # Skip this image tag since it has no 'src' or 'srcset' attributes
                 else:
-                    image_src = pick_an_image_from_srcset(image_srcset,url)
-                    store_image_from_url_in_database(search, image_src, url)
+                    image_src, image_data, content_type, validators = pick_an_image_from_srcset(image_srcset,url)
+                    if image_data:
+                        database_save_handler(image_data, search, image_src[:255], content_type, validators, found_by=FOUND_BY_BROWSER)
 
             elif element_tag == 'svg':
-                debug(f"           element={element}")
+                logger.debug("           element=%s", element)
                 
                 # Calculate crop parameters. floor() and ceil() to round to integers in case it comes back float.
                 left = math.floor(element.location['x'])
                 top = math.floor(element.location['y'])
                 right = left + math.ceil(element.size['width'])
                 bottom = top + math.ceil(element.size['height'])
-                # debug(f"           left={left} top={top} right={right} bottom={bottom}")
+                # logger.debug("           left=%s top=%s right=%s bottom=%s", left, top, right, bottom)
 
                 if bottom > browser_height or right > browser_width:
-                    debug("            Image to crop is off the page")
+                    logger.debug("            Image to crop is off the page")
                     continue
 
-                screen_cropped = screen_whole.crop( (left, top, right, bottom) ) # get cropped subset of image
-                debug(f"           Cropped")
+                with timer('svg_crop'):
+                    screen_cropped = screen_whole.crop( (left, top, right, bottom) ) # get cropped subset of image
+                    logger.debug("           Cropped")
 
-                # Create a BytesIO object to store the image data as bytes
-                image_buffer = BytesIO()
+                    # Create a BytesIO object to store the image data as bytes
+                    image_buffer = BytesIO()
 
-                # Save the cropped image to the BytesIO buffer
-                screen_cropped.save(image_buffer, format='PNG')
+                    # Save the cropped image to the BytesIO buffer
+                    screen_cropped.save(image_buffer, format='PNG')
 
                 # Get the bytes value from the BytesIO buffer
                 image_data = image_buffer.getvalue()
 
-                database_save_handler(image_data, search, '(screen shot)', 'image/x-png')
+                database_save_handler(image_data, search, '(screen shot)', 'image/x-png', found_by=FOUND_BY_BROWSER)
 
                 # Note to self:
                 # To print first 40 characters of binary data for debugging, b64encode it:
                 # {base64.b64encode(screen_cropped)[:40]}
                 # {(base64.b64decode(screen_cropped.make_blob())[:40])}
 
-    debug(f"quitting driver, went through {len(elements)} elements")
+    record_stage('webdriver_harvest', time.perf_counter() - stage_start)
+    logger.debug("quitting driver, went through %s elements", len(elements))
     # Close the browser instance
     try:
         driver.quit()
     except Exception as e: # (likely StaleElementReferenceException, but could be timeout or something else)
-        debug("Got a stale element or other error processing WebElements from Selenium")
+        logger.warning("Got a stale element or other error processing WebElements from Selenium")
         return
-    debug(f"quit driver")
+    logger.debug("quit driver")
 
     return
 
 # The purpose of this function is to retrieve Search and Image objects from the database, calculate the number
 # of searches and images, and render an HTML template with the information to be displayed in the browser.
+@reads_from_replica
 def home_page(request):
     try:
-        searches = Search.objects.all()
-        images = Image.objects.all()
+        counts = get_site_counts()
     except Exception as e: # (likely StaleElementReferenceException, but could be timeout or something else)
-        debug(f"Error in past_searches() retrieving searches or images from database: {e}")
+        logger.warning("Error in past_searches() retrieving searches or images from database: %s", e)
         return render(request, 'fail.html', {'error_message': f"Error retrieving searches/images from database: {e}"})
-    return render(request, 'index.html', {'number_of_searches': len(searches), 'number_of_images': len(images)}) 
+    return render(request, 'index.html', counts) 
+
+# Returns {'number_of_searches': n, 'number_of_images': n}, from the cache if nothing changed since it was counted
+def get_site_counts():
+    return get_or_compute('counts', COUNTS_KEY, lambda: {
+        'number_of_searches': Search.objects.count(),
+        'number_of_images': Image.objects.count(),
+    }, listing_timeout())
+
+# Parses a page's HTML and returns a srcset string for each img tag with an image in it, combining the
+# tag's single image URL (src, or one of the non-standard variants) with its srcset, so
+# pick_an_image_from_srcset() can choose the best size from all the candidates
+def image_srcsets_from_html(html_content):
+    with timer('html_parse'):
+        soup = BeautifulSoup(html_content, 'html.parser')  # Parse HTML content with BeautifulSoup
+        img_tags = soup.find_all('img') # Extract all the image URLs from the HTML content
+
+    image_srcsets = []
+    for img in img_tags:
+        img_str = str(img) # img by itself is an object, and we may want to use its string representation
+
+        logger.debug("checking img_str=%s", img_str)
+
+        # Some sites use data-gl-src, data-gl-srcset, data-getimg, data-hi-res-src, data-full-url, full-src, and
+        # a variety of other non-standard alternatives to src and srcset in image tags. (Example: usatoday.com).
+        # So if we don't find ' src' or ' srcset', we'll use these variants instead if they're present.
+
+        # Some img tags have a single src= and a multi-image srcset=, so find the single image url, and 
+        # add it to a multi-image srcset url, so we pick an appropriately sized image from all hte candidates 
+
+        if ' src="' in img_str: # priority if it has a space before it, in case of multiple src attributes
+            single_image_url = after_substr(img_str,' src="').split('"')[0]
+        elif 'src="' in img_str:
+            single_image_url = after_substr(img_str,'src="').split('"')[0]
+        elif 'url="' in img_str:
+            single_image_url = after_substr(img_str,'url="').split('"')[0]
+        elif 'img="' in img_str:
+            single_image_url = after_substr(img_str,'img="').split('"')[0]
+        else:
+            single_image_url = ''
+
+        if ' srcset="' in img_str: # priority if it has a space before it, in case of multiple srcset attributes
+            multi_image_url = after_substr(img_str,'srcset="').split('"')[0]
+        elif 'srcset="' in img_str:
+            multi_image_url = after_substr(img_str,'srcset="').split('"')[0]
+        else:
+            multi_image_url = ''
+
+        if single_image_url != '':
+            if multi_image_url == '':
+                multi_image_url = single_image_url + ' 1x'
+            else:
+                multi_image_url = single_image_url + ' 1x,' + multi_image_url
+
+        if multi_image_url == '':
+            logger.debug("Skipping img in img_tags loop (img=%s)", img)
+            continue  # Skip this image tag since it has no 'src' or 'srcset' attributes
+
+        image_srcsets.append(multi_image_url)
+    return image_srcsets
 
 # The purpose of this function is to handle form submission, retrieve the URL entered by the user,
 # perform web scraping operations using `BeautifulSoup`, and interact with the database to store the
 # scraped data. It also calls other functions to handle HTTP requests, parse image tags, and perform
 # additional web scraping using a web driver.
 def scrape_web_page(request):
-    debug(f"Starting scrape_web_page(request), request={request}")
+    logger.debug("Starting scrape_web_page(request), request=%s", request)
 
     if request.method == 'POST':
-
-        url_entered = request.POST['url'] # url_entered gets URL user entered in the index.html form
-        # Note that we store url_entered in the search database just as the user entered it, even if
-        # it's just "google.com", and we wind up storing images from "https://www.google.com"
-
-        parsed_url = urlparse(url_entered) # Parse the URL entered by the user to get the scheme
-        scheme = parsed_url.scheme if parsed_url.scheme else 'http' # Figure out scheme (e.g. http)
-        url_with_scheme = f"{scheme}://{parsed_url.netloc}{parsed_url.path}" # Rebuild URL
+        # Time every stage of this scrape, to save a summary with the Search
+        with search_timing() as timing_summary:
+            url_entered = request.POST['url'] # url_entered gets URL user entered in the index.html form
+            # Note that we store url_entered in the search database just as the user entered it, even if
+            # it's just "google.com", and we wind up storing images from "https://www.google.com"
+
+            url_with_scheme = add_scheme(url_entered) # Add http:// if the user left the scheme off
+            force_fresh = request.POST.get('force_fresh') == 'on' # the form's "force fresh" box scrapes again even if the page was scraped recently
+
+            # If the page was scraped recently (see reuse.py), show that scrape's images instead. Where the URL
+            # redirects to may already be known, saving even the page fetch; if not, it's checked again below.
+            source = None if force_fresh else find_reusable_search(known_final_url(url_with_scheme))
+            if source:
+                return redirect('success', id=reuse_search(url_entered, source).id)
         
-        url, response, error = get_web_response_handler(request,url_with_scheme, url_entered) # Call handler function for getting web response
-        debug(f"get_web_response_handler() returned url={url}, response={response}, error={error}")
-        if error:
-            return render(request, 'fail.html', {'error_message': error})
+            url, response, error = get_web_response_handler(request,url_with_scheme, url_entered) # Call handler function for getting web response
+            logger.debug("get_web_response_handler() returned url=%s, response=%s, error=%s", url, response, error)
+            if error:
+                return render(request, 'fail.html', {'error_message': error})
 
-        # We can retrieve a web page, so save the search URL (as the user entered it) in the Searches database
-        try:
-            search = Search.objects.create(url=url_entered) # Save the search instance
-            search.save()
-        except Exception as e:
-            debug(f"Failure inserting Search record: {e}")
-            return render(request, 'fail.html', {'error_message': f"Unable to insert search in database.html: {e}"})
+            source = None if force_fresh else find_reusable_search(url)
+            if source:
+                return redirect('success', id=reuse_search(url_entered, source).id)
 
-        soup = BeautifulSoup(response.content, 'html.parser')  # Parse HTML content with BeautifulSoup
-        img_tags = soup.find_all('img') # Extract all the image URLs from the HTML content
+            # We can retrieve a web page, so save the search URL (as the user entered it) in the Searches database
+            try:
+                search = Search.objects.create(url=url_entered, final_url=normalize_url(url)) # Save the search instance
+                search.save()
+            except Exception as e:
+                logger.warning("Failure inserting Search record: %s", e)
+                return render(request, 'fail.html', {'error_message': f"Unable to insert search in database.html: {e}"})
+
+            with invalidation_batch(): # one cache version bump for the search at the end, not one per image
+                batch = [] # saved settings.ASYNC_SCRAPE_DB_BATCH_SIZE at a time, so a batch's transcoding runs in parallel
+                for multi_image_url in image_srcsets_from_html(response.content):
+                    image_url, image_data, content_type, validators = pick_an_image_from_srcset(multi_image_url,url)
+                
+                    # Store the image from 'image_url' in Images table, with search data
+                    logger.debug("In img_tags loop, about to store img_url = %s", image_url)
+                    if image_data:
+                        batch.append((image_data, image_url, content_type, validators))
+                    if len(batch) >= settings.ASYNC_SCRAPE_DB_BATCH_SIZE:
+                        database_save_batch(search, batch)
+                        batch = []
+                if batch:
+                    database_save_batch(search, batch)
+                
+                if settings.SCRAPE_WITH_WEBDRIVER:
+                    logger.debug("Done with img_tags loop and beautiful soup scraping, about to call scrape_page+with_webdriver")
+                    scrape_page_with_webdriver(search,url)
 
-        for img in img_tags:
-            img_str = str(img) # img by itself is an object, and we may want to use its string representation
+        Search.objects.filter(pk=search.pk).update(timing_summary=timing_summary_for_storage(timing_summary))
+        incr('scrapes')
 
-            debug(f"checking img_str={img_str}")
+        return redirect('success', id=search.id)
+    return render(request, 'scrape_web_page.html')
 
-            # Some sites use data-gl-src, data-gl-srcset, data-getimg, data-hi-res-src, data-full-url, full-src, and
-            # a variety of other non-standard alternatives to src and srcset in image tags. (Example: usatoday.com).
-            # So if we don't find ' src' or ' srcset', we'll use these variants instead if they're present.
-            
-            # Some img tags have a single src= and a multi-image srcset=, so find the single image url, and 
-            # add it to a multi-image srcset url, so we pick an appropriately sized image from all hte candidates 
-
-            if ' src="' in img_str: # priority if it has a space before it, in case of multiple src attributes
-                single_image_url = after_substr(img_str,' src="').split('"')[0]
-            elif 'src="' in img_str:
-                single_image_url = after_substr(img_str,'src="').split('"')[0]
-            elif 'url="' in img_str:
-                single_image_url = after_substr(img_str,'url="').split('"')[0]
-            elif 'img="' in img_str:
-                single_image_url = after_substr(img_str,'img="').split('"')[0]
-            else:
-                single_image_url = ''
+# Async version of scrape_web_page(), for ASGI servers (uvicorn, daphne...), where one worker can run
+# many scrapes at once without a thread for each. Pages and images are fetched with httpx, every img
+# tag's srcset at the same time (at most settings.ASYNC_SCRAPE_CONCURRENCY downloads in flight per
+# scrape), and images are saved settings.ASYNC_SCRAPE_DB_BATCH_SIZE at a time through sync_to_async,
+# while the rest are still downloading. Served at /scrape_web_page_async/, and at /scrape_web_page/
+# too if settings.SCRAPE_ASYNC is on.
+async def scrape_web_page_async(request):
+    if request.method != 'POST':
+        return render(request, 'scrape_web_page.html')
+    if httpx is None:
+        return render(request, 'fail.html', {'error_message': "Async scraping needs the httpx package (pip install httpx)"})
+
+    with search_timing() as timing_summary:
+        url_entered = request.POST['url']
+        url_with_scheme = add_scheme(url_entered) # Add http:// if the user left the scheme off
+        force_fresh = request.POST.get('force_fresh') == 'on'
+
+        source = None if force_fresh else await sync_to_async(find_reusable_search)(known_final_url(url_with_scheme))
+        if source:
+            search = await sync_to_async(reuse_search)(url_entered, source)
+            return redirect('success', id=search.id)
+
+        limits = httpx.Limits(max_connections=settings.ASYNC_SCRAPE_CONCURRENCY * 2)
+        async with httpx.AsyncClient(timeout=settings.ASYNC_SCRAPE_TIMEOUT, limits=limits) as client:
+            url, response, error = await async_get_web_response(client, url_with_scheme, url_entered)
+            if error:
+                return render(request, 'fail.html', {'error_message': error})
+
+            source = None if force_fresh else await sync_to_async(find_reusable_search)(url)
+            if source:
+                search = await sync_to_async(reuse_search)(url_entered, source)
+                return redirect('success', id=search.id)
 
-            if ' srcset="' in img_str: # priority if it has a space before it, in case of multiple srcset attributes
-                multi_image_url = after_substr(img_str,'srcset="').split('"')[0]
-            elif 'srcset="' in img_str:
-                multi_image_url = after_substr(img_str,'srcset="').split('"')[0]
-            else:
-                multi_image_url = ''
+            try:
+                search = await Search.objects.acreate(url=url_entered, final_url=normalize_url(url))
+            except Exception as e:
+                logger.warning("Failure inserting Search record: %s", e)
+                return render(request, 'fail.html', {'error_message': f"Unable to insert search in database.html: {e}"})
+
+            # Parsing is CPU work, so it runs in a thread rather than holding up other scrapes on the event loop
+            image_srcsets = await sync_to_async(image_srcsets_from_html, thread_sensitive=False)(response.content)
+
+            semaphore = asyncio.Semaphore(settings.ASYNC_SCRAPE_CONCURRENCY)
+            picks = [asyncio.create_task(async_pick_an_image_from_srcset(client, semaphore, image_srcset, url)) for image_srcset in image_srcsets]
+            save_batch = sync_to_async(database_save_batch)
+            batch = []
+            try:
+                for pick in asyncio.as_completed(picks):
+                    image_url, image_data, content_type, validators = await pick
+                    if image_data:
+                        batch.append((image_data, image_url, content_type, validators))
+                    if len(batch) >= settings.ASYNC_SCRAPE_DB_BATCH_SIZE:
+                        await save_batch(search, batch)
+                        batch = []
+                if batch:
+                    await save_batch(search, batch)
+            finally:
+                for pick in picks:
+                    pick.cancel() # if the client went away or saving failed, stop the downloads still running
+
+        if settings.SCRAPE_WITH_WEBDRIVER:
+            await sync_to_async(scrape_page_with_webdriver)(search, url) # Selenium blocks, so it gets a thread
+
+    await Search.objects.filter(pk=search.pk).aupdate(timing_summary=timing_summary_for_storage(timing_summary))
+    incr('scrapes')
+
+    return redirect('success', id=search.id)
+
+# Refreshes a past search: scrapes its page again into the same Search, instead of starting a new one
+# that downloads and stores every image again. Images we already have are asked for with a conditional
+# GET (using the ETag / Last-Modified stored with them), and only images whose content isn't stored yet
+# are added. Images no longer on the page are counted, and marked as vanished if the form asked for it.
+# What was found is saved in Search.refresh_summary and shown on the past search page.
+def refresh_search(request, id):
+    past_search_url = f"{reverse('past_search')}?id={id}"
+    if request.method != 'POST':
+        return redirect(past_search_url)
 
-            if single_image_url != '':
-                if multi_image_url == '':
-                    multi_image_url = single_image_url + ' 1x'
-                else:
-                    multi_image_url = single_image_url + ' 1x,' + multi_image_url
+    try:
+        search = Search.objects.select_related('reused_from').get(id=id)
+    except Search.DoesNotExist:
+        return render(request, 'fail.html', {'error_message': f"Search ID {id} not found"}, status=404)
+    search = search.reused_from or search # a search that reused a recent scrape refreshes that scrape's images
 
-            if multi_image_url == '':
-                debug(f"Skipping img in img_tags loop (img={img})")
-                continue  # Skip this image tag since it has no 'src' or 'srcset' attributes
+    with search_timing() as timing_summary:
+        url_entered = search.url
+        url_with_scheme = add_scheme(url_entered) # Add http:// if the user left the scheme off
 
-            image_url = pick_an_image_from_srcset(multi_image_url,url)
-            
-            # Store the image at 'image_url' in Images table, with search data
-            debug(f"In img_tags loop, about to store img_url = {image_url} from img tag={img}")
-            store_image_from_url_in_database(search,image_url,url)
-            
-        debug(f"Done with img_tags loop and beautiful soup scraping, about to call scrape_page+with_webdriver")
-        debug(f"_____________________________________________________________________________________________")
-        debug(f"_____________________________________________________________________________________________")
-        scrape_page_with_webdriver(search,url)
+        url, response, error = get_web_response_handler(request, url_with_scheme, url_entered)
+        if error:
+            return render(request, 'fail.html', {'error_message': error})
 
-        return redirect('success', id=search.id)
-    return render(request, 'scrape_web_page.html')
+        refresh_summary = refresh_search_images(search, url, response.content, request.POST.get('mark_vanished') == 'on')
+
+    counters = timing_summary['counters']
+    refresh_summary['bytes_transferred'] = counters.get('page_fetch_bytes', 0) + counters.get('image_fetch_bytes', 0)
+    refresh_summary['seconds'] = round(timing_summary['total_seconds'], 3)
+    Search.objects.filter(pk=search.pk).update(last_refreshed=timezone.now(), refresh_summary=refresh_summary, final_url=normalize_url(url))
+    incr('refreshes')
+    incr('refresh_images', refresh_summary['new'], result='new')
+    incr('refresh_images', refresh_summary['unchanged'], result='unchanged')
+    incr('refresh_images', refresh_summary['removed'], result='removed')
+
+    logger.debug("Refreshed search %s: %s", search.id, refresh_summary)
+    return redirect(past_search_url)
+
+# Goes through the img tags of a search's page (fetched again as html_content from url) and stores the
+# images that are new since the search was last scraped. Returns counts of images that were new,
+# unchanged (not modified, or the same content we already have), failed (couldn't be fetched again),
+# removed (stored, but not on the page any more; marked as vanished if mark_vanished is set) and
+# not_checked (found by the browser pass, so not expected in the HTML; see Image.found_by).
+# A refresh doesn't start a browser, so images only the browser found are never counted as removed.
+@invalidation_batch()
+def refresh_search_images(search, url, html_content, mark_vanished):
+    stored_images = Image.objects.filter(search=search).only('id', 'url', 'etag', 'last_modified', 'content_hash', 'vanished_at', 'found_by').order_by('id') # newest wins in images_by_url
+    images_by_url = {image.url: image for image in stored_images}
+    image_ids_by_hash = {image.content_hash: image.id for image in stored_images}
+    seen_image_ids = set()
+    counts = {'new': 0, 'unchanged': 0, 'failed': 0, 'removed': 0, 'not_checked': 0}
+
+    for image_srcset in image_srcsets_from_html(html_content):
+        candidate_urls = srcset_candidate_urls(image_srcset, url)
+        known_url = next((candidate_url for candidate_url in candidate_urls if candidate_url[:255] in images_by_url), None)
+
+        if known_url is not None:
+            # We stored one of this tag's images last time, so just check whether it changed
+            known_image = images_by_url[known_url[:255]]
+            seen_image_ids.add(known_image.id)
+            validators = {'etag': known_image.etag, 'last_modified': known_image.last_modified}
+            image_data, content_type = retrieve_and_validate_img_handler(known_url, validators)
+            if validators.get('not_modified'):
+                counts['unchanged'] += 1
+                continue
+            if image_data is None:
+                counts['failed'] += 1
+                continue
+        else:
+            # A tag we haven't seen before, so pick the best size from its srcset like a new scrape does
+            known_url, image_data, content_type, validators = pick_an_image_from_srcset(image_srcset, url)
+            if image_data is None:
+                continue
+
+        content_hash = hashlib.md5(image_data).hexdigest()
+        if content_hash in image_ids_by_hash:
+            # Same content as an image we already have (maybe served with new validators, or from a new URL)
+            seen_image_ids.add(image_ids_by_hash[content_hash])
+            if validators.get('etag') or validators.get('last_modified'):
+                Image.objects.filter(pk=image_ids_by_hash[content_hash]).update(etag=validators.get('etag', ''), last_modified=validators.get('last_modified', ''))
+            counts['unchanged'] += 1
+            continue
+
+        if database_save_handler(image_data, search, known_url[:255], content_type, validators):
+            image_ids_by_hash[content_hash] = None # saved; nothing to mark as vanished
+            counts['new'] += 1
+        else:
+            counts['failed'] += 1
+
+    # Images found in the page's HTML (not by the browser pass, or screen shots) that weren't there this time
+    missing_images = [image for image in stored_images if image.id not in seen_image_ids]
+    vanished_ids = [image.id for image in missing_images if image.found_by == FOUND_IN_HTML and image.url != '(screen shot)']
+    counts['removed'] = len(vanished_ids)
+    counts['not_checked'] = len(missing_images) - len(vanished_ids)
+    if mark_vanished and vanished_ids:
+        Image.objects.filter(pk__in=vanished_ids, vanished_at__isnull=True).update(vanished_at=timezone.now())
+    returned_ids = [image.id for image in stored_images if image.id in seen_image_ids and image.vanished_at is not None]
+    if returned_ids:
+        Image.objects.filter(pk__in=returned_ids).update(vanished_at=None) # back on the page
+    invalidate_search(search.id) # vanished_at was changed with update(), which doesn't send the signals
+    return counts
 
 # The purpose of this function is to serve images to the client by retrieving the image object
 # from the database based on the provided `image_id`.
 # It then returns an HTTP response with the image data and appropriate content_type, allowing the
 # client to display the image in the browser or use it in other applications that consume image data.
+# Images stored in a transcoded format serve the compact version, unless ?original=1 asks for the
+# original download (if it was kept, see settings.IMAGE_TRANSCODE_KEEP_ORIGINAL).
 def myimage(request, image_id):
-    image = Image.objects.get(pk=image_id)
-    return HttpResponse(image.image, content_type="image/jpeg")
+    try:
+        image = Image.objects.get(pk=image_id)
+    except Image.DoesNotExist:
+        return render(request, 'fail.html', {'error_message': f"Image ID {image_id} not found"}, status=404)
+
+    if request.GET.get('original') == '1' and image.original is not None:
+        return HttpResponse(image.original, content_type=image.original_content_type or "image/jpeg")
+    return HttpResponse(image.image, content_type=image.content_type or "image/jpeg")
+
+# Gallery query parameters that filter on the precomputed Image metadata columns,
+# mapped to the queryset lookup they apply, e.g. ?min_width=800&format=png
+IMAGE_FILTER_PARAMETERS = {
+    'min_width': 'width__gte',
+    'max_width': 'width__lte',
+    'min_height': 'height__gte',
+    'max_height': 'height__lte',
+    'min_size': 'byte_size__gte',
+    'max_size': 'byte_size__lte',
+    'format': 'image_format',
+    'hash': 'content_hash',
+}
+
+# Gallery ?sort= values allowed, mapped to the column ordering (prefix with '-' for descending)
+IMAGE_SORT_FIELDS = {
+    'width': 'width',
+    'height': 'height',
+    'size': 'byte_size',
+    'format': 'image_format',
+    'frames': 'frame_count',
+    'date': 'timestamp',
+}
+
+# Applies the gallery filter and sort query parameters from request.GET to an Image queryset.
+# Everything is done with the indexed metadata columns in the database, so no blob is read or
+# decoded to decide which images to show. Unknown or malformed parameters are ignored.
+def filter_and_sort_images(images, query_params):
+    for parameter, lookup in IMAGE_FILTER_PARAMETERS.items():
+        value = query_params.get(parameter, '').strip()
+        if value == '':
+            continue
+        if lookup in ('image_format', 'content_hash'):
+            images = images.filter(**{lookup: value.lower()})
+        elif value.isdigit():
+            images = images.filter(**{lookup: int(value)})
+
+    vanished = query_params.get('vanished', '')
+    if vanished in ('1', 'true', 'yes'):
+        images = images.filter(vanished_at__isnull=False)
+    elif vanished in ('0', 'false', 'no'):
+        images = images.filter(vanished_at__isnull=True)
+
+    animated = query_params.get('animated', '')
+    if animated in ('1', 'true', 'yes'):
+        images = images.filter(frame_count__gt=1)
+    elif animated in ('0', 'false', 'no'):
+        images = images.exclude(frame_count__gt=1)
+
+    sort = query_params.get('sort', '')
+    descending = sort.startswith('-')
+    sort_field = IMAGE_SORT_FIELDS.get(sort.lstrip('-'))
+    if sort_field:
+        images = images.order_by(('-' if descending else '') + sort_field, 'id')
+
+    return images
 
 # The purpose of this function is to retrieve images from the database, process them by extracting
 # filenames and generating data URIs, and render a template to display the images in a web page.
+@reads_from_replica
 def show_all_images(request):
-    images = Image.objects.all()
+    images = filter_and_sort_images(Image.objects.defer('original'), request.GET)
     images = add_template_data_to_image(images)
     return render(request, 'show_all_images.html', {'images': images}, )
 
 # The purpose of this function is to retrieve past searches and images from the database,
 # adjust the timestamp to the local timezone, and render a template to display the searches
 # along with the number of images in a web page. 
+@reads_from_replica
 def past_searches(request):
     # Get all past searches, format local timestamp, and send to template
     try:
-        searches = Search.objects.all()
-        images = Image.objects.all()
+        searches = get_or_compute('past_searches', PAST_SEARCHES_KEY, list_past_searches, listing_timeout())
+        counts = get_site_counts()
     except Exception as e: # (likely StaleElementReferenceException, but could be timeout or something else)
-        debug(f"Error in past_searches() retrieving searches or images from database: {e}")
+        logger.warning("Error in past_searches() retrieving searches or images from database: %s", e)
         return render(request, 'fail.html', {'error_message': f"Error retrieving searches/images from database: {e}"})
 
-    for search in searches:
-        local_tz = timezone.get_current_timezone()
-        local_dt = search.timestamp.astimezone(local_tz)
-        search.timestampadjuster = local_dt.strftime('%Y-%m-%d %H:%M:%S')
-        
-    return render(request, 'past_searches.html', {'searches': searches, 'number_of_images': len(images)}) # Render list of searches to template
+    return render(request, 'past_searches.html', {'searches': searches, 'number_of_images': counts['number_of_images']}) # Render list of searches to template
+
+# Returns the past searches as a list of dicts (id, url, timestampadjuster) small enough to cache
+def list_past_searches():
+    local_tz = timezone.get_current_timezone()
+    searches = []
+    for search_id, url, timestamp in Search.objects.order_by('id').values_list('id', 'url', 'timestamp'):
+        local_dt = timestamp.astimezone(local_tz)
+        searches.append({'id': search_id, 'url': url, 'timestampadjuster': local_dt.strftime('%Y-%m-%d %H:%M:%S')})
+    return searches
     
 # Takes an Image record retrieved from database, and adds two fields to each 
 # image record to display in the web page template:
-# * image.filename (extracted from the URL, minus the http & domain name.
+# * image.filename (extracted from the URL at ingest, minus the http & domain name).
+#   Rows stored before the filename column existed get it worked out from the URL here.
 # * image.image_data_uri the image itself in data-formatted base64 encoding that
 #   can be displayed with an <img> tag in the template.
 def add_template_data_to_image(images):
-    max_filename_length = 60 # max filename we display
-        
     for image in images:
-        if image.url.startswith("data"): 
-            # if starts with 'data:' instead of 'http:' or 'https:', just use url as a pseudo-filename
-            image.filename = image.url[:40] 
-        else:
-            # sometimes the url contains ? and other extraneous data after the filename, so strip everything after ?
-            filename = image.url.split('?')[0]
-            # split remaining url by / and pick the last (-1) element, which is just the filename
-            filename = filename.split('/')[-1]
-
-            # Make a max-60-character filename to display as caption to template.
-            # If it's say 100 characters ending in .jpeg, it will truncate the part before 
-            # and add (...) but keep the .jpeg. If it doesn't have a period in it, it just
-            # truncates it 5 characters before the size limit and adds (...).
-            if filename == '':
-                image.filename = '(no filename)' # if there was no text between the last / in the url and the ?, just include the whole url
-            elif filename.rfind('.') == -1 and len(filename) > max_filename_length: # if no period in filename & > max chars, truncate to 26 chars + '(...)'
-                image.filename = filename[:max_filename_length-5] + '(...)'
-            elif filename.rfind('.') > 0 and len(filename) > max_filename_length: # if period & prefix of filename is > max chars, truncate prefix + '(...)'
-                image.filename = filename.split('.')[0][:max_filename_length-9] + '(...).' + after_substr(filename,'.')[:4]
-            else:
-                image.filename = filename
+        if not image.filename:
+            image.filename = describe_image_url(image.url)['filename']
             
         image.image_data_uri = f"data:{image.content_type};base64,{base64.b64encode(image.image).decode('utf-8')}"
 
     return images
 
+# Marker in success.html and past_search.html where the image cards go
+GALLERY_STREAM_MARKER = '<!-- gallery images stream here -->'
+
+# Renders a gallery page (success.html or past_search.html) for an Image queryset from one Search.
+# The rendered image cards and the image count are cached per search, content version and
+# filter/sort parameters (see caching.py), so repeat views don't re-query or re-encode the blobs.
+# On a cache miss the whole page is normally rendered at once. In streaming mode (settings.GALLERY_STREAMING,
+# or ?stream=1 / ?stream=0 to override it per request) the page header is sent immediately,
+# then the image cards follow a chunk at a time, so the browser starts painting right away and
+# only one chunk of blobs and base64 data URIs is in memory no matter how big the search is.
+def render_gallery_page(request, template_name, search, images, context):
+    search_id, version = search.id, search.content_version
+    variant = gallery_variant(request.GET)
+
+    context['number_of_images'] = get_or_compute('gallery_count', gallery_count_key(search_id, version, variant), images.count, gallery_timeout())
+    page = render_to_string(template_name, context, request)
+    page_header, page_footer = page.split(GALLERY_STREAM_MARKER, 1)
+
+    fragment_key = gallery_key(search_id, version, variant)
+    fragment = cache.get(fragment_key)
+    count_cache_lookup('gallery', fragment is not None)
+    if fragment is not None:
+        return HttpResponse(page_header + fragment + page_footer)
+
+    streaming = request.GET.get('stream', '1' if getattr(settings, 'GALLERY_STREAMING', False) else '0') == '1'
+    if not streaming or context['number_of_images'] == 0:
+        # Add filename and image_data_uri attribute for each image to send to the template
+        fragment = render_to_string('image_cards.html', {'images': add_template_data_to_image(images)})
+        cache_gallery_fragment(fragment_key, fragment)
+        return HttpResponse(page_header + fragment + page_footer)
+
+    response = StreamingHttpResponse(streaming_content(request, stream_gallery(page_header, images, page_footer, fragment_key)), content_type='text/html; charset=utf-8')
+    response['X-Accel-Buffering'] = 'no' # ask nginx-style proxies not to buffer the stream
+    return response
+
+# Canonical string of the gallery filter and sort parameters in a request, so the same gallery
+# requested with the parameters in a different order (or with unrelated ones) shares a cache entry
+def gallery_variant(query_params):
+    names = sorted(list(IMAGE_FILTER_PARAMETERS) + ['animated', 'vanished', 'sort'])
+    return '&'.join(f"{name}={query_params.get(name, '').strip().lower()}" for name in names if query_params.get(name, '').strip())
+
+# Caches a rendered gallery fragment, unless it's bigger than settings.GALLERY_CACHE_MAX_BYTES
+def cache_gallery_fragment(fragment_key, fragment):
+    if len(fragment) <= getattr(settings, 'GALLERY_CACHE_MAX_BYTES', 10000000):
+        cache.set(fragment_key, fragment, timeout=gallery_timeout())
+
+# Generator that yields the page header, then the rendered image cards a chunk at a time, then the footer.
+# The queryset's ids are walked with a server-side .iterator(chunk_size=...), and each chunk's blobs are
+# loaded with one query, so memory stays bounded even where the driver can't stream blob rows itself.
+# The chunks are also collected to cache the whole fragment, until it gets too big to cache.
+def stream_gallery(page_header, images, page_footer, fragment_key):
+    yield page_header
+
+    chunk_size = getattr(settings, 'GALLERY_STREAM_CHUNK_SIZE', 24)
+    max_cached_bytes = getattr(settings, 'GALLERY_CACHE_MAX_BYTES', 10000000)
+    chunks = []
+    chunks_length = 0
+
+    image_ids = []
+    for image_id in images.values_list('id', flat=True).iterator(chunk_size=chunk_size):
+        image_ids.append(image_id)
+        if len(image_ids) == chunk_size:
+            chunk = render_image_cards(image_ids)
+            image_ids = []
+            if chunks is not None:
+                chunks.append(chunk)
+                chunks_length += len(chunk)
+                if chunks_length > max_cached_bytes:
+                    chunks = None # too big to cache, stop holding on to it
+            yield chunk
+    if image_ids:
+        chunk = render_image_cards(image_ids)
+        if chunks is not None:
+            chunks.append(chunk)
+        yield chunk
+
+    if chunks is not None:
+        cache_gallery_fragment(fragment_key, ''.join(chunks))
+
+    yield page_footer
+
+# Content for a StreamingHttpResponse from a generator. Under ASGI (uvicorn, daphne...) Django reads a
+# sync iterator to the end with sync_to_async(list) before sending anything, which would hold a whole
+# gallery or export in memory, so there it gets an async iterator instead, making each chunk with
+# sync_to_async. Those calls run in the request's thread, like the view, so database cursors the
+# generator holds between chunks stay valid.
+def streaming_content(request, content):
+    if not isinstance(request, ASGIRequest):
+        return content
+    return _chunks_in_thread(content)
+
+async def _chunks_in_thread(content):
+    next_chunk = sync_to_async(next)
+    try:
+        while True:
+            chunk = await next_chunk(content, None) # chunks are never None, so that's the end
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        await sync_to_async(content.close)() # e.g. the client went away; let the generator clean up
+
+# Loads one chunk of images by id and renders their gallery cards, in the order of image_ids
+def render_image_cards(image_ids):
+    images_by_id = Image.objects.defer('original').in_bulk(image_ids) # the original blob isn't needed for display
+    images = [images_by_id[image_id] for image_id in image_ids if image_id in images_by_id]
+    return render_to_string('image_cards.html', {'images': add_template_data_to_image(images)})
+
 # Show a page for a given past search, including its URL & timestamp, and images stored 
+@reads_from_replica
 def past_search(request):
     try:
         # Check if an id parameter was sent (e.g. http://127.0.0.1:8000/past_searches?id=5) 
@@ -546,7 +1059,7 @@ def past_search(request):
         return render(request, 'fail.html', {'error_message': "No search id sent to past_search.html"})
 
     try:
-        search = Search.objects.get(id=search_id_for_page)
+        search = Search.objects.select_related('reused_from').get(id=search_id_for_page)
     except Search.DoesNotExist:
         return render(request, 'fail.html',{'error_message': f"Search ID {search_id_for_page} not found"})
 
@@ -554,22 +1067,32 @@ def past_search(request):
     local_dt = search.timestamp.astimezone(local_tz)
     search.timestamp_local = local_dt.strftime('%Y-%m-%d %H:%M:%S')
 
-    images = Image.objects.filter(search_id=search_id_for_page)
-
-    # Add filename and image_data_uri attribute for each image to send to success.html
-    images = add_template_data_to_image(images)
+    images_search = search.reused_from or search # a search that reused a recent scrape shows that scrape's images
+    images = filter_and_sort_images(Image.objects.defer('original').filter(search_id=images_search.id), request.GET)
+    record_search_view(images_search)
 
     # Return past_search.html with data to render it (images, search.url, search_timestamp_formatted) 
-    debug(f"Returning past_search.html")
-    return render(request, 'past_search.html', {'images': images, 'search_url': search.url, 'search_timestamp': search.timestamp_local})
+    logger.debug("Returning past_search.html")
+    context = {'search_id': search.id, 'search_url': search.url, 'search_timestamp': search.timestamp_local, 'bytes_saved': images_search.bytes_saved,
+               'refresh_summary': images_search.refresh_summary, **reused_from_context(search)}
+    if images_search.last_refreshed:
+        context['last_refreshed'] = images_search.last_refreshed.astimezone(local_tz).strftime('%Y-%m-%d %H:%M:%S')
+    return render_gallery_page(request, 'past_search.html', images_search, images, context)
+
+# Template data about the search a search reused the images of, if it did
+def reused_from_context(search):
+    if search.reused_from is None:
+        return {}
+    local_dt = search.reused_from.timestamp.astimezone(timezone.get_current_timezone())
+    return {'reused_from_id': search.reused_from.id, 'reused_from_timestamp': local_dt.strftime('%Y-%m-%d %H:%M:%S')}
 
 # Show success.html after storing images for user's requested URL
 def success(request, id):
-    debug(f"in success(), id={id} ")
+    logger.debug("in success(), id=%s ", id)
 
     # Retrieve the Search record with the id of the search we just performed
     try:
-        search = Search.objects.get(id=id)
+        search = Search.objects.select_related('reused_from').get(id=id)
     except Search.DoesNotExist:
         return render(request, 'fail.html', {'error_message': "Unexpected problem retrieving images from search"},)
     
@@ -579,11 +1102,107 @@ def success(request, id):
     search_timestamp_formatted = local_dt.strftime('%Y-%m-%d %H:%M:%S')
 
     # Retrieve all the Image records with the id of the search we just performed
-    images = Image.objects.filter(search_id=id)
-
-    # Add filename and image_data_uri attribute for each image to send to success.html
-    images = add_template_data_to_image(images)
+    images_search = search.reused_from or search # a search that reused a recent scrape shows that scrape's images
+    images = filter_and_sort_images(Image.objects.defer('original').filter(search_id=images_search.id), request.GET)
+    record_search_view(images_search)
 
     # Return success.html with data to render it (images, search.url, search_timestamp_formatted) 
-    debug(f"Returning success.html")
-    return render(request, 'success.html', {'images': images, 'search_url': search.url, 'search_timestamp': search_timestamp_formatted})
\ No newline at end of file
+    logger.debug("Returning success.html")
+    return render_gallery_page(request, 'success.html', images_search, images, {'search_id': search.id, 'search_url': search.url, 'search_timestamp': search_timestamp_formatted,
+                                                                               'bytes_saved': images_search.bytes_saved, **reused_from_context(search)})
+# Most images the image search page will show at once
+IMAGE_SEARCH_RESULTS_LIMIT = 100
+
+# Turns a 'YYYY-MM-DD' date from the search form into a timezone-aware datetime at the start of that
+# day in the local timezone, or None if it's empty or not a valid date.
+def local_date_to_datetime(date_string):
+    try:
+        date = datetime.date.fromisoformat(date_string.strip())
+    except ValueError:
+        return None
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time.min), timezone.get_current_timezone())
+
+# Search stored images by source host, filename and/or archived date range, e.g.
+# /search_images/?host=www.umich.edu&filename=logo&date_from=2023-05-01&date_to=2023-05-31
+# Host is an exact match on the indexed host column, and dates use the indexed timestamp column.
+# The filename is matched case-insensitively anywhere in the image URL's path (the stored display
+# filename is cut to 60 characters with "(...)", so it can't be searched reliably). A substring match
+# can't use an index, so giving a host or dates as well keeps it from scanning the whole table.
+# The gallery filter and sort parameters (min_width, format, sort, ...) work here too.
+@reads_from_replica
+def search_images(request):
+    host = request.GET.get('host', '').strip().lower()
+    filename = request.GET.get('filename', '').strip()
+    date_from = request.GET.get('date_from', '')
+    date_to = request.GET.get('date_to', '')
+
+    images = None
+    if host or filename or date_from or date_to:
+        images = Image.objects.defer('original')
+        if host:
+            images = images.filter(host=host)
+        start = local_date_to_datetime(date_from)
+        if start:
+            images = images.filter(timestamp__gte=start)
+        end = local_date_to_datetime(date_to)
+        if end:
+            images = images.filter(timestamp__lt=end + datetime.timedelta(days=1)) # date_to is inclusive
+        if filename:
+            images = images.filter(path__icontains=filename)
+
+        images = filter_and_sort_images(images.order_by('-timestamp', '-id'), request.GET)
+        images = add_template_data_to_image(images[:IMAGE_SEARCH_RESULTS_LIMIT])
+
+    return render(request, 'search_images.html', {
+        'images': images,
+        'host': host,
+        'filename': filename,
+        'date_from': date_from,
+        'date_to': date_to,
+        'results_limit': IMAGE_SEARCH_RESULTS_LIMIT,
+    })
+
+# Download all of a search's images as a ZIP archive (see export.py), streamed so memory stays constant.
+# Supports Range requests (with If-Range) so a big download can be resumed where it left off.
+@reads_from_replica
+def export_search(request, id):
+    try:
+        search = Search.objects.select_related('reused_from').get(id=id)
+    except Search.DoesNotExist:
+        return render(request, 'fail.html', {'error_message': f"Search ID {id} not found"})
+
+    try:
+        export = SearchExport(search.reused_from or search) # a search that reused a recent scrape exports that scrape's images
+    except ExportTooLarge as e:
+        return render(request, 'fail.html', {'error_message': str(e)})
+
+    byte_range = None
+    if request.headers.get('If-Range', export.etag) == export.etag: # only resume if the archive hasn't changed
+        try:
+            byte_range = parse_range_header(request.headers.get('Range'), export.total_size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f"bytes */{export.total_size}"
+            return response
+
+    if byte_range:
+        start, end = byte_range
+        response = StreamingHttpResponse(streaming_content(request, export.stream(start, end)), status=206, content_type='application/zip')
+        response['Content-Range'] = f"bytes {start}-{end}/{export.total_size}"
+        response['Content-Length'] = end - start + 1
+    else:
+        response = StreamingHttpResponse(streaming_content(request, export.stream()), content_type='application/zip')
+        response['Content-Length'] = export.total_size
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = export.etag
+    response['Content-Disposition'] = f'attachment; filename="{export.filename()}"'
+    return response
+
+# Prometheus text format metrics for this server process: counts and timings of every scrape
+# pipeline stage (see metrics.py), plus the page cache hit and miss counts.
+def metrics(request):
+    extra_counters = []
+    for cache_name, stats in cache_stats().items():
+        extra_counters.append(('cache_hits', {'cache': cache_name}, stats['hits']))
+        extra_counters.append(('cache_misses', {'cache': cache_name}, stats['misses']))
+    return HttpResponse(render_prometheus(extra_counters), content_type='text/plain; version=0.0.4; charset=utf-8')
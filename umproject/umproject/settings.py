@@ -74,23 +74,72 @@ WSGI_APPLICATION = 'umproject.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
+#
+# UMPROJECT_DB_PROFILE picks the layout:
+#   'mysql' (the default): the MySQL server below. Set UMPROJECT_DB_READ_HOST to send the listing and
+#       gallery views' reads to a replica on that host (see my_app/database.py).
+#   'sqlite': one SQLite file (UMPROJECT_SQLITE_PATH, default db.sqlite3 next to manage.py), using
+#       SQLITE_PRAGMAS below: WAL so readers and the scraper's writes don't block each other, a bigger
+#       page cache and memory mapped reads. Fine for a single server, and no database server to run.
+#   'sqlite-read-replica': the SQLite file for writes, plus a second file (the same name ending in
+#       -read.sqlite3) the listing and gallery views read from, to try the read/write routing locally.
+#       Copy the first to the second with 'manage.py sync_read_database' (--interval to keep doing it).
+# UMPROJECT_DB_CONN_MAX_AGE is how many seconds connections are kept open for reuse between requests
+# (0 closes them after every request, None keeps them forever).
+
+DB_PROFILE = os.environ.get('UMPROJECT_DB_PROFILE', 'mysql')
+DB_CONN_MAX_AGE = os.environ.get('UMPROJECT_DB_CONN_MAX_AGE', '60')
+DB_CONN_MAX_AGE = None if DB_CONN_MAX_AGE == 'None' else int(DB_CONN_MAX_AGE)
+
+MYSQL_DATABASE = {
+    'ENGINE': 'django.db.backends.mysql',
+    'NAME': 'basepy',
+    'USER': 'root',
+    'PASSWORD': '',
+    'HOST':'localhost',
+    'PORT':'3306',
+    'OPTIONS': {
+        'connect_timeout': 30, # set connection timeout to 30 seconds
+        'read_timeout': 60, # set read timeout to 60 seconds
+        'write_timeout': 60, # set read timeout to 60 seconds
+    },
+    'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+    'CONN_HEALTH_CHECKS': True, # check a reused connection still works before each request
+}
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.mysql',
-        'NAME': 'basepy',
-        'USER': 'root',
-        'PASSWORD': '',
-        'HOST':'localhost',
-        'PORT':'3306',
-        'OPTIONS': {
-            'connect_timeout': 30, # set connection timeout to 30 seconds
-            'read_timeout': 60, # set read timeout to 60 seconds
-            'write_timeout': 60, # set read timeout to 60 seconds
-        },
-    }
+SQLITE_PATH = os.environ.get('UMPROJECT_SQLITE_PATH', os.path.join(BASE_DIR, 'db.sqlite3'))
+SQLITE_DATABASE = {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': SQLITE_PATH,
+    'OPTIONS': {
+        'timeout': 20, # seconds to wait for another connection's write lock
+    },
+    'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+    'CONN_HEALTH_CHECKS': True,
 }
 
+# Applied to every new SQLite connection (see my_app/database.py)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL', # safe with WAL, and far fewer fsyncs
+    'cache_size': -64000, # negative means KiB, so about 64MB of page cache per connection
+    'mmap_size': 268435456, # read up to 256MB of the file through memory mapping
+    'temp_store': 'MEMORY',
+    'auto_vacuum': 'INCREMENTAL', # lets a purge hand freed pages back a chunk at a time (new files; an existing one switches at its next VACUUM)
+}
+
+DATABASE_READ_ALIAS = 'read'
+DATABASE_ROUTERS = ['my_app.database.ReadReplicaRouter']
+
+if DB_PROFILE in ('sqlite', 'sqlite-read-replica'):
+    DATABASES = {'default': SQLITE_DATABASE}
+    if DB_PROFILE == 'sqlite-read-replica':
+        DATABASES[DATABASE_READ_ALIAS] = {**SQLITE_DATABASE, 'NAME': os.path.splitext(SQLITE_PATH)[0] + '-read.sqlite3', 'TEST': {'MIRROR': 'default'}}
+else:
+    DATABASES = {'default': MYSQL_DATABASE}
+    if os.environ.get('UMPROJECT_DB_READ_HOST'):
+        DATABASES[DATABASE_READ_ALIAS] = {**MYSQL_DATABASE, 'HOST': os.environ['UMPROJECT_DB_READ_HOST'], 'TEST': {'MIRROR': 'default'}}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -122,11 +171,136 @@ USE_I18N = True
 
 USE_TZ = True
 
+# After scraping the HTML, load the page in a headless browser to pick up script-loaded images and inline SVGs
+SCRAPE_WITH_WEBDRIVER = True
+
+# Async scraping (my_app.views.scrape_web_page_async, at /scrape_web_page_async/), for running under an
+# ASGI server, e.g. 'uvicorn umproject.asgi:application'. Needs httpx (pip install httpx).
+# Each scrape downloads at most ASYNC_SCRAPE_CONCURRENCY images at once, and saves them to the database
+# ASYNC_SCRAPE_DB_BATCH_SIZE at a time (the sync scrape saves in batches of that size too, so each
+# batch's transcoding runs in parallel). Set SCRAPE_ASYNC to serve /scrape_web_page/ with it as well.
+SCRAPE_ASYNC = False
+ASYNC_SCRAPE_CONCURRENCY = 8
+ASYNC_SCRAPE_DB_BATCH_SIZE = 20
+ASYNC_SCRAPE_TIMEOUT = 30 # seconds for each page or image request
+
+# Per-host scheduling of every page and image request (see my_app/fetch_scheduler.py). Each host gets
+# an adaptive limit on requests in flight (starting at FETCH_HOST_INITIAL_CONCURRENCY, between the MIN
+# and MAX), and a token bucket rate limit (0 for none). Transient failures are retried with jittered
+# exponential backoff, honoring Retry-After up to FETCH_RETRY_AFTER_MAX seconds, and a host that fails
+# FETCH_CIRCUIT_BREAKER_FAILURES times in a row isn't tried again for FETCH_CIRCUIT_BREAKER_COOLDOWN seconds.
+FETCH_HOST_INITIAL_CONCURRENCY = 4
+FETCH_HOST_MIN_CONCURRENCY = 1
+FETCH_HOST_MAX_CONCURRENCY = 16
+FETCH_HOST_MAX_REQUESTS_PER_SECOND = 20
+FETCH_HOST_BURST = 20 # requests that may start at once before the rate limit kicks in
+FETCH_HOST_LATENCY_TARGET = 2 # seconds; slower responses shrink the host's concurrency limit
+FETCH_TIMEOUT = 30 # seconds for each request (sync pipeline; the async one uses ASYNC_SCRAPE_TIMEOUT)
+FETCH_MAX_RETRIES = 3
+FETCH_BACKOFF_BASE = 0.5 # seconds
+FETCH_BACKOFF_MAX = 30 # seconds
+FETCH_RETRY_AFTER_MAX = 60 # seconds
+FETCH_CIRCUIT_BREAKER_FAILURES = 5
+FETCH_CIRCUIT_BREAKER_COOLDOWN = 30 # seconds
+
+# Redirects from the page a search asks for (see my_app/redirects.py): at most MAX_REDIRECTS hops are
+# followed, and where a URL ends up is cached, so searching for it again skips the hops. A chain of only
+# permanent redirects (301 / 308) is cached for REDIRECT_CACHE_TIMEOUT seconds, one with a temporary
+# redirect (302 / 303 / 307) in it for REDIRECT_TEMPORARY_CACHE_TIMEOUT, since the site may change it.
+MAX_REDIRECTS = 10
+REDIRECT_CACHE_TIMEOUT = 24 * 60 * 60
+REDIRECT_TEMPORARY_CACHE_TIMEOUT = 5 * 60
+
+# A page scraped less than SCRAPE_REUSE_WINDOW seconds ago (or refreshed since) isn't scraped again;
+# the new search shows that scrape's images (see my_app/reuse.py). 0 turns this off. The scrape form's
+# "force fresh" box skips it for one scrape.
+SCRAPE_REUSE_WINDOW = 10 * 60
+
 # WebDriver executable locations:
 CHROME_DRIVER_EXECUTABLE_LOCATION = r"C:\Python311\Scripts\chromedriver.exe"
 FIREFOX_DRIVER_EXECUTABLE_LOCATION = r"C:\Python311\Scripts\geckodriver.exe"
 FIREFOX_BROWSER_EXECUTABLE_LOCATION = r"C:\Program Files (x86)\Mozilla Firefox\firefox.exe"
 
+# Gallery pages (success and past_search) stream image cards to the browser as they're rendered,
+# GALLERY_STREAM_CHUNK_SIZE images at a time, instead of building the whole page first.
+# Can be overridden per request with ?stream=1 or ?stream=0.
+GALLERY_STREAMING = True
+GALLERY_STREAM_CHUNK_SIZE = 24
+
+# Cache for rendered gallery cards, image counts and the past searches list (see my_app/caching.py).
+# Gallery entries are keyed by Search.content_version, which is in the database, so a change made by
+# any process (another worker, purge_images, generate_synthetic_dataset...) is seen by every worker
+# at once. The site-wide entries can be up to LISTING_CACHE_TIMEOUT seconds stale in other processes.
+# The local-memory cache is per process, and holds at most MAX_BYTES (gallery fragments can be
+# megabytes each, so MAX_ENTRIES alone doesn't bound it). To share one cache between worker
+# processes, use the file based one (MAX_BYTES doesn't apply to it):
+#     'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+#     'LOCATION': os.path.join(BASE_DIR, 'cache'),
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+CACHES = {
+    'default': {
+        'BACKEND': 'my_app.cache_backends.ByteLimitedLocMemCache',
+        'LOCATION': 'umproject',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+            'MAX_BYTES': 200 * 1024 * 1024, # per worker process
+        },
+    }
+}
+GALLERY_CACHE_TIMEOUT = 60 * 60 # seconds to keep a search's rendered gallery cards
+GALLERY_CACHE_MAX_BYTES = 10000000 # galleries bigger than this (as rendered HTML) aren't cached
+LISTING_CACHE_TIMEOUT = 5 * 60 # seconds to keep the past searches list and the counts
+
+# Ingest-time transcoding (see my_app/transcode.py). When on, photos are stored re-encoded as
+# IMAGE_TRANSCODE_FORMAT ('WEBP', 'AVIF' or 'JPEG') at IMAGE_TRANSCODE_QUALITY, and PNGs and still GIFs
+# are recompressed losslessly, in a pool of IMAGE_TRANSCODE_WORKERS processes. The original download
+# is kept alongside (served by /image/<id>/?original=1) if IMAGE_TRANSCODE_KEEP_ORIGINAL is set, but
+# then storage grows instead of shrinking, and nothing is counted as saved by transcoding.
+IMAGE_TRANSCODING = False
+IMAGE_TRANSCODE_FORMAT = 'WEBP'
+IMAGE_TRANSCODE_QUALITY = 80
+IMAGE_TRANSCODE_KEEP_ORIGINAL = False
+IMAGE_TRANSCODE_MIN_BYTES = 10000 # smaller images aren't worth transcoding
+IMAGE_TRANSCODE_WORKERS = 2
+IMAGE_TRANSCODE_TIMEOUT = 30 # seconds to wait for an image's transcode before storing it as downloaded
+
+# Retention (see my_app/retention.py), applied by 'manage.py purge_images', e.g. nightly from cron.
+# Set a policy to None to turn it off.
+RETENTION_MAX_SEARCH_AGE_DAYS = None # delete searches scraped longer ago than this
+RETENTION_MAX_TOTAL_BYTES = None # over this, delete the least recently viewed searches
+RETENTION_MAX_BYTES_PER_HOST = None # over this for one image host, delete its least recently viewed images
+RETENTION_PURGE_CHUNK_SIZE = 200 # images deleted per query
+RETENTION_PURGE_PAUSE = 0.5 # seconds between chunks, so the site's own queries get in
+RETENTION_RECLAIM_CHUNK_PAGES = 2560 # free pages handed back per incremental vacuum of SQLite (10MB with 4KB pages)
+SEARCH_VIEW_RECORD_INTERVAL = 60 * 60 # seconds; a gallery view updates Search.last_viewed at most this often
+
+# Logging. The scrape pipeline logs through the 'my_app' logger: warnings for failures, and a line
+# for every step at DEBUG. Set UMPROJECT_LOG_LEVEL (e.g. INFO or WARNING) to quiet it down.
+# https://docs.djangoproject.com/en/4.2/topics/logging/
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {
+            'format': '{levelname}: {message}',
+            'style': '{',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'simple',
+        },
+    },
+    'loggers': {
+        'my_app': {
+            'handlers': ['console'],
+            'level': os.environ.get('UMPROJECT_LOG_LEVEL', 'DEBUG' if DEBUG else 'WARNING'),
+            'propagate': False,
+        },
+    },
+}
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/4.2/howto/static-files/
 
@@ -15,6 +15,7 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
+from django.conf import settings
 from django.urls import path
 from my_app import views
 
@@ -22,8 +23,14 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('',views.home_page, name="home_page"),
     path('show_all_images/', views.show_all_images, name='show_all_images'),
-    path('scrape_web_page/', views.scrape_web_page, name='scrape_web_page'),
+    path('scrape_web_page/', views.scrape_web_page_async if settings.SCRAPE_ASYNC else views.scrape_web_page, name='scrape_web_page'),
+    path('scrape_web_page_async/', views.scrape_web_page_async, name='scrape_web_page_async'),
     path('success/<int:id>/', views.success, name='success'),
     path('past_searches/', views.past_searches, name='past_searches'),
     path('past_search.html', views.past_search, name='past_search'),
+    path('search_images/', views.search_images, name='search_images'),
+    path('export/<int:id>/', views.export_search, name='export_search'),
+    path('refresh/<int:id>/', views.refresh_search, name='refresh_search'),
+    path('image/<int:image_id>/', views.myimage, name='myimage'),
+    path('metrics', views.metrics, name='metrics'),
 ]
\ No newline at end of file